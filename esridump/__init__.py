@@ -1,2 +1,4 @@
-from esridump.esri2geojson import esri2geojson
-from esridump.dumper import EsriDumper
+from esridump.esri2geojson import esri2geojson, esri2geojson_batch
+from esridump.dumper import EsriDumper, QueryPlan
+from esridump.aio import AsyncEsriDumper
+from esridump.service import ServiceDumper
@@ -0,0 +1,281 @@
+import asyncio
+import ssl
+import time
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from esridump.dumper import EsriDumper, QueryPlan
+from esridump.errors import EsriDownloadError
+from esridump.ratelimit import retry_after_seconds
+
+
+def _caused_by_ssl_error(exc):
+    while exc is not None:
+        if isinstance(exc, ssl.SSLError):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+class AsyncEsriDumper(EsriDumper):
+    """ An EsriDumper for asyncio code, used with ``async for``.
+
+    It plans the pages exactly like EsriDumper but sends every request through
+    an httpx.AsyncClient and backs off with asyncio.sleep, so many layers can
+    be dumped from a single event loop. Pass the same ``client`` to several
+    dumpers to share one connection pool between them. Create it with
+    ``follow_redirects=True``, since requests follows redirects and httpx
+    doesn't by default.
+    """
+
+    def __init__(self, url, client=None, **kwargs):
+        if httpx is None:
+            raise ImportError("AsyncEsriDumper requires httpx, install it with `pip install esridump[async]`")
+
+        super().__init__(url, **kwargs)
+        if self._stream_pages:
+            raise ValueError("AsyncEsriDumper doesn't support stream_pages")
+        if self._adaptive_page_size:
+            raise ValueError("AsyncEsriDumper doesn't support max_page_size='auto'")
+        self._client = client
+        self._owns_client = client is None
+        self._insecure_client = None
+
+    def _get_client(self):
+        if self._client is None:
+            limits = httpx.Limits(max_connections=self._pool_size,
+                                  max_keepalive_connections=self._pool_size if self._keep_alive else 0)
+            self._client = httpx.AsyncClient(limits=limits, follow_redirects=True)
+        return self._client
+
+    async def aclose(self):
+        """ Close the HTTP clients this dumper opened itself. """
+        if self._owns_client and self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._insecure_client is not None:
+            await self._insecure_client.aclose()
+            self._insecure_client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def _request(self, method, url, **kwargs):
+        url = self._apply_proxy(url, kwargs)
+
+        self._logger.debug("%s %s, args %s", method, url,
+                           kwargs.get('params') or kwargs.get('data'))
+        try:
+            return await self._get_client().request(method, url, timeout=self._http_timeout, **kwargs)
+        except httpx.ConnectError as e:
+            if not _caused_by_ssl_error(e):
+                raise
+            self._logger.warning("Retrying %s without SSL verification", url)
+            if self._insecure_client is None:
+                self._insecure_client = httpx.AsyncClient(verify=False, follow_redirects=True)
+            return await self._insecure_client.request(method, url, timeout=self._http_timeout, **kwargs)
+
+    async def _perform(self, request):
+        if request.error_message is None:
+            return await self._request(request.method, request.url, **request.kwargs)
+
+        key, data = self._cache_lookup(request.method, request.url, request.kwargs, request.error_message)
+        if data is not None:
+            return data
+
+        response = await self._request(request.method, request.url, **request.kwargs)
+        self._record_response(request.stat, response)
+        data = self._handle_esri_errors(response, request.error_message)
+        self._cache_store(key, response)
+        return data
+
+    async def _drive(self, steps):
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    result = await self._perform(request)
+                except Exception as e:
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+    async def can_handle_pagination(self, query_fields):
+        return await self._drive(self._can_handle_pagination(query_fields))
+
+    async def get_metadata(self):
+        if self._metadata is None:
+            self._metadata = await self._drive(self._get_metadata())
+        return self._metadata
+
+    async def get_feature_count(self):
+        return await self._drive(self._get_feature_count())
+
+    async def plan(self):
+        if self._planned is None:
+            self._planned = self._plan_from_checkpoint() or self._with_transport(await self._drive(self._plan_pages()))
+        return QueryPlan(self._layer_url, self._planned)
+
+    async def _fetch_envelope(self, envelope, depth, outSR, max_records):
+        if self._envelope_count_first:
+            await asyncio.sleep(self._rate_limiter.acquire())
+            try:
+                count = await self._drive(self._count_bounded_features(envelope))
+            except EsriDownloadError as e:
+                count = e
+            split = self._plan_envelope(count, depth, max_records)
+            if split:
+                return envelope, depth, None
+            if count == 0:
+                return envelope, depth, []
+        else:
+            split = None
+
+        await asyncio.sleep(self._rate_limiter.acquire())
+        features = await self._drive(self._fetch_bounded_features(envelope, outSR))
+        self._count_stats(envelope_features_fetched=len(features))
+        if split is None and self._envelope_is_full(len(features), depth, max_records):
+            return envelope, depth, None
+        return envelope, depth, features
+
+    async def _scrape_an_envelope(self, envelope, outSR, max_records):
+        stack = [(envelope, 0)]
+        in_flight = set()
+        try:
+            while stack or in_flight:
+                while stack and len(in_flight) < self._concurrency:
+                    box, depth = stack.pop()
+                    in_flight.add(asyncio.ensure_future(self._fetch_envelope(box, depth, outSR, max_records)))
+
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    box, depth, features = task.result()
+                    if features is None:
+                        stack.extend((child, depth + 1) for child in reversed(self._split_envelope(box)))
+                    else:
+                        for feature in features:
+                            yield feature
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+        self._log_envelope_stats(max_records)
+
+    def __iter__(self):
+        raise TypeError("AsyncEsriDumper must be iterated with `async for`")
+
+    def iter_pages(self):
+        raise TypeError("AsyncEsriDumper must be iterated with `async for`")
+
+    def iter_serialized_pages(self, jsonlines=False, fast_json=False):
+        raise TypeError("AsyncEsriDumper must be iterated with `async for`")
+
+    async def __aiter__(self):
+        try:
+            await self.plan()
+            plan, self._planned = self._planned, None
+
+            if plan.strategy == 'envelope':
+                if self._checkpoint:
+                    self._logger.warning("Envelope scraping can't be checkpointed, so this dump can't be resumed")
+
+                bounds = plan.metadata['extent']
+                saved = set()
+
+                async for feature in self._scrape_an_envelope(bounds, self._outSR, plan.page_size):
+                    oid = feature['attributes'].get(plan.oid_field_name)
+                    if oid in saved:
+                        continue
+
+                    yield self._convert_feature(feature)
+
+                    saved.add(oid)
+
+                return
+
+            async for index, features in self._fetch_pages(self._pages_to_fetch(plan)):
+                for feature in self._convert_page(features):
+                    yield feature
+                self._page_done(index)
+        finally:
+            await self.aclose()
+
+    async def _fetch_page(self, query_args):
+        if self._pbf_failed and query_args.get('f') == 'pbf':
+            query_args = self._json_page_args(query_args)
+
+        query_url = self._build_url('/query')
+        headers = self._build_headers()
+        download_exception = None
+        error_message = "Could not retrieve this chunk of objects"
+
+        def parse(response):
+            return self._parse_page(response, query_args, error_message)
+
+        cache_key, data = self._cache_lookup(
+            'POST', query_url, dict(data=query_args), error_message, parse=parse)
+        if data is not None:
+            return self._check_page(data, query_args)
+
+        for retry in range(self._num_of_retry):
+            response = None
+            try:
+                await asyncio.sleep(self._rate_limiter.acquire())
+                started = time.monotonic()
+                response = await self._request(
+                    'POST', query_url, headers=headers, data=query_args)
+                data = parse(response)
+                self._rate_limiter.record_success(time.monotonic() - started)
+                self._cache_store(cache_key, response)
+                download_exception = None
+                break
+            except ValueError as e:
+                if query_args.get('f') == 'pbf':
+                    self._logger.warning("Could not decode a pbf page, so fetching pages as JSON from now on: %s", e)
+                    self._pbf_failed = True
+                    return await self._fetch_page(query_args)
+                raise EsriDownloadError("Could not parse JSON", e)
+            except Exception as e:
+                download_exception = EsriDownloadError(
+                    "Could not connect to URL", e)
+                self._rate_limiter.record_failure(retry_after_seconds(response))
+                await asyncio.sleep(self._rate_limiter.backoff(retry))
+                self._logger.info("retry pause {0}".format(retry))
+
+        if download_exception:
+            raise download_exception
+
+        return self._check_page(data, query_args)
+
+    async def _fetch_pages(self, pages):
+        """ Fetch each (index, query_args) pair in pages with at most `concurrency` requests in flight. """
+        # Maps each in-flight task to its page index, in submission order
+        pending = {}
+        try:
+            for index, query_args in pages:
+                pending[asyncio.ensure_future(self._fetch_page(query_args))] = index
+                while len(pending) >= self._concurrency:
+                    yield await self._next_finished_page(pending)
+
+            while pending:
+                yield await self._next_finished_page(pending)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _next_finished_page(self, pending):
+        if self._ordered:
+            task = next(iter(pending))
+            await asyncio.wait([task])
+        else:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            task = done.pop()
+        return pending.pop(task), task.result()
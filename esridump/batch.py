@@ -0,0 +1,190 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from six.moves.urllib.parse import urlparse
+
+from esridump.dumper import EsriDumper, _build_rate_limiter, _build_session, _sets_rate_limit
+from esridump.writers import GeoJSONWriter, json_dumps
+
+# One dump to run: a layer URL, the file to write it to, and the query
+# parameters and HTTP headers to send with its requests.
+ManifestEntry = collections.namedtuple('ManifestEntry', 'url outfile params headers')
+
+
+def read_manifest(path):
+    """ Read a manifest of dumps, returning a list of ManifestEntry.
+
+    Each line is a JSON object with a ``url``, an ``outfile`` and optionally
+    ``params`` and ``headers`` objects. Blank lines and lines starting with
+    ``#`` are skipped.
+    """
+    entries = []
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            try:
+                entry = json.loads(line)
+                entries.append(ManifestEntry(
+                    entry['url'], entry['outfile'], entry.get('params') or {}, entry.get('headers') or {}))
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError("Line {} of manifest {} isn't a valid entry: {}".format(number, path, e))
+    return entries
+
+
+def _host(entry):
+    return urlparse(entry.url).netloc
+
+
+class _HostScheduler(object):
+    """ Hands out entry indexes round-robin across hosts, with at most host_limit running for each host. """
+
+    def __init__(self, entries, host_limit):
+        self._entries = entries
+        self._host_limit = host_limit
+        # Indexes of the entries waiting to run for each host, with the host to try first at the front
+        self._waiting = collections.OrderedDict()
+        for index, entry in enumerate(entries):
+            self._waiting.setdefault(_host(entry), collections.deque()).append(index)
+        self._running = collections.Counter()
+        self._condition = threading.Condition()
+
+    def next_entry(self):
+        """ Wait until an entry can start and return its index, or return None once every entry has started. """
+        with self._condition:
+            while self._waiting:
+                for host, indexes in self._waiting.items():
+                    if self._running[host] < self._host_limit:
+                        break
+                else:
+                    self._condition.wait()
+                    continue
+
+                index = indexes.popleft()
+                self._running[host] += 1
+                # Every other host with waiting entries goes before this one next time
+                if indexes:
+                    self._waiting.move_to_end(host)
+                else:
+                    del self._waiting[host]
+                return index
+            return None
+
+    def entry_done(self, index):
+        with self._condition:
+            self._running[_host(self._entries[index])] -= 1
+            self._condition.notify_all()
+
+
+class BatchDumper(object):
+    """ Runs the dumps in a manifest in one process.
+
+    At most ``workers`` dumps run at once, and at most ``host_concurrency``
+    of them against the same host. Hosts take turns, so one host with many
+    entries can't hold up the rest. Dumps share a connection pool, and the
+    dumps of each host share an adaptive rate limiter. Other keyword
+    arguments are passed to each EsriDumper. An entry's params and headers
+    are added to ``extra_query_args`` and ``extra_headers``.
+    """
+
+    def __init__(self, entries, workers=8, host_concurrency=2, parent_logger=None, **dumper_kwargs):
+        self._entries = list(entries)
+        self._workers = max(1, workers or 1)
+        self._host_concurrency = max(1, host_concurrency or 1)
+        self._dumper_kwargs = dumper_kwargs
+        self._parent_logger = parent_logger
+        self._rate_limiters = {}
+        self._lock = threading.Lock()
+
+        if parent_logger:
+            self._logger = parent_logger.getChild('esridump')
+        else:
+            self._logger = logging.getLogger('esridump')
+
+        self._session = _build_session(self._workers * max(1, dumper_kwargs.get('concurrency') or 1))
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _rate_limiter(self, host):
+        with self._lock:
+            if host not in self._rate_limiters:
+                self._rate_limiters[host] = _build_rate_limiter(self._logger)
+            return self._rate_limiters[host]
+
+    def _dumper(self, entry):
+        kwargs = dict(self._dumper_kwargs, session=self._session, parent_logger=self._parent_logger)
+        kwargs['extra_query_args'] = dict(kwargs.get('extra_query_args') or {}, **entry.params)
+        kwargs['extra_headers'] = dict(kwargs.get('extra_headers') or {}, **entry.headers)
+        if not _sets_rate_limit(kwargs):
+            kwargs['rate_limiter'] = self._rate_limiter(_host(entry))
+        return EsriDumper(entry.url, **kwargs)
+
+    def _run_entry(self, entry, jsonlines, fast_json):
+        started = time.monotonic()
+        result = dict(url=entry.url, outfile=entry.outfile, status='ok', features=0)
+        self._logger.info("Dumping %s to %s", entry.url, entry.outfile)
+
+        def counted(features):
+            for feature in features:
+                result['features'] += 1
+                yield feature
+
+        try:
+            directory = os.path.dirname(entry.outfile)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            with open(entry.outfile, 'w') as f:
+                writer = GeoJSONWriter(f, jsonlines=jsonlines, dumps=json_dumps(fast=fast_json))
+                for page in self._dumper(entry).iter_pages():
+                    writer.write_page(counted(page))
+                writer.close()
+        except Exception as e:
+            self._logger.exception("Could not dump %s", entry.url)
+            result.update(status='failed', error=str(e))
+            if os.path.exists(entry.outfile):
+                os.remove(entry.outfile)
+
+        result['seconds'] = round(time.monotonic() - started, 3)
+        return result
+
+    def run(self, jsonlines=False, fast_json=False):
+        """ Run every entry, returning a report with one dict per entry in manifest order.
+
+        Each dict has the entry's url and outfile, a status of 'ok' or
+        'failed', the number of features written, the seconds it took and,
+        for failures, the error.
+        """
+        scheduler = _HostScheduler(self._entries, self._host_concurrency)
+        report = [None] * len(self._entries)
+
+        def work():
+            while True:
+                index = scheduler.next_entry()
+                if index is None:
+                    return
+                try:
+                    report[index] = self._run_entry(self._entries[index], jsonlines, fast_json)
+                finally:
+                    scheduler.entry_done(index)
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            for future in [executor.submit(work) for _ in range(self._workers)]:
+                future.result()
+
+        failed = sum(1 for result in report if result['status'] != 'ok')
+        self._logger.info("Dumped %s of %s entries, %s failed", len(report) - failed, len(report), failed)
+        return report
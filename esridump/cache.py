@@ -0,0 +1,120 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+# How many of the least recently used entries to look at a time when making room
+_EVICTION_BATCH = 16
+
+
+class CachedResponse(object):
+    """ Just enough of a requests.Response to run a cached body through EsriDumper._handle_esri_errors. """
+
+    status_code = 200
+
+    class _Request(object):
+        def __init__(self, url):
+            self.url = url
+
+    def __init__(self, url, content):
+        self.request = self._Request(url)
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache(object):
+    """ An on-disk cache of Esri response bodies, stored zlib-compressed in a SQLite file.
+
+    Entries older than ``ttl`` seconds are ignored and dropped. When the
+    compressed bodies add up to more than ``max_size`` bytes, the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, path, ttl=None, max_size=1024 ** 3, compress_level=6, clock=time.time):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._compress_level = compress_level
+        self._clock = clock
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER, body BLOB)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def key(self, method, url, params=None, data=None):
+        """ Build a cache key from the request, independent of the order of its arguments. """
+        canonical = json.dumps(
+            [method.upper(), url, params or {}, data or {}],
+            sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """ Return the cached body for key, or None if it's missing or expired. """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT created, size, body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            created, size, body = row
+            now = self._clock()
+            if self._ttl is not None and created + self._ttl < now:
+                self._delete(key, size)
+                self._db.commit()
+                return None
+
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+
+        return zlib.decompress(body)
+
+    def put(self, key, content):
+        body = zlib.compress(content, self._compress_level)
+        now = self._clock()
+
+        with self._lock:
+            row = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._delete(key, row[0])
+
+            self._db.execute(
+                "INSERT INTO responses (key, created, accessed, size, body) VALUES (?, ?, ?, ?, ?)",
+                (key, now, now, len(body), body))
+            self._size += len(body)
+            self._evict()
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def _delete(self, key, size):
+        self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self._size -= size
+
+    def _evict(self):
+        if self._size <= self._max_size:
+            return
+
+        # Read the oldest few entries at a time off the accessed index, rather than the whole table
+        while self._size > self._max_size:
+            rows = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed LIMIT ?", (_EVICTION_BATCH,)).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._size <= self._max_size:
+                    break
+                self._delete(key, size)
@@ -0,0 +1,85 @@
+import json
+import os
+
+
+class Checkpoint(object):
+    """ Records a dump's query plan and which of its pages have been written.
+
+    The checkpoint is a newline-delimited JSON file. The first line holds the
+    layer URL, the pagination strategy and every page's query arguments. Each
+    following line marks one page as written, along with whatever state the
+    ``on_save`` callback returns (the CLI stores its output file offset). The
+    file is only ever appended to, so a crash can at most lose the last line.
+    """
+
+    def __init__(self, path, on_save=None):
+        self.path = path
+        self.url = None
+        self.strategy = None
+        self.page_args = None
+        self.completed = set()
+        self.state = {}
+        self._on_save = on_save
+
+    def load(self):
+        """ Read an existing checkpoint file, returning False if there isn't one. """
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'r') as f:
+            lines = f.readlines()
+
+        if not lines:
+            return False
+
+        header = json.loads(lines[0])
+        self.url = header['url']
+        self.strategy = header['strategy']
+        self.page_args = header['page_args']
+
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may have been cut off when the previous run died
+                break
+            self.completed.add(entry['page'])
+            self.state = entry.get('state', {})
+
+        return True
+
+    def start(self, url, strategy, page_args):
+        """ Start a new checkpoint file for a freshly planned dump. """
+        self.url = url
+        self.strategy = strategy
+        self.page_args = list(page_args)
+        self.completed = set()
+        self.state = {}
+
+        with open(self.path, 'w') as f:
+            json.dump(dict(url=url, strategy=strategy, page_args=self.page_args), f)
+            f.write('\n')
+
+    def page_done(self, index):
+        """ Mark the page at ``index`` in page_args as written. """
+        if self._on_save:
+            self.state = self._on_save()
+        self.completed.add(index)
+
+        with open(self.path, 'a') as f:
+            json.dump(dict(page=index, state=self.state), f)
+            f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remaining_pages(self):
+        """ The (index, query_args) pairs of pages that have not been written yet. """
+        return [
+            (index, query_args)
+            for index, query_args in enumerate(self.page_args)
+            if index not in self.completed
+        ]
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
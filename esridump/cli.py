@@ -3,9 +3,26 @@ import email.parser
 from six.moves import urllib
 import logging
 import json
+import os
 import sys
 
 from esridump import EsriDumper
+from esridump.batch import BatchDumper, read_manifest
+from esridump.cache import ResponseCache
+from esridump.checkpoint import Checkpoint
+from esridump.compress import CompressedWriter, compression_for
+from esridump.incremental import IncrementalDump, read_features
+from esridump.service import ServiceDumper
+from esridump.shards import ShardedWriter
+from esridump.writers import GeoJSONWriter, GeoPackageWriter, GeoParquetWriter, PostGISCopyWriter, json_dumps
+
+# Output formats written by a writer with one column per field, and the format the dumper produces for them
+_TABLE_FORMATS = {
+    'geoparquet': 'geojson',
+    'geopackage': 'esrijson',
+    'pgcopy': 'esrijson',
+    'pgcopy-binary': 'esrijson',
+}
 
 def _collect_headers(strings):
     headers = {}
@@ -24,14 +41,49 @@ def _collect_params(strings):
 
     return params
 
+def _page_size(string):
+    if string == 'auto':
+        return string
+    try:
+        return int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number of features or 'auto', got {!r}".format(string))
+
+_BYTE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+def _split_unit(string):
+    number = string.upper().rstrip('KMGB')
+    return number, string.upper()[len(number):]
+
+def _byte_size(string):
+    """ Parse a number of bytes, optionally with a B, KB, MB or GB suffix. """
+    number, unit = _split_unit(string)
+    try:
+        return int(float(number) * _BYTE_UNITS[unit or 'B'])
+    except (KeyError, ValueError):
+        raise argparse.ArgumentTypeError("expected a size like 512MB, got {!r}".format(string))
+
+def _shard_size(string):
+    """ Parse a shard size into (size, by_bytes). Plain numbers count features, and a B, KB, MB or GB suffix bytes. """
+    number, unit = _split_unit(string)
+    try:
+        if not unit:
+            return (int(number), False)
+        if unit in _BYTE_UNITS:
+            return (_byte_size(string), True)
+    except (ValueError, argparse.ArgumentTypeError):
+        pass
+    raise argparse.ArgumentTypeError("expected a number of features or a size like 512MB, got {!r}".format(string))
+
 def _parse_args(args):
     parser = argparse.ArgumentParser(
         description="Convert a single Esri feature service URL to GeoJSON")
     parser.add_argument("url",
+        nargs='?',
         help="Esri layer URL")
     parser.add_argument("outfile",
-        type=argparse.FileType('w'),
-        help="Output file name (use - for stdout)")
+        nargs='?',
+        help="Output file name (use - for stdout), or the output directory with --service")
     parser.add_argument("--proxy",
         help="Proxy string to send requests through ie: https://example.com/proxy.ashx?<SERVER>")
     parser.add_argument("--jsonlines",
@@ -72,21 +124,206 @@ def _parse_args(args):
         default=30,
         help="HTTP timeout in seconds, default 30")
     parser.add_argument("-m", "--max-page-size",
-        type=int,
+        type=_page_size,
         default=1000,
-        help="Maximum number of features to pull per batch, default 1000")
+        help="Maximum number of features to pull per batch, default 1000. Use 'auto' to grow and shrink "
+             "pages up to the server's limit depending on how quickly it responds")
     parser.add_argument("--paginate-oid",
         dest='paginate_oid',
         action='store_true',
         default=False,
         help="Turn on paginate by OID regardless of normal pagination support")
+    parser.add_argument("--fetch-by-object-ids",
+        dest='fetch_by_object_ids',
+        action='store_true',
+        default=False,
+        help="When paging through a list of OIDs, fetch each page with the objectIds parameter "
+             "instead of a where clause")
+    parser.add_argument("-c", "--concurrency",
+        type=int,
+        default=1,
+        help="Number of pages to request from the server at the same time, default 1")
+    parser.add_argument("-w", "--workers",
+        type=int,
+        default=1,
+        help="Number of processes that convert and serialize pages, default 1 (no extra processes)")
+    parser.add_argument("--transport",
+        choices=('json', 'pbf'),
+        default='json',
+        help="Ask for pages as JSON or, where the server supports it, compact protocol buffers, default json")
+    parser.add_argument("--dry-run",
+        dest='dry_run',
+        action='store_true',
+        default=False,
+        help="Print how the layer would be paged through and how many requests it would take, "
+             "without downloading any features")
+    parser.add_argument("--stream-pages",
+        action='store_true',
+        default=False,
+        help="Parse each page's features as they arrive instead of loading the whole page into memory. "
+             "With --concurrency above 1 or --max-page-size auto, pages are still read whole")
+    parser.add_argument("--fast-json",
+        action='store_true',
+        default=False,
+        help="Serialize features with orjson if it is installed. Faster, but writes compact JSON")
     parser.add_argument("--output-format",
         dest='output_format',
         action='store',
         default='geojson',
-        help="The JSON output format of the feature data")
+        help="The output format of the feature data: geojson (the default), esrijson, geoparquet, geopackage, "
+             "or pgcopy or pgcopy-binary for PostgreSQL COPY data")
+    parser.add_argument("--copy-table",
+        dest='copy_table',
+        help="With --output-format pgcopy, write a psql script that creates this PostGIS table and copies into it")
+    parser.add_argument("--compress",
+        choices=('gzip', 'zstd'),
+        help="Compress the output on a background thread. The default is to compress when OUTFILE ends "
+             "in .gz or .zst")
+    parser.add_argument("--shard-size",
+        type=_shard_size,
+        help="Split the output into numbered files of this many features, or with a B, KB, MB or GB suffix "
+             "of about this size before compression")
+    parser.add_argument("--shard-manifest",
+        help="With --shard-size, list each shard's path, feature count and object ID range in this "
+             "JSON lines file as the shard is finished, default OUTFILE.shards.jsonl")
+    parser.add_argument("--checkpoint",
+        help="Record the query plan and the pages written so far in this file, "
+             "default OUTFILE.checkpoint when --resume is used")
+    parser.add_argument("--resume",
+        action='store_true',
+        default=False,
+        help="Skip the pages a previous run recorded in its checkpoint and append to its output")
+
+    parser.add_argument("--cache",
+        help="Keep server responses in this SQLite file and reuse them on later runs")
+    parser.add_argument("--cache-ttl",
+        type=int,
+        default=None,
+        help="Ignore cached responses older than this many seconds, default never")
+    parser.add_argument("--cache-max-size",
+        type=_byte_size,
+        default=None,
+        help="Evict the least recently used responses once the cache is bigger than this, "
+             "in bytes or with a KB, MB or GB suffix, default 1GB")
+
+    parser.add_argument("--incremental",
+        metavar='PREVIOUS',
+        help="Update this previous dump of the layer, downloading only added and modified features")
+    parser.add_argument("--changes",
+        help="With --incremental, write the added, modified and deleted object IDs to this JSON file")
+
+    parser.add_argument("--service",
+        action='store_true',
+        default=False,
+        help="URL is a MapServer or FeatureServer. Dump each of its layers to a file in the OUTFILE directory")
+    parser.add_argument("--service-concurrency",
+        type=int,
+        default=4,
+        help="With --service, the number of layers to dump at the same time, default 4")
+    parser.add_argument("--host-concurrency",
+        type=int,
+        default=8,
+        help="With --service, the most requests to have in flight to one host at a time, default 8")
+
+    parser.add_argument("--manifest",
+        help="Instead of one URL, run every dump listed in this file. Each line is a JSON object "
+             "with a url, an outfile and optionally params and headers objects")
+    parser.add_argument("--jobs",
+        type=int,
+        default=8,
+        help="With --manifest, the number of dumps to run at the same time, default 8")
+    parser.add_argument("--jobs-per-host",
+        type=int,
+        default=2,
+        help="With --manifest, the most dumps to run against one host at the same time, default 2")
+    parser.add_argument("--report",
+        help="With --manifest, write a JSON report of each dump's outcome to this file")
+
+    args = parser.parse_args(args)
+
+    if args.output_format in _TABLE_FORMATS and (args.manifest or args.service or args.checkpoint or args.resume or
+                                                 args.incremental or args.workers > 1):
+        parser.error("--output-format {} can't be combined with --manifest, --service, --checkpoint, "
+                     "--resume, --incremental or --workers".format(args.output_format))
+
+    if args.copy_table and args.output_format != 'pgcopy':
+        parser.error("--copy-table only works with --output-format pgcopy")
+
+    if args.manifest:
+        if args.url or args.outfile:
+            parser.error("--manifest takes the URLs and output files from the manifest")
+        if (args.checkpoint or args.resume or args.incremental or args.service or args.dry_run or args.workers > 1 or
+                args.compress or args.shard_size):
+            parser.error("--manifest can't be combined with --checkpoint, --resume, --incremental, "
+                         "--service, --dry-run, --workers, --compress or --shard-size")
+        return args
 
-    return parser.parse_args(args)
+    if not args.url or not args.outfile:
+        parser.error("the url and outfile arguments are required")
+
+    if args.resume and not args.checkpoint:
+        if args.outfile == '-':
+            parser.error("--resume needs --checkpoint when writing to stdout")
+        args.checkpoint = args.outfile + '.checkpoint'
+
+    if args.checkpoint and not args.jsonlines:
+        parser.error("--checkpoint and --resume only work with --jsonlines output")
+
+    if args.max_page_size == 'auto' and args.checkpoint:
+        parser.error("--max-page-size auto can't be combined with --checkpoint or --resume")
+
+    if args.incremental and args.checkpoint:
+        parser.error("--incremental can't be combined with --checkpoint or --resume")
+
+    if args.incremental and os.path.abspath(args.incremental) == os.path.abspath(args.outfile):
+        parser.error("--incremental needs a different output file than the previous dump")
+
+    if args.incremental and args.workers > 1:
+        parser.error("--workers can't be combined with --incremental")
+
+    if args.dry_run and (args.incremental or args.checkpoint):
+        parser.error("--dry-run can't be combined with --incremental, --checkpoint or --resume")
+
+    if args.service and (args.incremental or args.checkpoint or args.workers > 1):
+        parser.error("--service can't be combined with --incremental, --checkpoint, --resume or --workers")
+
+    if args.service and args.outfile == '-':
+        parser.error("--service needs an output directory")
+
+    if args.output_format in ('geoparquet', 'geopackage') and args.outfile == '-':
+        parser.error("--output-format {} needs an output file".format(args.output_format))
+
+    if not args.compress and not args.dry_run and args.outfile != '-':
+        args.compress = compression_for(args.outfile)
+
+    if args.compress and (args.checkpoint or args.service or args.output_format in ('geoparquet', 'geopackage')):
+        parser.error("--compress can't be combined with --checkpoint, --resume, --service "
+                     "or --output-format {}".format(args.output_format))
+
+    if args.shard_size and (args.outfile == '-' or args.checkpoint or args.service or args.workers > 1 or
+                            args.output_format in _TABLE_FORMATS):
+        parser.error("--shard-size needs an output file, and can't be combined with --checkpoint, --resume, "
+                     "--service, --workers or --output-format {}".format(args.output_format))
+
+    if args.shard_size and not args.shard_manifest:
+        args.shard_manifest = args.outfile + '.shards.jsonl'
+
+    if args.dry_run or args.service or args.shard_size or args.output_format in ('geoparquet', 'geopackage'):
+        # Nothing is written yet, so leave any existing output alone. Parquet and GeoPackage files,
+        # and shards, are opened by their writers.
+        return args
+
+    resuming = args.resume and os.path.exists(args.checkpoint)
+    mode = 'a' if resuming else 'w'
+    if args.compress:
+        args.outfile = CompressedWriter(argparse.FileType('wb')(args.outfile), args.compress)
+        return args
+
+    if args.output_format == 'pgcopy-binary':
+        mode += 'b'
+    args.outfile = argparse.FileType(mode)(args.outfile)
+
+    return args
 
 def main():
     args = _parse_args(sys.argv[1:])
@@ -102,7 +339,26 @@ def main():
 
     requested_fields = args.fields.split(',') if args.fields else None
 
-    dumper = EsriDumper(args.url,
+    checkpoint = None
+    if args.checkpoint:
+        def output_state():
+            args.outfile.flush()
+            return {'output_offset': args.outfile.tell()}
+
+        checkpoint = Checkpoint(args.checkpoint, on_save=output_state)
+        if args.resume and checkpoint.load():
+            # Drop anything written after the last completed page
+            args.outfile.truncate(checkpoint.state.get('output_offset', 0))
+            logger.info("Resuming from checkpoint %s", args.checkpoint)
+
+    cache = None
+    if args.cache:
+        cache_kwargs = dict(ttl=args.cache_ttl)
+        if args.cache_max_size is not None:
+            cache_kwargs['max_size'] = args.cache_max_size
+        cache = ResponseCache(args.cache, **cache_kwargs)
+
+    dumper_kwargs = dict(
         extra_query_args=params,
         extra_headers=headers,
         fields=requested_fields,
@@ -112,24 +368,115 @@ def main():
         max_page_size=args.max_page_size,
         parent_logger=logger,
         paginate_oid=args.paginate_oid,
-        output_format=args.output_format)
+        fetch_by_object_ids=args.fetch_by_object_ids,
+        output_format=_TABLE_FORMATS.get(args.output_format, args.output_format),
+        concurrency=args.concurrency,
+        checkpoint=checkpoint,
+        cache=cache,
+        stream_pages=args.stream_pages,
+        transport=args.transport,
+        workers=args.workers)
+
+    if args.manifest:
+        with BatchDumper(read_manifest(args.manifest),
+                workers=args.jobs,
+                host_concurrency=args.jobs_per_host,
+                **dumper_kwargs) as batch:
+            report = batch.run(jsonlines=args.jsonlines, fast_json=args.fast_json)
+
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
+
+        failed = [result['url'] for result in report if result['status'] != 'ok']
+        if failed:
+            sys.exit("Could not dump {} of {} URLs".format(len(failed), len(report)))
+        return
+
+    if args.service:
+        with ServiceDumper(args.url,
+                concurrency=args.service_concurrency,
+                host_concurrency=args.host_concurrency,
+                **dumper_kwargs) as service:
+            if args.dry_run:
+                plans = [plan.as_dict() for plan in service.plans().values()]
+                json.dump(plans, sys.stdout, indent=2)
+                sys.stdout.write('\n')
+                return
 
-    if args.jsonlines:
-        for feature in dumper:
-            args.outfile.write(json.dumps(feature))
-            args.outfile.write('\n')
+            service.dump(args.outfile, jsonlines=args.jsonlines, fast_json=args.fast_json)
+            if service.errors:
+                sys.exit("Could not dump layers {}".format(', '.join(str(i) for i in sorted(service.errors))))
+        return
+
+    dumper = EsriDumper(args.url, **dumper_kwargs)
+
+    if args.dry_run:
+        json.dump(dumper.plan().as_dict(), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    features = dumper
+    if args.incremental:
+        features = IncrementalDump(dumper, lambda: read_features(args.incremental))
+
+    if args.output_format in _TABLE_FORMATS:
+        metadata = dumper.get_metadata()
+        fields = [
+            field for field in metadata.get('fields') or []
+            if not requested_fields or field['name'] in requested_fields
+        ]
+
+    if args.shard_size:
+        shard_size, by_bytes = args.shard_size
+        metadata = dumper.get_metadata()
+        oid_field = metadata.get('objectIdField') or next(
+            (field['name'] for field in metadata.get('fields') or [] if field.get('type') == 'esriFieldTypeOID'), None)
+        writer = ShardedWriter(args.outfile, shard_size,
+            by_bytes=by_bytes,
+            jsonlines=args.jsonlines,
+            dumps=json_dumps(fast=args.fast_json),
+            oid_field=oid_field,
+            compress=args.compress,
+            manifest=args.shard_manifest)
+    elif args.output_format == 'geoparquet':
+        writer = GeoParquetWriter(args.outfile, fields)
+    elif args.output_format == 'geopackage':
+        if os.path.exists(args.outfile):
+            os.remove(args.outfile)
+        writer = GeoPackageWriter(args.outfile, fields,
+            table=metadata.get('name') or os.path.splitext(os.path.basename(args.outfile))[0],
+            geometry_type='POINT' if metadata.get('geometryType') == 'esriGeometryPoint' else 'GEOMETRY',
+            has_z=bool(metadata.get('hasZ')))
+    elif args.output_format in ('pgcopy', 'pgcopy-binary'):
+        writer = PostGISCopyWriter(args.outfile, fields,
+            binary=args.output_format == 'pgcopy-binary',
+            table=args.copy_table,
+            has_z=bool(metadata.get('hasZ')))
+    else:
+        writer = GeoJSONWriter(args.outfile,
+            jsonlines=args.jsonlines,
+            dumps=json_dumps(fast=args.fast_json))
+    if args.workers > 1:
+        for text in dumper.iter_serialized_pages(jsonlines=args.jsonlines, fast_json=args.fast_json):
+            writer.write_serialized(text)
     else:
-        args.outfile.write('{"type":"FeatureCollection","features":[\n')
-        feature_iter = iter(dumper)
-        try:
-            feature = next(feature_iter)
-            while True:
-                args.outfile.write(json.dumps(feature))
-                feature = next(feature_iter)
-                args.outfile.write(',\n')
-        except StopIteration:
-            args.outfile.write('\n')
-        args.outfile.write(']}')
+        for page in features.iter_pages():
+            writer.write_page(page)
+    writer.close()
+    if args.compress and not args.shard_size:
+        args.outfile.close()
+
+    if checkpoint:
+        checkpoint.remove()
+
+    if args.incremental and args.changes:
+        with open(args.changes, 'w') as f:
+            json.dump({
+                'added': features.added,
+                'modified': features.modified,
+                'deleted': features.deleted,
+            }, f)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,108 @@
+import gzip
+import os
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression methods by the file extensions that imply them
+_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+    '.zstd': 'zstd',
+}
+
+_DONE = object()
+
+
+def compression_for(path):
+    """ Return the compression method a file name's extension asks for, or None. """
+    return _EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def _compressor(fileobj, method, level, threads):
+    """ Wrap a binary file in a writable stream that compresses into it. """
+    if method == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6 if level is None else level)
+    elif method == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd compression requires zstandard, install it with `pip install esridump[zstd]`")
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level, threads=threads)
+        return compressor.stream_writer(fileobj, closefd=False)
+    raise ValueError('Unknown compression method {}, expecting "gzip" or "zstd"'.format(method))
+
+
+class CompressedWriter(object):
+    """ A file-like object that compresses what is written to it on a background thread.
+
+    ``write()`` only hands the data to the thread, so compressing and writing
+    to ``fileobj`` overlap with fetching the next pages. At most
+    ``queue_size`` writes wait at a time, after which ``write()`` blocks.
+    Text is encoded as UTF-8. zstd compresses on ``threads`` more threads,
+    by default one per CPU. An error on the background thread is raised by
+    the next ``write()`` or by ``close()``, which also closes ``fileobj``.
+    """
+
+    def __init__(self, fileobj, method, level=None, threads=-1, queue_size=16):
+        self._fileobj = fileobj
+        self._stream = _compressor(fileobj, method, level, threads)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._closed = False
+
+        # A daemon, so a dump that fails part way doesn't hang waiting on it at exit
+        self._thread = threading.Thread(target=self._run, name='esridump-compress', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is _DONE:
+                break
+            if self._error is not None:
+                # Keep draining the queue so write() never blocks after an error
+                continue
+            try:
+                self._stream.write(data)
+            except Exception as e:
+                self._error = e
+
+        if self._error is None:
+            try:
+                self._stream.close()
+            except Exception as e:
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, data):
+        self._raise_error()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if data:
+            self._queue.put(data)
+        return len(data)
+
+    def flush(self):
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        self._queue.put(_DONE)
+        self._thread.join()
+        self._fileobj.close()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,12 +1,199 @@
+import collections
+import datetime
+import itertools
 import logging
+import multiprocessing
 import requests
 import json
 import socket
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from six.moves.urllib.parse import urlencode
 
-from esridump import esri2geojson
+from esridump import esri2geojson, esri2geojson_batch
+from esridump.cache import CachedResponse
 from esridump.errors import EsriDownloadError
+from esridump.jsonstream import FeatureStreamParser
+from esridump.pagesize import AdaptivePageSize
+from esridump.pbf import decode_query_result, looks_like_json
+from esridump.ratelimit import AdaptiveRateLimiter, FixedPauseRateLimiter, retry_after_seconds
+from esridump.writers import json_dumps, serialize_features
+
+
+# A request the planning steps need answered before they can continue. The
+# dumper performs it and sends back the parsed JSON, or the raw response when
+# error_message is None. Requests with a stat name are counted in EsriDumper.stats.
+_Request = collections.namedtuple('_Request', 'method url kwargs error_message stat', defaults=(None,))
+
+# The outcome of planning: which strategy to use and the page queries for it.
+# Layers that can only be scraped by envelope have no page_args, and neither
+# do plans whose page_range is cut into pages as they are fetched. row_count
+# is the number of rows the server reported, if it did.
+_Plan = collections.namedtuple(
+    '_Plan', 'strategy page_args metadata page_size oid_field_name page_range row_count', defaults=(None, None))
+
+# The units (row offsets, OIDs or positions in a list of OIDs) from start up
+# to stop that a plan pages through. build(first, stop) makes the query for
+# one page of them.
+_PageRange = collections.namedtuple('_PageRange', 'start stop build')
+
+# The OIDs that changed since a previous dump, and the page queries that fetch the new versions.
+_Changes = collections.namedtuple('_Changes', 'added modified deleted page_args')
+
+_END_OF_PAGE = object()
+
+# Paging by OID switches to counting rows first once the OIDs between the min
+# and max outnumber the layer's rows by this much.
+_SPARSE_OID_RATIO = 4
+
+
+class _RangePages(object):
+    """ The page queries for a _PageRange, built as they are iterated over.
+
+    Pages are cut every page_size units, or at the (first, stop) pairs in
+    bounds when they're given.
+    """
+
+    def __init__(self, page_range, page_size, bounds=None):
+        self.page_range = page_range
+        self.page_size = page_size
+        self.bounds = bounds
+
+    def _iter_bounds(self):
+        if self.bounds is not None:
+            return iter(self.bounds)
+
+        start, stop = self.page_range.start, self.page_range.stop
+        return ((first, min(first + self.page_size, stop)) for first in range(start, stop, self.page_size))
+
+    def __len__(self):
+        if self.bounds is not None:
+            return len(self.bounds)
+        return max(0, -(-(self.page_range.stop - self.page_range.start) // self.page_size))
+
+    def __iter__(self):
+        build = self.page_range.build
+        for first, stop in self._iter_bounds():
+            yield build(first, stop)
+
+    def with_range(self, page_range):
+        return _RangePages(page_range, self.page_size, self.bounds)
+
+
+class QueryPlan(object):
+    """ How EsriDumper will page through a layer, as returned by EsriDumper.plan().
+
+    ``strategy`` is 'offset', 'oid-statistics', 'oid-enumeration', 'envelope'
+    or 'empty'. ``row_count`` and ``request_count`` are estimates made before
+    any features are fetched, and are None when they can't be known: some
+    servers don't count rows, and envelope crawls split boxes as they go.
+    With adaptive page sizes, ``request_count`` is the fewest page requests
+    the layer could take.
+    """
+
+    def __init__(self, url, plan):
+        self.url = url
+        self.strategy = plan.strategy
+        self.row_count = plan.row_count
+        self.page_size = plan.page_size
+        self._page_args = plan.page_args
+
+        if plan.page_args is not None:
+            self.request_count = len(plan.page_args)
+        elif plan.page_range is not None:
+            units = plan.page_range.stop - plan.page_range.start
+            self.request_count = -(-units // plan.page_size)
+        else:
+            self.request_count = None
+
+    def pages(self):
+        """ Yield the query arguments of each page, built as they're asked for.
+
+        Envelope crawls and adaptive page sizes cut pages while fetching, so
+        they yield nothing.
+        """
+        return iter(self._page_args or ())
+
+    def as_dict(self):
+        return dict(
+            url=self.url,
+            strategy=self.strategy,
+            row_count=self.row_count,
+            page_size=self.page_size,
+            request_count=self.request_count,
+        )
+
+
+class _ObjectIdsCheck(object):
+    """ Checks the features of a page fetched by objectIds against the OIDs asked for.
+
+    Features that weren't asked for mean the server ignored objectIds, so
+    they raise an EsriDownloadError. Missing features were most likely
+    deleted since the OIDs were listed, so they are only logged.
+    """
+
+    def __init__(self, query_args, oid_field_name):
+        self._expected = set(int(oid) for oid in query_args['objectIds'].split(','))
+        self._oid_field_name = oid_field_name
+        self._returned = set()
+        # Set when a feature has no OID to check, such as when the OID field wasn't asked for
+        self._unchecked = False
+
+    def feature(self, feature):
+        oid = (feature.get('attributes') or {}).get(self._oid_field_name)
+        if oid is None:
+            self._unchecked = True
+            return
+
+        if int(oid) not in self._expected:
+            raise EsriDownloadError(
+                "Server returned OID {} which wasn't asked for, so it may not support objectIds".format(oid))
+        self._returned.add(int(oid))
+
+    def done(self, logger):
+        missing = len(self._expected) - len(self._returned)
+        if missing and not self._unchecked:
+            logger.warning("%s of %s features asked for by objectIds weren't returned, so they may have been deleted",
+                           missing, len(self._expected))
+
+
+def _build_session(pool_size):
+    """ Make a requests session that keeps up to pool_size connections open to each host. """
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# The EsriDumper arguments that choose how it is rate limited
+_RATE_LIMIT_ARGS = ('rate_limiter', 'pause_seconds', 'requests_to_pause')
+
+
+def _build_rate_limiter(logger, rate_limiter=None, pause_seconds=None, requests_to_pause=None):
+    """ Return the rate limiter given, fixed pauses if either pause argument is given, or else an adaptive one. """
+    if rate_limiter:
+        return rate_limiter
+    elif pause_seconds is not None or requests_to_pause is not None:
+        # Callers that ask for fixed pauses get the original pause schedule
+        return FixedPauseRateLimiter(
+            10 if pause_seconds is None else pause_seconds,
+            requests_to_pause or 5,
+            logger=logger)
+    return AdaptiveRateLimiter(logger=logger)
+
+
+def _sets_rate_limit(dumper_kwargs):
+    """ Whether EsriDumper keyword arguments choose a rate limiter, so a shared one shouldn't be passed in. """
+    return any(dumper_kwargs.get(name) is not None for name in _RATE_LIMIT_ARGS)
+
+
+def _convert_and_serialize(features, output_format, jsonlines, fast_json):
+    """ Convert and serialize one page of Esri JSON features. Runs in the worker processes. """
+    if output_format == 'geojson':
+        features = esri2geojson_batch(features)
+    return serialize_features(features, jsonlines, json_dumps(fast_json))
 
 
 class EsriDumper(object):
@@ -16,8 +203,14 @@ class EsriDumper(object):
                  outSR=None, proxy=None,
                  start_with=None, geometry_precision=None,
                  paginate_oid=False, max_page_size=None,
-                 pause_seconds=10, requests_to_pause=5,
-                 num_of_retry=5, output_format='geojson'):
+                 pause_seconds=None, requests_to_pause=None,
+                 num_of_retry=5, output_format='geojson',
+                 concurrency=1, ordered=True,
+                 session=None, pool_size=None, keep_alive=True,
+                 rate_limiter=None, checkpoint=None, cache=None,
+                 stream_pages=False, stream_chunk_size=64 * 1024,
+                 transport='json', workers=None, max_envelope_depth=20,
+                 envelope_count_first=True, fetch_by_object_ids=False, metadata=None):
         self._layer_url = url
         self._query_params = extra_query_args or {}
         self._headers = extra_headers or {}
@@ -29,38 +222,95 @@ class EsriDumper(object):
         self._startWith = start_with or 0
         self._precision = geometry_precision or 7
         self._paginate_oid = paginate_oid
-        self._max_page_size = max_page_size or 1000
+        self._adaptive_page_size = max_page_size == 'auto'
+        self._max_page_size = 1000 if self._adaptive_page_size else (max_page_size or 1000)
 
-        self._pause_seconds = pause_seconds
-        self._requests_to_pause = requests_to_pause
         self._num_of_retry = num_of_retry
+        self._concurrency = max(1, concurrency or 1)
+        self._ordered = ordered
+        self._pool_size = pool_size or max(10, self._concurrency)
+        self._keep_alive = keep_alive
+        self._session = session
+        self._owns_session = session is None
+        self._checkpoint = checkpoint
+        self._cache = cache
+        self._stream_pages = stream_pages
+        self._stream_chunk_size = stream_chunk_size
+        self._workers = workers or 1
+        self._max_envelope_depth = max_envelope_depth
+        self._envelope_count_first = envelope_count_first
+        self._fetch_by_object_ids = fetch_by_object_ids
+        # Layer metadata fetched ahead of time, such as from a service's /layers resource
+        self._metadata = metadata
+        # Found while planning, to check the features of pages fetched by objectIds
+        self._oid_field_name = None
+        # Made by plan() for the next iteration to follow
+        self._planned = None
+
+        # Counters describing the work done so far, such as requests and bytes per kind of query
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
 
         if output_format not in ('geojson', 'esrijson'):
             raise ValueError(f'Invalid output format. Expecting "geojson" or "esrijson", got {output_format}')
 
         self._output_format = output_format
 
+        if self._adaptive_page_size and checkpoint:
+            raise ValueError("Adaptive page sizes can't be combined with a checkpoint")
+
+        if transport not in ('json', 'pbf'):
+            raise ValueError(f'Invalid transport. Expecting "json" or "pbf", got {transport}')
+
+        self._transport = transport
+        # Set once a pbf page couldn't be decoded, so the rest are fetched as JSON
+        self._pbf_failed = False
+
         if parent_logger:
             self._logger = parent_logger.getChild('esridump')
         else:
             self._logger = logging.getLogger('esridump')
 
-    def _request(self, method, url, **kwargs):
-        try:
+        self._rate_limiter = _build_rate_limiter(self._logger, rate_limiter, pause_seconds, requests_to_pause)
+
+    def _apply_proxy(self, url, kwargs):
+        if self._proxy:
+            url = self._proxy + url
+
+            params = kwargs.pop('params', None)
+            if params:
+                url += '?' + urlencode(params)
+
+        return url
 
-            if self._proxy:
-                url = self._proxy + url
+    def _get_session(self):
+        if self._session is None:
+            self._session = _build_session(self._pool_size)
+        return self._session
 
-                params = kwargs.pop('params', None)
-                if params:
-                    url += '?' + urlencode(params)
+    def close(self):
+        """ Close the HTTP session if this dumper created it. """
+        if self._owns_session and self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, method, url, **kwargs):
+        session = self._get_session()
+        try:
+            url = self._apply_proxy(url, kwargs)
 
             self._logger.debug("%s %s, args %s", method, url,
                                kwargs.get('params') or kwargs.get('data'))
-            return requests.request(method, url, timeout=self._http_timeout, **kwargs)
+            return session.request(method, url, timeout=self._http_timeout, **kwargs)
         except requests.exceptions.SSLError:
             self._logger.warning("Retrying %s without SSL verification", url)
-            return requests.request(method, url, timeout=self._http_timeout, verify=False, **kwargs)
+            return session.request(method, url, timeout=self._http_timeout, verify=False, **kwargs)
 
     def _build_url(self, url=None):
         return self._layer_url + url if url else self._layer_url
@@ -88,7 +338,8 @@ class EsriDumper(object):
         return complete_args
 
     def _build_headers(self, headers=None):
-        complete_headers = dict(**self._headers)
+        complete_headers = {} if self._keep_alive else {'Connection': 'close'}
+        complete_headers.update(self._headers)
         if headers:
             complete_headers.update(headers)
         return complete_headers
@@ -111,7 +362,11 @@ class EsriDumper(object):
             ))
             raise
 
-        error = data.get('error')
+        self._raise_for_esri_error(data.get('error'), error_message)
+
+        return data
+
+    def _raise_for_esri_error(self, error, error_message):
         if error:
             raise EsriDownloadError("{}: {} {}" .format(
                 error_message,
@@ -119,9 +374,101 @@ class EsriDumper(object):
                 ', '.join(error['details']),
             ))
 
+    def _stream_features(self, response, error_message, started):
+        """ Start streaming the features out of a query response opened with stream=True.
+
+        The response is read up to its first feature before this returns, so
+        error payloads and unparseable bodies are raised while the request can
+        still be retried. The rest is parsed as the returned iterator is consumed,
+        and the rate limiter hears how long the page took, since ``started``,
+        once it has all been read.
+        """
+        if response.status_code != 200:
+            self._handle_esri_errors(response, error_message)
+
+        features = self._iter_streamed_features(response, error_message, started)
+        first = next(features, _END_OF_PAGE)
+        if first is _END_OF_PAGE:
+            return []
+        return itertools.chain([first], features)
+
+    def _iter_streamed_features(self, response, error_message, started):
+        def check_member(key, value):
+            if key == 'error':
+                self._raise_for_esri_error(value, error_message)
+
+        parser = FeatureStreamParser(on_member=check_member)
+        try:
+            for chunk in response.iter_content(chunk_size=self._stream_chunk_size):
+                for feature in parser.feed(chunk):
+                    yield feature
+            for feature in parser.close():
+                yield feature
+            self._rate_limiter.record_success(time.monotonic() - started)
+        except ValueError as e:
+            raise EsriDownloadError("Could not parse JSON", e)
+        except requests.exceptions.RequestException as e:
+            raise EsriDownloadError("Connection lost while streaming {}".format(response.request.url), e)
+        finally:
+            response.close()
+
+    def _cache_lookup(self, method, url, kwargs, error_message, parse=None):
+        """ Look a request up in the response cache, returning (cache key, parsed data or None). """
+        if not self._cache:
+            return None, None
+
+        key = self._cache.key(method, url, kwargs.get('params'), kwargs.get('data'))
+        content = self._cache.get(key)
+        if content is None:
+            return key, None
+
+        self._logger.debug("Using cached response for %s %s", method, url)
+        response = CachedResponse(url, content)
+        if parse:
+            return key, parse(response)
+        return key, self._handle_esri_errors(response, error_message)
+
+    def _cache_store(self, key, response):
+        if key:
+            self._cache.put(key, response.content)
+
+    def _count_stats(self, **amounts):
+        with self._stats_lock:
+            self.stats.update(amounts)
+
+    def _record_response(self, stat, response):
+        if stat:
+            self._count_stats(**{stat + '_requests': 1, stat + '_bytes': len(response.content)})
+
+    def _perform(self, request):
+        if request.error_message is None:
+            return self._request(request.method, request.url, **request.kwargs)
+
+        key, data = self._cache_lookup(request.method, request.url, request.kwargs, request.error_message)
+        if data is not None:
+            return data
+
+        response = self._request(request.method, request.url, **request.kwargs)
+        self._record_response(request.stat, response)
+        data = self._handle_esri_errors(response, request.error_message)
+        self._cache_store(key, response)
         return data
 
-    def can_handle_pagination(self, query_fields):
+    def _drive(self, steps):
+        """ Run a planning step generator to completion, performing each request it yields. """
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    result = self._perform(request)
+                except Exception as e:
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+    def _can_handle_pagination(self, query_fields):
         check_args = self._build_query_args({
             'resultOffset': 0,
             'resultRecordCount': 1,
@@ -132,8 +479,8 @@ class EsriDumper(object):
         })
         headers = self._build_headers()
         query_url = self._build_url('/query')
-        response = self._request(
-            'POST', query_url, headers=headers, data=check_args)
+        response = yield _Request(
+            'POST', query_url, dict(headers=headers, data=check_args), None)
 
         try:
             data = response.json()
@@ -146,19 +493,30 @@ class EsriDumper(object):
 
         return data.get('error') and data['error']['message'] != "Failed to execute query."
 
-    def get_metadata(self):
+    def can_handle_pagination(self, query_fields):
+        return self._drive(self._can_handle_pagination(query_fields))
+
+    def _get_metadata(self):
+        if self._metadata is not None:
+            return self._metadata
+
         query_args = self._build_query_args({
             'f': 'json',
         })
         headers = self._build_headers()
         url = self._build_url()
-        response = self._request(
-            'GET', url, params=query_args, headers=headers)
-        metadata_json = self._handle_esri_errors(
-            response, "Could not retrieve layer metadata")
+        metadata_json = yield _Request(
+            'GET', url, dict(params=query_args, headers=headers),
+            "Could not retrieve layer metadata")
         return metadata_json
 
-    def get_feature_count(self):
+    def get_metadata(self):
+        """ Fetch the layer's metadata. It's kept and reused when the dumper plans its pages. """
+        if self._metadata is None:
+            self._metadata = self._drive(self._get_metadata())
+        return self._metadata
+
+    def _get_feature_count(self):
         query_args = self._build_query_args({
             'where': '1=1',
             'returnCountOnly': 'true',
@@ -166,15 +524,17 @@ class EsriDumper(object):
         })
         headers = self._build_headers()
         url = self._build_url('/query')
-        response = self._request(
-            'GET', url, params=query_args, headers=headers)
-        count_json = self._handle_esri_errors(
-            response, "Could not retrieve row count")
+        count_json = yield _Request(
+            'GET', url, dict(params=query_args, headers=headers),
+            "Could not retrieve row count")
         count = count_json.get('count')
         if count is None:
             raise EsriDownloadError("Server doesn't support returnCountOnly")
         return count_json['count']
 
+    def get_feature_count(self):
+        return self._drive(self._get_feature_count())
+
     def _find_oid_field_name(self, metadata):
         oid_field_name = metadata.get('objectIdField')
         if not oid_field_name:
@@ -202,10 +562,9 @@ class EsriDumper(object):
         })
         headers = self._build_headers()
         url = self._build_url('/query')
-        response = self._request(
-            'GET', url, params=query_args, headers=headers)
-        metadata = self._handle_esri_errors(
-            response, "Could not retrieve min/max oid values")
+        metadata = yield _Request(
+            'GET', url, dict(params=query_args, headers=headers),
+            "Could not retrieve min/max oid values")
 
         # Some servers (specifically version 10.11, it seems) will respond with SQL statements
         # for the attribute names rather than the requested field names, so pick the min and max
@@ -213,16 +572,6 @@ class EsriDumper(object):
         min_max_values = metadata['features'][0]['attributes'].values()
         min_value = min(min_max_values)
         max_value = max(min_max_values)
-        query_args = self._build_query_args({
-            'f': 'json',
-            'outFields': '*',
-            'outStatistics': json.dumps([
-                dict(statisticType='min', onStatisticField=oid_field_name,
-                     outStatisticFieldName='THE_MIN'),
-                dict(statisticType='max', onStatisticField=oid_field_name,
-                     outStatisticFieldName='THE_MAX'),
-            ], separators=(',', ':'))
-        })
         query_args = self._build_query_args({
             'where': '{} = {} OR {} = {}'.format(
                 oid_field_name,
@@ -235,10 +584,9 @@ class EsriDumper(object):
         })
         headers = self._build_headers()
         url = self._build_url('/query')
-        response = self._request(
-            'GET', url, params=query_args, headers=headers)
-        oid_data = self._handle_esri_errors(
-            response, "Could not check min/max values")
+        oid_data = yield _Request(
+            'GET', url, dict(params=query_args, headers=headers),
+            "Could not check min/max values")
         if not oid_data or not oid_data.get('objectIds') or min_value not in oid_data['objectIds'] or max_value not in oid_data['objectIds']:
             raise EsriDownloadError('Server returned invalid min/max')
 
@@ -252,15 +600,76 @@ class EsriDumper(object):
         })
         url = self._build_url('/query')
         headers = self._build_headers()
-        response = self._request(
-            'GET', url, params=query_args, headers=headers)
-        oid_data = self._handle_esri_errors(
-            response, "Could not retrieve object IDs")
+        oid_data = yield _Request(
+            'GET', url, dict(params=query_args, headers=headers),
+            "Could not retrieve object IDs")
         oids = oid_data.get('objectIds')
         if not oids:
             raise EsriDownloadError("Server doesn't support returnIdsOnly")
         return oids
 
+    def _get_edited_oids(self, edit_field_name, since):
+        """ Find the OIDs of features edited at or after since, in milliseconds since the epoch. """
+        edited_at = datetime.datetime.fromtimestamp(since / 1000.0, datetime.timezone.utc)
+        query_args = self._build_query_args({
+            'where': "{} >= TIMESTAMP '{}'".format(
+                edit_field_name,
+                edited_at.strftime('%Y-%m-%d %H:%M:%S'),
+            ),
+            'returnIdsOnly': 'true',
+            'f': 'json',
+        })
+        url = self._build_url('/query')
+        headers = self._build_headers()
+        oid_data = yield _Request(
+            'GET', url, dict(params=query_args, headers=headers),
+            "Could not retrieve edited object IDs")
+        return oid_data.get('objectIds') or []
+
+    def _oid_list_query_args(self, oid_field_name, oids, query_fields):
+        """ Build the query for a page of exactly the given OIDs. """
+        oid_list = ','.join(str(oid) for oid in oids)
+        if self._fetch_by_object_ids:
+            # Looked up by primary key, and POSTed so long lists fit
+            return self._page_query_args('1=1', query_fields, {'objectIds': oid_list})
+        return self._page_query_args('{} IN ({})'.format(oid_field_name, oid_list), query_fields)
+
+    def _oid_list_page_args(self, oid_field_name, oids, page_size):
+        """ Build page queries that fetch exactly the given OIDs. """
+        return [
+            self._oid_list_query_args(oid_field_name, oids[i:i+page_size], self._fields)
+            for i in range(0, len(oids), page_size)
+        ]
+
+    def _plan_changes(self, metadata, previous_oids, last_edit):
+        """ Compare the OIDs of a previous dump with the server's, returning a _Changes.
+
+        Modified features can only be found when the layer tracks edit dates
+        and last_edit, the newest edit date in the previous dump, is known.
+        """
+        oid_field_name = self._find_oid_field_name(metadata)
+        self._oid_field_name = oid_field_name
+        page_size = max(self._max_page_size,
+                        metadata.get('maxRecordCount', 500))
+
+        server_oids = set(map(int, (yield from self._get_layer_oids())))
+        deleted = previous_oids - server_oids
+        added = server_oids - previous_oids
+        modified = set()
+
+        edit_field_name = (metadata.get('editFieldsInfo') or {}).get('editDateField')
+        if edit_field_name and last_edit is not None:
+            edited = yield from self._get_edited_oids(edit_field_name, last_edit)
+            modified = set(map(int, edited)) & previous_oids
+        else:
+            self._logger.info(
+                "Layer doesn't track edit dates, so only added and deleted features will be found")
+
+        self._logger.info("Found %s added, %s modified and %s deleted features",
+                          len(added), len(modified), len(deleted))
+        page_args = self._oid_list_page_args(oid_field_name, sorted(added | modified), page_size)
+        return _Changes(sorted(added), sorted(modified), sorted(deleted), page_args)
+
     def _fetch_bounded_features(self, envelope, outSR):
         query_args = self._build_query_args({
             'geometry': json.dumps(envelope),
@@ -275,78 +684,285 @@ class EsriDumper(object):
         })
         headers = self._build_headers()
         url = self._build_url('/query')
-        response = self._request(
-            'GET', url, params=query_args, headers=headers)
-        features = self._handle_esri_errors(
-            response, "Could not retrieve a section of features")
+        features = yield _Request(
+            'GET', url, dict(params=query_args, headers=headers),
+            "Could not retrieve a section of features", 'envelope_feature_query')
         return features['features']
 
+    def _count_bounded_features(self, envelope):
+        query_args = self._build_query_args({
+            'where': '1=1',
+            'geometry': json.dumps(envelope),
+            'geometryType': 'esriGeometryEnvelope',
+            'spatialRel': 'esriSpatialRelIntersects',
+            'returnCountOnly': 'true',
+            'f': 'json'
+        })
+        headers = self._build_headers()
+        url = self._build_url('/query')
+        count_json = yield _Request(
+            'GET', url, dict(params=query_args, headers=headers),
+            "Could not count a section of features", 'envelope_count_query')
+        count = count_json.get('count')
+        if count is None:
+            raise EsriDownloadError("Server doesn't support returnCountOnly with a geometry")
+        return count
+
     def _split_envelope(self, envelope):
-        half_width = (envelope['xmax'] - envelope['xmin']) / 2.0
-        half_height = (envelope['ymax'] - envelope['ymin']) / 2.0
-        return [
-            dict(
-                xmin=envelope['xmin'],
-                ymin=envelope['ymin'],
-                xmax=envelope['xmin'] + half_width,
-                ymax=envelope['ymin'] + half_height,
-            ),
-            dict(
-                xmax=envelope['xmin'] + half_width,
-                ymin=envelope['ymin'],
-                xmin=envelope['xmax'],
-                ymax=envelope['ymin'] + half_height,
-            ),
-            dict(
-                xmin=envelope['xmin'],
-                ymax=envelope['ymin'] + half_height,
-                xmax=envelope['xmin'] + half_width,
-                ymin=envelope['ymax'],
-            ),
-            dict(
-                xmax=envelope['xmin'] + half_width,
-                ymax=envelope['ymin'] + half_height,
-                xmin=envelope['xmax'],
-                ymin=envelope['ymax'],
-            ),
+        """ Split an envelope into its four quadrants, which only share their edges. """
+        x_mid = envelope['xmin'] + (envelope['xmax'] - envelope['xmin']) / 2.0
+        y_mid = envelope['ymin'] + (envelope['ymax'] - envelope['ymin']) / 2.0
+
+        quadrants = [
+            dict(xmin=envelope['xmin'], ymin=envelope['ymin'], xmax=x_mid, ymax=y_mid),
+            dict(xmin=x_mid, ymin=envelope['ymin'], xmax=envelope['xmax'], ymax=y_mid),
+            dict(xmin=envelope['xmin'], ymin=y_mid, xmax=x_mid, ymax=envelope['ymax']),
+            dict(xmin=x_mid, ymin=y_mid, xmax=envelope['xmax'], ymax=envelope['ymax']),
         ]
+        if 'spatialReference' in envelope:
+            for quadrant in quadrants:
+                quadrant['spatialReference'] = envelope['spatialReference']
+        return quadrants
+
+    def _envelope_is_full(self, count, depth, max_records):
+        """ Whether a box holding count features is full and should be split into its quadrants. """
+        if count < max_records:
+            return False
 
-    def _scrape_an_envelope(self, envelope, outSR, max_records):
-        features = self._fetch_bounded_features(envelope, outSR)
+        if depth >= self._max_envelope_depth:
+            self._logger.warning(
+                "Box is still full after %s splits, so some of its features may be missing", depth)
+            return False
 
-        if len(features) >= max_records:
-            self._logger.info(
-                "Retrieved exactly the maximum record count. Splitting this box and retrieving the children.")
+        self._logger.info(
+            "Box holds at least the maximum record count. Splitting this box and retrieving the children.")
+        return True
+
+    def _plan_envelope(self, count, depth, max_records):
+        """ Decide what to do with a box from its feature count, returning whether to split it.
+
+        Returns None when the count couldn't be found, and turns counting off
+        for the rest of the crawl.
+        """
+        if isinstance(count, EsriDownloadError):
+            self._logger.info("Could not count the features in a box, so fetching every box in full: %s", count)
+            self._envelope_count_first = False
+            return None
+
+        if self._envelope_is_full(count, depth, max_records):
+            # A full page of features we didn't have to download and throw away
+            self._count_stats(envelope_boxes_split_by_count=1)
+            return True
+        return False
+
+    def _envelope_bytes_saved(self, max_records):
+        """ Estimate the bytes that counting first saved, from the average size of the features fetched. """
+        stats = self.stats
+        if not stats['envelope_features_fetched']:
+            return 0
+
+        feature_bytes = stats['envelope_feature_query_bytes'] / stats['envelope_features_fetched']
+        saved = stats['envelope_boxes_split_by_count'] * max_records * feature_bytes - stats['envelope_count_query_bytes']
+        return int(saved)
+
+    def _fetch_envelope(self, envelope, depth, outSR, max_records):
+        """ Query one box, returning (envelope, depth, features), with features None if the box should be split. """
+        if self._envelope_count_first:
+            time.sleep(self._rate_limiter.acquire())
+            try:
+                count = self._drive(self._count_bounded_features(envelope))
+            except EsriDownloadError as e:
+                count = e
+            split = self._plan_envelope(count, depth, max_records)
+            if split:
+                return envelope, depth, None
+            if count == 0:
+                return envelope, depth, []
+        else:
+            split = None
 
-            envelopes = self._split_envelope(envelope)
+        time.sleep(self._rate_limiter.acquire())
+        features = self._drive(self._fetch_bounded_features(envelope, outSR))
+        self._count_stats(envelope_features_fetched=len(features))
+        if split is None and self._envelope_is_full(len(features), depth, max_records):
+            return envelope, depth, None
+        return envelope, depth, features
 
-            for child_envelope in envelopes:
-                for feature in self._scrape_an_envelope(child_envelope, outSR, max_records):
-                    yield feature
-        else:
-            for feature in features:
-                yield feature
+    def _scrape_an_envelope(self, envelope, outSR, max_records):
+        """ Yield the features in envelope, splitting full boxes into quadrants until none are full.
+
+        Each box's features are counted first, so features are only
+        downloaded for boxes that fit in a page. Up to ``concurrency`` boxes
+        are queried at once. Boxes are taken from a stack, so with a
+        concurrency of 1 the tree is walked depth first. Features on the edge
+        of two boxes are yielded twice.
+        """
+        stack = [(envelope, 0)]
+        executor = ThreadPoolExecutor(max_workers=self._concurrency)
+        in_flight = set()
+        try:
+            while stack or in_flight:
+                while stack and len(in_flight) < self._concurrency:
+                    box, depth = stack.pop()
+                    in_flight.add(executor.submit(self._fetch_envelope, box, depth, outSR, max_records))
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    box, depth, features = future.result()
+                    if features is None:
+                        stack.extend((child, depth + 1) for child in reversed(self._split_envelope(box)))
+                    else:
+                        for feature in features:
+                            yield feature
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        self._log_envelope_stats(max_records)
+
+    def _log_envelope_stats(self, max_records):
+        self.stats['envelope_bytes_saved'] = self._envelope_bytes_saved(max_records)
+        self._logger.info(
+            "Envelope crawl made %s count and %s feature queries, saving about %s bytes by counting first",
+            self.stats['envelope_count_query_requests'],
+            self.stats['envelope_feature_query_requests'],
+            self.stats['envelope_bytes_saved'])
+
+    def _page_query_args(self, where, query_fields, extra_args=None):
+        query_args = {
+            'where': where,
+            'geometryPrecision': self._precision,
+            'returnGeometry': self._request_geometry,
+            'outSR': self._outSR,
+            'outFields': ','.join(query_fields or ['*']),
+            'f': 'json',
+        }
+        if extra_args:
+            query_args.update(extra_args)
+        return self._build_query_args(query_args)
+
+    def _offset_page_range(self, row_count, query_fields):
+        def build(first, stop):
+            return self._page_query_args('1=1', query_fields, {
+                'resultOffset': first,
+                'resultRecordCount': stop - first,
+            })
+        return _PageRange(self._startWith, row_count, build)
+
+    def _oid_statistics_page_range(self, oid_min, oid_max, oid_field_name, query_fields):
+        def build(first, stop):
+            return self._page_query_args('{} > {} AND {} <= {}'.format(
+                oid_field_name,
+                first - 1,
+                oid_field_name,
+                stop - 1,
+            ), query_fields)
+        return _PageRange(oid_min, oid_max + 1, build)
 
-    def __iter__(self):
+    def _oids_are_sparse(self, oid_min, oid_max, row_count, page_size):
+        """ Whether most OIDs from oid_min to oid_max are unused, so most pages of OIDs would be empty. """
+        if row_count is None or self._adaptive_page_size:
+            return False
+
+        span = oid_max - oid_min + 1
+        return span > page_size and span > _SPARSE_OID_RATIO * row_count
+
+    def _count_oid_range(self, oid_field_name, first, stop):
+        query_args = self._build_query_args({
+            'where': '{} > {} AND {} <= {}'.format(
+                oid_field_name,
+                first - 1,
+                oid_field_name,
+                stop - 1,
+            ),
+            'returnCountOnly': 'true',
+            'f': 'json',
+        })
+        headers = self._build_headers()
+        url = self._build_url('/query')
+        count_json = yield _Request(
+            'GET', url, dict(params=query_args, headers=headers),
+            "Could not count the features in a range of OIDs", 'oid_count_query')
+        count = count_json.get('count')
+        if count is None:
+            raise EsriDownloadError("Server doesn't support returnCountOnly with a where clause")
+        return count
+
+    def _dense_oid_ranges(self, oid_field_name, oid_min, oid_max, row_count, page_size):
+        """ Cut the OIDs from oid_min to oid_max into (first, stop) ranges of close to page_size rows each.
+
+        Ranges of more than page_size rows are halved, counting the rows in
+        the first half, then neighbouring ranges are merged while they fit in
+        a page.
+        """
+        # (first, stop, rows) for ranges still to be split, the next one last
+        to_split = [(oid_min, oid_max + 1, row_count)]
+        ranges = []
+        while to_split:
+            first, stop, rows = to_split.pop()
+            if rows <= page_size or stop - first == 1:
+                ranges.append((first, stop, rows))
+                continue
+
+            middle = first + (stop - first) // 2
+            first_rows = yield from self._count_oid_range(oid_field_name, first, middle)
+            first_rows = min(first_rows, rows)
+            to_split.append((middle, stop, rows - first_rows))
+            to_split.append((first, middle, first_rows))
+
+        merged = []
+        for first, stop, rows in ranges:
+            if merged and merged[-1][2] + rows <= page_size:
+                merged[-1] = (merged[-1][0], stop, merged[-1][2] + rows)
+            else:
+                merged.append((first, stop, rows))
+        return [(first, stop) for first, stop, _ in merged]
+
+    def _oid_enumeration_page_range(self, oids, oid_field_name, query_fields):
+        def build(first, stop):
+            if self._fetch_by_object_ids:
+                return self._oid_list_query_args(oid_field_name, oids[first:stop], query_fields)
+            return self._page_query_args('{} >= {} AND {} <= {}'.format(
+                oid_field_name,
+                oids[first],
+                oid_field_name,
+                oids[stop - 1],
+            ), query_fields)
+        return _PageRange(0, len(oids), build)
+
+    def _range_plan(self, strategy, page_range, metadata, page_size, oid_field_name, row_count):
+        if self._adaptive_page_size:
+            self._logger.info("Paging through %s %s units using %s method, with adaptive page sizes",
+                              page_range.stop - page_range.start, strategy, strategy)
+            return _Plan(strategy, None, metadata, page_size, oid_field_name, page_range, row_count)
+
+        page_args = _RangePages(page_range, page_size)
+        self._logger.info(
+            "Planned %s requests of size %s using %s method", len(page_args), page_size, strategy)
+        return _Plan(strategy, page_args, metadata, page_size, oid_field_name, page_range, row_count)
+
+    def _plan_pages(self):
+        """ Work out how to page through the layer, returning a _Plan.
+
+        This is a planning step generator: it yields each request it needs
+        answered, so the same planning serves the blocking and asyncio dumpers.
+        """
         query_fields = self._fields
-        metadata = self.get_metadata()
+        metadata = yield from self._get_metadata()
         page_size = max(self._max_page_size,
                         metadata.get('maxRecordCount', 500))
-        geometry_type = metadata.get('geometryType')
 
         row_count = None
 
         try:
-            row_count = self.get_feature_count()
+            row_count = yield from self._get_feature_count()
         except EsriDownloadError:
             self._logger.info("Source does not support feature count")
 
-        # If there are no records matching the query, short circuit and return an empty generator.
+        # If there are no records matching the query, short circuit with an empty plan.
         if row_count == 0:
-            return
-            yield
-
-        page_args = []
+            return _Plan('empty', [], metadata, page_size, None, row_count=0)
 
         if not self._paginate_oid and row_count is not None and (metadata.get('supportsPagination') or
                                                                  (metadata.get('advancedQueryCapabilities') and metadata['advancedQueryCapabilities']['supportsPagination'])):
@@ -355,159 +971,452 @@ class EsriDumper(object):
             # There's a bug where some servers won't handle these queries in combination with a list of
             # fields specified. We'll make a single, 1 row query here to check if the server supports this
             # and switch to querying for all fields if specifying the fields fails.
-            if query_fields and not self.can_handle_pagination(query_fields):
+            if query_fields and not (yield from self._can_handle_pagination(query_fields)):
                 self._logger.info(
                     "Source does not support pagination with fields specified, so querying for all fields.")
                 query_fields = None
 
-            for offset in range(self._startWith, row_count, page_size):
-                query_args = self._build_query_args({
-                    'resultOffset': offset,
-                    'resultRecordCount': page_size,
-                    'where': '1=1',
-                    'geometryPrecision': self._precision,
-                    'returnGeometry': self._request_geometry,
-                    'outSR': self._outSR,
-                    'outFields': ','.join(query_fields or ['*']),
-                    'f': 'json',
-                })
-                page_args.append(query_args)
-            self._logger.info(
-                "Built %s requests of size %s using resultOffset method", len(page_args), page_size)
-        else:
-            # If not, we can still use the `where` argument to paginate
+            return self._range_plan(
+                'offset', self._offset_page_range(row_count, query_fields), metadata, page_size, None, row_count)
 
-            use_oids = True
-            oid_field_name = self._find_oid_field_name(metadata)
+        # If not, we can still use the `where` argument to paginate
 
-            if not oid_field_name:
-                raise EsriDownloadError(
-                    "Could not find object ID field name for deduplication")
+        oid_field_name = self._find_oid_field_name(metadata)
+        self._oid_field_name = oid_field_name
 
-            if metadata.get('supportsStatistics'):
-                # If the layer supports statistics, we can request maximum and minimum object ID
-                # to help build the pages
-                try:
-                    (oid_min, oid_max) = self._get_layer_min_max(oid_field_name)
-
-                    for page_min in range(oid_min - 1, oid_max, page_size):
-                        page_max = min(page_min + page_size, oid_max)
-                        query_args = self._build_query_args({
-                            'where': '{} > {} AND {} <= {}'.format(
-                                oid_field_name,
-                                page_min,
-                                oid_field_name,
-                                page_max,
-                            ),
-                            'geometryPrecision': self._precision,
-                            'returnGeometry': self._request_geometry,
-                            'outSR': self._outSR,
-                            'outFields': ','.join(query_fields or ['*']),
-                            'f': 'json',
-                        })
-                        page_args.append(query_args)
-                    self._logger.info(
-                        "Built {} requests using OID where clause method".format(len(page_args)))
-
-                    # If we reach this point we don't need to fall through to enumerating all object IDs
-                    # because the statistics method worked
-                    use_oids = False
-                except EsriDownloadError:
-                    self._logger.exception(
-                        "Finding max/min from statistics failed. Trying OID enumeration.")
+        if not oid_field_name:
+            raise EsriDownloadError(
+                "Could not find object ID field name for deduplication")
+
+        if metadata.get('supportsStatistics'):
+            # If the layer supports statistics, we can request maximum and minimum object ID
+            # to help build the pages
+            try:
+                (oid_min, oid_max) = yield from self._get_layer_min_max(oid_field_name)
+            except EsriDownloadError:
+                self._logger.exception(
+                    "Finding max/min from statistics failed. Trying OID enumeration.")
+            else:
+                # We don't need to fall through to enumerating all object IDs
+                # because the statistics method worked
+                page_range = self._oid_statistics_page_range(oid_min, oid_max, oid_field_name, query_fields)
+                if self._oids_are_sparse(oid_min, oid_max, row_count, page_size):
+                    try:
+                        ranges = yield from self._dense_oid_ranges(
+                            oid_field_name, oid_min, oid_max, row_count, page_size)
+                    except EsriDownloadError:
+                        self._logger.exception(
+                            "Counting rows in ranges of sparse OIDs failed. Paging through every OID.")
+                    else:
+                        page_args = _RangePages(page_range, page_size, ranges)
+                        self._logger.info(
+                            "Planned %s requests for %s rows with OIDs from %s to %s, after %s count queries",
+                            len(page_args), row_count, oid_min, oid_max, self.stats['oid_count_query_requests'])
+                        return _Plan('oid-statistics', page_args, metadata, page_size, oid_field_name, page_range,
+                                     row_count)
 
-            if use_oids:
-                # If the layer does not support statistics, we can request
-                # all the individual IDs and page through them one chunk at
-                # a time.
+                return self._range_plan('oid-statistics', page_range, metadata, page_size, oid_field_name, row_count)
 
-                try:
-                    oids = sorted(map(int, self._get_layer_oids()))
-
-                    for i in range(0, len(oids), page_size):
-                        oid_chunk = oids[i:i+page_size]
-                        page_min = oid_chunk[0]
-                        page_max = oid_chunk[-1]
-                        query_args = self._build_query_args({
-                            'where': '{} >= {} AND {} <= {}'.format(
-                                oid_field_name,
-                                page_min,
-                                oid_field_name,
-                                page_max,
-                            ),
-                            'geometryPrecision': self._precision,
-                            'returnGeometry': self._request_geometry,
-                            'outSR': self._outSR,
-                            'outFields': ','.join(query_fields or ['*']),
-                            'f': 'json',
-                        })
-                        page_args.append(query_args)
-                    self._logger.info(
-                        "Built %s requests using OID enumeration method", len(page_args))
-                except EsriDownloadError:
-                    self._logger.info("Falling back to geo queries")
-                    # Use geospatial queries when none of the ID-based methods will work
-                    bounds = metadata['extent']
-                    saved = set()
+        # If the layer does not support statistics, we can request
+        # all the individual IDs and page through them one chunk at
+        # a time.
 
-                    for feature in self._scrape_an_envelope(bounds, self._outSR, page_size):
-                        attrs = feature['attributes']
-                        oid = attrs.get(oid_field_name)
-                        if oid in saved:
-                            continue
+        try:
+            oids = sorted(map(int, (yield from self._get_layer_oids())))
+        except EsriDownloadError:
+            self._logger.info("Falling back to geo queries")
+            # Use geospatial queries when none of the ID-based methods will work
+            return _Plan('envelope', None, metadata, page_size, oid_field_name, row_count=row_count)
+
+        return self._range_plan(
+            'oid-enumeration',
+            self._oid_enumeration_page_range(oids, oid_field_name, query_fields),
+            metadata, page_size, oid_field_name, len(oids) if row_count is None else row_count)
+
+    def _uses_pbf(self, metadata):
+        """ Whether pages should be fetched as f=pbf: that transport was asked for and the layer supports it. """
+        if self._transport != 'pbf':
+            return False
 
-                        yield esri2geojson(feature)
+        formats = (metadata.get('supportedQueryFormats') or '').lower()
+        if 'pbf' not in [f.strip() for f in formats.split(',')]:
+            self._logger.info("Layer doesn't support pbf queries, so fetching pages as JSON")
+            return False
+        return True
+
+    def _pbf_page_args(self, query_args):
+        quantization = json.dumps(dict(
+            mode='edit',
+            originPosition='upperLeft',
+            tolerance=10 ** -self._precision,
+        ), separators=(',', ':'))
+        return dict(query_args, f='pbf', quantizationParameters=quantization)
+
+    def _transport_page_args(self, metadata, page_args):
+        """ Switch page queries to f=pbf if the layer should be fetched that way. """
+        if not page_args or not self._uses_pbf(metadata):
+            return page_args
+        return [self._pbf_page_args(query_args) for query_args in page_args]
+
+    def _json_page_args(self, query_args):
+        query_args = dict(query_args, f='json')
+        query_args.pop('quantizationParameters', None)
+        return query_args
+
+    def _parse_page(self, response, query_args, error_message):
+        """ Parse a page response, decoding it from protobuf if it was requested with f=pbf. """
+        if query_args.get('f') != 'pbf' or response.status_code != 200 or looks_like_json(response.content):
+            # Errors come back as JSON even for pbf queries
+            return self._handle_esri_errors(response, error_message)
+
+        return decode_query_result(response.content, query_args.get('geometryPrecision'))
+
+    def _convert_feature(self, feature):
+        if self._output_format == 'geojson':
+            return esri2geojson(feature)
+        return feature
+
+    def _convert_page(self, features):
+        """ Convert a page of features, in one batch unless the page is being streamed. """
+        if self._output_format != 'geojson':
+            return features
+        if not isinstance(features, list):
+            return map(esri2geojson, features)
+        return esri2geojson_batch(features)
+
+    def _plan_from_checkpoint(self):
+        """ Rebuild the plan recorded in the checkpoint, if there is one to resume. """
+        checkpoint = self._checkpoint
+        if not checkpoint or checkpoint.page_args is None:
+            return None
+
+        if checkpoint.url != self._layer_url:
+            raise EsriDownloadError("Checkpoint {} was made for {}, not {}".format(
+                checkpoint.path, checkpoint.url, self._layer_url))
+
+        self._logger.info("Resuming %s dump with %s of %s pages already written",
+                          checkpoint.strategy, len(checkpoint.completed), len(checkpoint.page_args))
+        return _Plan(checkpoint.strategy, checkpoint.page_args, None, None, None)
+
+    def _pages_to_fetch(self, plan):
+        """ The (index, query_args) pairs to fetch for plan, skipping pages the checkpoint has written. """
+        if not self._checkpoint:
+            return enumerate(plan.page_args)
+
+        if self._checkpoint.page_args is None:
+            self._checkpoint.start(self._layer_url, plan.strategy, plan.page_args)
+
+        return self._checkpoint.remaining_pages()
+
+    def _scrape_deduplicated(self, plan):
+        bounds = plan.metadata['extent']
+        saved = set()
+
+        for feature in self._scrape_an_envelope(bounds, self._outSR, plan.page_size):
+            attrs = feature['attributes']
+            oid = attrs.get(plan.oid_field_name)
+            if oid in saved:
+                continue
+
+            yield feature
+
+            saved.add(oid)
+
+    def _with_transport(self, plan):
+        if plan.page_range is None:
+            return plan._replace(page_args=self._transport_page_args(plan.metadata, plan.page_args))
+
+        if not self._uses_pbf(plan.metadata):
+            return plan
+
+        build = plan.page_range.build
+        page_range = plan.page_range._replace(build=lambda first, stop: self._pbf_page_args(build(first, stop)))
+        page_args = plan.page_args.with_range(page_range) if plan.page_args is not None else None
+        return plan._replace(page_args=page_args, page_range=page_range)
+
+    def plan(self):
+        """ Work out how the layer will be paged through, without fetching any features.
+
+        Returns a QueryPlan. The next iteration over the dumper follows this
+        plan instead of making a new one.
+        """
+        if self._planned is None:
+            self._planned = self._plan_from_checkpoint() or self._with_transport(self._drive(self._plan_pages()))
+        return QueryPlan(self._layer_url, self._planned)
+
+    def _take_plan(self):
+        self.plan()
+        plan, self._planned = self._planned, None
+        return plan
+
+    def _fetched_pages(self, split_envelope=False):
+        """ Yield (index, Esri JSON features) for each page, with an index of None for an envelope scrape.
+
+        An envelope scrape is one page, or with ``split_envelope`` lists of up
+        to the plan's page size features.
+        """
+        plan = self._take_plan()
+
+        if plan.strategy == 'envelope':
+            if self._checkpoint:
+                self._logger.warning("Envelope scraping can't be checkpointed, so this dump can't be resumed")
+
+            features = self._scrape_deduplicated(plan)
+            if not split_envelope:
+                yield None, features
+                return
+
+            while True:
+                page = list(itertools.islice(features, plan.page_size))
+                if not page:
+                    return
+                yield None, page
 
-                        saved.add(oid)
+        if plan.page_args is None:
+            for features in self._fetch_adaptive_pages(plan):
+                yield None, features
+            return
 
-                    return
+        for index, features in self._fetch_pages(self._pages_to_fetch(plan)):
+            yield index, features
+
+    def _page_done(self, index):
+        if self._checkpoint and index is not None:
+            self._checkpoint.page_done(index)
+
+    def iter_pages(self):
+        """ Yield the layer's features a page at a time.
+
+        Each page is an iterable of features that must be consumed before
+        asking for the next page. A layer scraped by envelope comes back as a
+        single page.
+        """
+        for index, features in self._fetched_pages():
+            yield self._convert_page(features)
+            self._page_done(index)
+
+    def iter_serialized_pages(self, jsonlines=False, fast_json=False):
+        """ Yield each page converted and serialized, ready for GeoJSONWriter.write_serialized.
+
+        With ``workers`` greater than 1, whole pages are converted and
+        serialized in a pool of that many processes while the next pages are
+        fetched, and the text comes back in page order. Streamed pages are
+        read into memory before they are handed to a worker, and layers
+        scraped by envelope are handed over a page size at a time. The
+        workers are started with forkserver or spawn rather than fork,
+        because the fetch and output threads are already running.
+        """
+        if self._workers == 1:
+            for index, features in self._fetched_pages():
+                yield _convert_and_serialize(features, self._output_format, jsonlines, fast_json)
+                self._page_done(index)
+            return
+
+        start_methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in start_methods else 'spawn')
+        executor = ProcessPoolExecutor(max_workers=self._workers, mp_context=context)
+        # (index, future) for pages handed to the pool, in page order
+        pending = collections.deque()
+        try:
+            for index, features in self._fetched_pages(split_envelope=True):
+                pending.append((index, executor.submit(
+                    _convert_and_serialize, list(features), self._output_format, jsonlines, fast_json)))
+                # Keep every worker busy without holding more than a couple of pages each
+                while len(pending) > 2 * self._workers:
+                    index, future = pending.popleft()
+                    yield future.result()
+                    self._page_done(index)
+
+            while pending:
+                index, future = pending.popleft()
+                yield future.result()
+                self._page_done(index)
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def __iter__(self):
+        for page in self.iter_pages():
+            for feature in page:
+                yield feature
+
+    def _check_page(self, data, query_args):
+        error = data.get('error')
+        if error:
+            raise EsriDownloadError("Problem querying ESRI dataset with args {}. Server said: {}".format(
+                query_args, error['message']))
+
+        features = data.get('features')
+        if 'objectIds' in query_args and features is not None:
+            check = _ObjectIdsCheck(query_args, data.get('objectIdFieldName') or self._oid_field_name)
+            for feature in features:
+                check.feature(feature)
+            check.done(self._logger)
+        return features
+
+    def _checked_stream(self, features, query_args):
+        check = _ObjectIdsCheck(query_args, self._oid_field_name)
+        for feature in features:
+            check.feature(feature)
+            yield feature
+        check.done(self._logger)
+
+    def _fetch_page(self, query_args):
+        if self._pbf_failed and query_args.get('f') == 'pbf':
+            query_args = self._json_page_args(query_args)
 
         query_url = self._build_url('/query')
         headers = self._build_headers()
-        for query_index, query_args in enumerate(page_args, start=1):
-            download_exception = None
-            data = None
-
-            #  try to do a request "num_of_retry" to increase the probability of fetching data successfully
-            for retry in range(self._num_of_retry):
-                try:
-                    # pause every number of "requests_to_pause", that increase the probability for server response
-                    if query_index % self._requests_to_pause == 0:
-                        time.sleep(self._pause_seconds)
-                        self._logger.info(
-                            "pause for %s seconds", self._pause_seconds)
+        download_exception = None
+        error_message = "Could not retrieve this chunk of objects"
+        # pbf pages are small and can't be parsed incrementally, so they are never streamed
+        stream = self._stream_pages and query_args.get('f') != 'pbf'
+
+        def parse(response):
+            return self._parse_page(response, query_args, error_message)
+
+        cache_key, data = self._cache_lookup(
+            'POST', query_url, dict(data=query_args), error_message, parse=parse)
+        if data is not None:
+            return self._check_page(data, query_args)
+
+        #  try to do a request "num_of_retry" to increase the probability of fetching data successfully
+        for retry in range(self._num_of_retry):
+            response = None
+            try:
+                time.sleep(self._rate_limiter.acquire())
+                started = time.monotonic()
+                if stream:
+                    response = self._request(
+                        'POST', query_url, headers=headers, data=query_args, stream=True)
+                    features = self._stream_features(response, error_message, started)
+                else:
                     response = self._request(
                         'POST', query_url, headers=headers, data=query_args)
-                    data = self._handle_esri_errors(
-                        response, "Could not retrieve this chunk of objects")
-                    # reset the exception state.
-                    download_exception = None
-                    # get out of retry loop, as the request succeeded
-                    break
-                except socket.timeout as e:
-                    raise EsriDownloadError(
-                        "Timeout when connecting to URL", e)
-                except ValueError as e:
-                    raise EsriDownloadError("Could not parse JSON", e)
-                except Exception as e:
-                    download_exception = EsriDownloadError(
-                        "Could not connect to URL", e)
-                    # increase the pause time every retry, to increase the probability of fetching data successfully
-                    time.sleep(self._pause_seconds * (retry + 1))
-                    self._logger.info("retry pause {0}".format(retry))
-
-            if download_exception:
-                raise download_exception
+                    data = parse(response)
+                    self._cache_store(cache_key, response)
+                    self._rate_limiter.record_success(time.monotonic() - started)
+                # reset the exception state.
+                download_exception = None
+                # get out of retry loop, as the request succeeded
+                break
+            except socket.timeout as e:
+                raise EsriDownloadError(
+                    "Timeout when connecting to URL", e)
+            except ValueError as e:
+                if query_args.get('f') == 'pbf':
+                    self._logger.warning("Could not decode a pbf page, so fetching pages as JSON from now on: %s", e)
+                    self._pbf_failed = True
+                    return self._fetch_page(query_args)
+                raise EsriDownloadError("Could not parse JSON", e)
+            except Exception as e:
+                download_exception = EsriDownloadError(
+                    "Could not connect to URL", e)
+                # let the rate limiter slow down (and honor Retry-After) before trying again
+                self._rate_limiter.record_failure(retry_after_seconds(response))
+                time.sleep(self._rate_limiter.backoff(retry))
+                self._logger.info("retry pause {0}".format(retry))
+
+        if download_exception:
+            raise download_exception
+
+        if stream:
+            if 'objectIds' in query_args:
+                return self._checked_stream(features, query_args)
+            return features
+
+        return self._check_page(data, query_args)
+
+    def _fetch_pages(self, pages):
+        """ Fetch each (index, query_args) pair in pages, yielding (index, features) for each page.
+
+        With a concurrency greater than 1 the pages are requested from a thread pool that
+        never holds more than that many pages in flight. Pages are yielded in the order they
+        appear in pages unless the dumper was created with ordered=False, in which case
+        they are yielded as soon as they arrive. Streamed pages are read whole on the
+        pool's threads, so their bodies are read concurrently too.
+        """
+        if self._concurrency == 1:
+            for index, query_args in pages:
+                yield index, self._fetch_page(query_args)
+            return
 
-            error = data.get('error')
-            if error:
-                raise EsriDownloadError("Problem querying ESRI dataset with args {}. Server said: {}".format(
-                    query_args, error['message']))
+        executor = ThreadPoolExecutor(max_workers=self._concurrency)
+        # Maps each in-flight future to its page index, in submission order
+        pending = {}
+        try:
+            for index, query_args in pages:
+                pending[executor.submit(self._fetch_whole_page, query_args)] = index
+                while len(pending) >= self._concurrency:
+                    yield self._next_finished_page(pending)
+
+            while pending:
+                yield self._next_finished_page(pending)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _fetch_whole_page(self, query_args):
+        """ Fetch a page, reading all of a streamed page before returning it. """
+        features = self._fetch_page(query_args)
+        if self._stream_pages and features is not None and not isinstance(features, list):
+            features = list(features)
+        return features
+
+    def _fetch_timed_page(self, query_args):
+        started = time.monotonic()
+        features = self._fetch_whole_page(query_args)
+        return features, time.monotonic() - started
+
+    def _fetch_adaptive_pages(self, plan):
+        """ Fetch the plan's page_range in order, cutting each page at the current adaptive page size.
+
+        A page that fails is split in two and both halves are fetched again,
+        down to pages of a single unit, so one bad chunk doesn't stop the dump.
+        """
+        page_range = plan.page_range
+        sizer = AdaptivePageSize(plan.metadata.get('maxRecordCount') or plan.page_size, logger=self._logger)
+        next_first = page_range.start
+        # (first, stop, future) for every page handed to the pool, in page order
+        pending = collections.deque()
+        executor = ThreadPoolExecutor(max_workers=self._concurrency)
+
+        def submit(first, stop):
+            return executor.submit(self._fetch_timed_page, page_range.build(first, stop))
 
-            features = data.get('features')
+        try:
+            while pending or next_first < page_range.stop:
+                while next_first < page_range.stop and len(pending) < self._concurrency:
+                    stop = min(next_first + sizer.size, page_range.stop)
+                    pending.append((next_first, stop, submit(next_first, stop)))
+                    next_first = stop
 
-            for feature in features:
-                if self._output_format == 'geojson':
-                    yield esri2geojson(feature)
-                else:
-                    yield feature
+                first, stop, future = pending.popleft()
+                try:
+                    features, seconds = future.result()
+                except EsriDownloadError:
+                    if stop - first == 1:
+                        raise
+                    sizer.record_failure(stop - first)
+                    middle = first + (stop - first) // 2
+                    self._logger.info("Page failed, so fetching it again in two halves")
+                    pending.appendleft((middle, stop, submit(middle, stop)))
+                    pending.appendleft((first, middle, submit(first, middle)))
+                    continue
+
+                sizer.record_success(stop - first, seconds)
+                yield features
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _next_finished_page(self, pending):
+        if self._ordered:
+            future = next(iter(pending))
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            future = done.pop()
+        return pending.pop(future), future.result()
@@ -13,6 +13,14 @@ def esri2geojson(esrijson_feature):
 
     return response
 
+def esri2geojson_batch(esrijson_features):
+    """
+    Convert a page of Esri JSON features to a list of GeoJSON features, with
+    the same results as calling esri2geojson on each one.
+    """
+    convert = esri2geojson
+    return [convert(feature) for feature in esrijson_features]
+
 def convert_esri_geometry(esri_geometry):
     if esri_geometry is None:
         return esri_geometry
@@ -66,8 +74,22 @@ def convert_esri_polyline(esri_geometry):
         }
 
 def convert_esri_polygon(esri_geometry):
-    rings = esri_geometry.get('rings')
+    clean_rings = clean_esri_rings(esri_geometry.get('rings'))
+
+    if len(clean_rings) == 1:
+        return {
+            "type": "Polygon",
+            "coordinates": clean_rings
+        }
+    elif len(clean_rings) == 0:
+        return None
+    else:
+        return decode_polygon(clean_rings)
 
+def clean_esri_rings(rings):
+    """
+    Drop the rings that can't make a polygon and close the rest.
+    """
     def ensure_closed_ring(ring):
         first = ring[0]
         last = ring[-1]
@@ -82,22 +104,16 @@ def convert_esri_polygon(esri_geometry):
     def is_valid_ring(ring):
         return len(ring) >= 3 and not (len(ring) == 3 and ring[0] == ring[2])
 
-    clean_rings = [
+    return [
         ensure_closed_ring(ring)
         for ring in filter(is_valid_ring, rings)
     ]
 
-    if len(clean_rings) == 1:
-        return {
-            "type": "Polygon",
-            "coordinates": clean_rings
-        }
-    elif len(clean_rings) == 0:
-        return None
-    else:
-        return decode_polygon(clean_rings)
-
-def decode_polygon(esri_rings):
+def group_esri_rings(esri_rings):
+    """
+    Group rings into polygons, each a clockwise outer ring followed by the
+    counter-clockwise holes after it.
+    """
     coords = []
     outer_ring_index = -1
 
@@ -112,6 +128,11 @@ def decode_polygon(esri_rings):
             # Skip over rings that are in an unexpected order
             continue
 
+    return coords
+
+def decode_polygon(esri_rings):
+    coords = group_esri_rings(esri_rings)
+
     if len(coords) == 1:
         return {
             "type": "Polygon",
@@ -131,8 +152,18 @@ def ring_is_clockwise(ring):
     this code taken from http://esri.github.com/geojson-utils/src/jsonConverters.js by James Cardona (MIT lisense)
     """
     total = 0
-    for (pt1, pt2) in pairwise(ring):
-        total += (pt2[0] - pt1[0]) * (pt2[1] + pt1[1])
+    if not ring:
+        return True
+
+    x1 = ring[0][0]
+    y1 = ring[0][1]
+    # Indexing the vertices directly is much quicker than pairwise() on big rings
+    for pt in ring[1:]:
+        x2 = pt[0]
+        y2 = pt[1]
+        total += (x2 - x1) * (y2 + y1)
+        x1 = x2
+        y1 = y2
     return total >= 0
 
 def pairwise(iterable):
@@ -0,0 +1,95 @@
+import json
+
+from esridump.errors import EsriDownloadError
+
+
+def _is_feature(line):
+    """ Whether a line is a whole GeoJSON or Esri JSON feature, rather than the start or all of a collection. """
+    try:
+        value = json.loads(line)
+    except ValueError:
+        return False
+    return isinstance(value, dict) and value.get('type') != 'FeatureCollection' and 'features' not in value
+
+
+def _feature_attributes(feature):
+    """ The attributes of a GeoJSON or Esri JSON feature. """
+    if 'attributes' in feature:
+        return feature['attributes'] or {}
+    return feature.get('properties') or {}
+
+
+def read_features(path):
+    """ Yield the features of a FeatureCollection or newline-delimited file, of GeoJSON or Esri JSON features. """
+    with open(path, 'r') as f:
+        first_line = f.readline()
+        f.seek(0)
+
+        if _is_feature(first_line):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for feature in json.load(f)['features']:
+                yield feature
+
+
+class IncrementalDump(object):
+    """ Brings a previous dump of a layer up to date, downloading only what changed.
+
+    Iterating yields the merged dump: every feature of the previous dump that
+    is unchanged, followed by the new versions of added and modified features.
+    ``previous`` is a callable returning a fresh iterable of the previous
+    dump's features, since it is read twice. After iteration ``added``,
+    ``modified`` and ``deleted`` hold the OIDs that changed.
+    """
+
+    def __init__(self, dumper, previous):
+        self._dumper = dumper
+        self._previous = previous
+        self.added = None
+        self.modified = None
+        self.deleted = None
+
+    def iter_pages(self):
+        """ Yield the merged dump a page at a time, like EsriDumper.iter_pages. """
+        dumper = self._dumper
+        metadata = dumper.get_metadata()
+        oid_field_name = dumper._find_oid_field_name(metadata)
+        if not oid_field_name:
+            raise EsriDownloadError("Could not find object ID field name to compare dumps with")
+        edit_field_name = (metadata.get('editFieldsInfo') or {}).get('editDateField')
+
+        previous_oids = set()
+        last_edit = None
+        for feature in self._previous():
+            attributes = _feature_attributes(feature)
+            oid = attributes.get(oid_field_name)
+            if oid is None:
+                raise EsriDownloadError("Previous dump has a feature without a {} attribute".format(oid_field_name))
+            previous_oids.add(int(oid))
+
+            edited = attributes.get(edit_field_name) if edit_field_name else None
+            if edited is not None and (last_edit is None or edited > last_edit):
+                last_edit = edited
+
+        changes = dumper._drive(dumper._plan_changes(metadata, previous_oids, last_edit))
+        self.added = changes.added
+        self.modified = changes.modified
+        self.deleted = changes.deleted
+
+        stale = set(changes.modified) | set(changes.deleted)
+        yield (
+            feature
+            for feature in self._previous()
+            if int(_feature_attributes(feature)[oid_field_name]) not in stale
+        )
+
+        page_args = dumper._transport_page_args(metadata, changes.page_args)
+        for _, features in dumper._fetch_pages(enumerate(page_args)):
+            yield dumper._convert_page(features)
+
+    def __iter__(self):
+        for page in self.iter_pages():
+            for feature in page:
+                yield feature
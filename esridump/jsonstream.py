@@ -0,0 +1,151 @@
+import codecs
+import json
+import re
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_INCOMPLETE = object()
+_NUMBER_CHARACTERS = '0123456789.eE+-'
+
+
+class FeatureStreamParser(object):
+    """ An incremental parser for Esri query responses.
+
+    Feed it the response body in chunks of bytes. Each call to ``feed``
+    returns the items of the top-level ``features`` array that were completed
+    by that chunk, so only the feature being parsed is ever held as text.
+    Every other top-level member is passed to ``on_member(key, value)`` as soon
+    as it has been read, which lets callers raise on error payloads before any
+    features arrive. Call ``close`` once the body has been read.
+    """
+
+    def __init__(self, on_member=None, array_key='features'):
+        self._on_member = on_member
+        self._array_key = array_key
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+
+        self._buffer = ''
+        self._pos = 0
+        self._chunks = []
+        self._chunks_length = 0
+        # Don't try to decode a partial value again until this much text is available
+        self._wanted = 0
+        self._closed = False
+
+        self._state = 'start'
+        self._key = None
+
+    def feed(self, data):
+        text = self._text.decode(data)
+        if text:
+            self._chunks.append(text)
+            self._chunks_length += len(text)
+        return list(self._parse())
+
+    def close(self):
+        """ Finish parsing, returning any last features and raising ValueError if the JSON is incomplete. """
+        text = self._text.decode(b'', final=True)
+        if text:
+            self._chunks.append(text)
+            self._chunks_length += len(text)
+        self._closed = True
+
+        features = list(self._parse())
+        if self._state != 'done':
+            raise ValueError("Response ended before its JSON was complete")
+        return features
+
+    def _fill(self):
+        available = len(self._buffer) - self._pos + self._chunks_length
+        if self._chunks and (self._closed or available >= self._wanted):
+            self._buffer = self._buffer[self._pos:] + ''.join(self._chunks)
+            self._pos = 0
+            self._chunks = []
+            self._chunks_length = 0
+
+    def _decode(self):
+        if not self._closed and len(self._buffer) - self._pos < self._wanted:
+            return _INCOMPLETE
+
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if self._closed:
+                raise
+            self._wanted = 2 * (len(self._buffer) - self._pos)
+            return _INCOMPLETE
+
+        if not self._closed and (end == len(self._buffer) or self._buffer[end] in _NUMBER_CHARACTERS):
+            # A number at the end of the buffer might continue in the next chunk
+            self._wanted = len(self._buffer) - self._pos + 1
+            return _INCOMPLETE
+
+        self._pos = end
+        self._wanted = 0
+        return value
+
+    def _expect(self, char, expected):
+        if char not in expected:
+            raise ValueError("Expected one of {!r} at {!r} in the response, found {!r}".format(
+                expected, self._buffer[self._pos:self._pos + 20], char))
+        self._pos += 1
+
+    def _parse(self):
+        while True:
+            self._fill()
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos >= len(self._buffer):
+                return
+
+            char = self._buffer[self._pos]
+            state = self._state
+
+            if state == 'start':
+                self._expect(char, '{')
+                self._state = 'key'
+            elif state == 'key':
+                if char == '}':
+                    self._pos += 1
+                    self._state = 'done'
+                    continue
+                key = self._decode()
+                if key is _INCOMPLETE:
+                    return
+                self._key = key
+                self._state = 'colon'
+            elif state == 'colon':
+                self._expect(char, ':')
+                self._state = 'array' if self._key == self._array_key else 'value'
+            elif state == 'array':
+                if char == '[':
+                    self._pos += 1
+                    self._state = 'first_item'
+                else:
+                    self._state = 'value'
+            elif state == 'first_item':
+                if char == ']':
+                    self._pos += 1
+                    self._state = 'member_separator'
+                else:
+                    self._state = 'item'
+            elif state == 'item':
+                item = self._decode()
+                if item is _INCOMPLETE:
+                    return
+                self._state = 'item_separator'
+                yield item
+            elif state == 'item_separator':
+                self._expect(char, ',]')
+                self._state = 'item' if char == ',' else 'member_separator'
+            elif state == 'value':
+                value = self._decode()
+                if value is _INCOMPLETE:
+                    return
+                self._state = 'member_separator'
+                if self._on_member:
+                    self._on_member(self._key, value)
+            elif state == 'member_separator':
+                self._expect(char, ',}')
+                self._state = 'key' if char == ',' else 'done'
+            else:
+                raise ValueError("Unexpected data after the end of the response JSON")
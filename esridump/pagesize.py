@@ -0,0 +1,45 @@
+import logging
+import threading
+
+
+class AdaptivePageSize(object):
+    """ Picks how many features to ask for per page from how the last pages went.
+
+    A page that comes back in under half of ``target_seconds`` doubles the
+    size (up to ``maximum``, normally the layer's maxRecordCount). A page
+    slower than ``target_seconds`` or a failed page halves it (down to
+    ``minimum``). The size is shared by every thread fetching pages.
+    """
+
+    def __init__(self, maximum, initial=None, minimum=1, target_seconds=5.0, logger=None):
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        self.size = max(minimum, min(self.maximum, initial or self.maximum // 4))
+        self._target_seconds = target_seconds
+        self._logger = logger or logging.getLogger('esridump')
+        self._lock = threading.Lock()
+
+    def record_success(self, size, seconds):
+        """ Record that a page of ``size`` took ``seconds`` to come back. """
+        with self._lock:
+            if seconds > self._target_seconds:
+                self._shrink(size, "a page of %s took %.1f seconds" % (size, seconds))
+            elif seconds < self._target_seconds / 2 and size >= self.size:
+                # Smaller pages, such as the last one of a range, don't say whether the current size is too small
+                self._resize(size * 2, "a page of %s took %.1f seconds" % (size, seconds))
+
+    def record_failure(self, size):
+        with self._lock:
+            self._shrink(size, "a page of %s failed" % size)
+
+    def _shrink(self, size, reason):
+        # Pages much smaller than the current size, or cut before an earlier shrink,
+        # shouldn't shrink it again
+        if size * 2 > self.size:
+            self._resize(min(self.size, size // 2), reason)
+
+    def _resize(self, size, reason):
+        size = max(self.minimum, min(self.maximum, size))
+        if size != self.size:
+            self._logger.info("Changing page size from %s to %s because %s", self.size, size, reason)
+            self.size = size
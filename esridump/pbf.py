@@ -0,0 +1,369 @@
+import struct
+
+# The parts of Esri's FeatureCollection.proto (package esriPBuffer) needed to
+# turn an f=pbf query response back into the structure of an f=json one.
+# https://github.com/Esri/arcgis-pbf/tree/main/proto/FeatureCollection
+
+_GEOMETRY_TYPES = {
+    0: 'esriGeometryPoint',
+    1: 'esriGeometryMultipoint',
+    2: 'esriGeometryPolyline',
+    3: 'esriGeometryPolygon',
+    4: 'esriGeometryMultiPatch',
+    127: 'esriGeometryNull',
+}
+
+_FIELD_TYPES = [
+    'esriFieldTypeSmallInteger',
+    'esriFieldTypeInteger',
+    'esriFieldTypeSingle',
+    'esriFieldTypeDouble',
+    'esriFieldTypeString',
+    'esriFieldTypeDate',
+    'esriFieldTypeOID',
+    'esriFieldTypeGeometry',
+    'esriFieldTypeBlob',
+    'esriFieldTypeRaster',
+    'esriFieldTypeGUID',
+    'esriFieldTypeGlobalID',
+    'esriFieldTypeXML',
+]
+
+_UPPER_LEFT = 0
+
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+
+def looks_like_json(content):
+    """ Whether a response body is JSON, such as an error payload sent back for an f=pbf query. """
+    return content.lstrip()[:1] == b'{'
+
+
+def _varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _fields(buf):
+    """ Yield (field number, wire type, value) for each field of an encoded message.
+
+    Varints are returned as ints, everything else as a memoryview of its bytes.
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == _VARINT:
+            value, pos = _varint(buf, pos)
+        elif wire_type == _LENGTH_DELIMITED:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == _FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == _FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire_type))
+
+        if pos > end:
+            raise ValueError("Protobuf message is truncated")
+        yield key >> 3, wire_type, value
+
+
+def _packed_varints(wire_type, value):
+    if wire_type == _VARINT:
+        return [value]
+
+    values = []
+    pos = 0
+    end = len(value)
+    while pos < end:
+        item, pos = _varint(value, pos)
+        values.append(item)
+    return values
+
+
+def _string(value):
+    return bytes(value).decode('utf-8')
+
+
+def _double(value):
+    return struct.unpack('<d', value)[0]
+
+
+def _decode_value(buf):
+    for number, wire_type, value in _fields(buf):
+        if number == 1:
+            return _string(value)
+        elif number == 2:
+            return struct.unpack('<f', value)[0]
+        elif number == 3:
+            return _double(value)
+        elif number in (4, 8):
+            return _zigzag(value)
+        elif number in (5, 7):
+            return value
+        elif number == 6:
+            return _signed(value)
+        elif number == 9:
+            return bool(value)
+    # An empty Value is a null attribute
+    return None
+
+
+def _decode_doubles(buf):
+    """ Decode a Scale or Translate message, returning (x, y, m, z). """
+    values = [0.0, 0.0, 0.0, 0.0]
+    for number, _, value in _fields(buf):
+        if 1 <= number <= 4:
+            values[number - 1] = _double(value)
+    return values
+
+
+def _decode_transform(buf):
+    origin = _UPPER_LEFT
+    scale = [1.0, 1.0, 1.0, 1.0]
+    translate = [0.0, 0.0, 0.0, 0.0]
+    for number, _, value in _fields(buf):
+        if number == 1:
+            origin = value
+        elif number == 2:
+            scale = _decode_doubles(value)
+        elif number == 3:
+            translate = _decode_doubles(value)
+    return origin, scale, translate
+
+
+def _decode_field(buf):
+    field = {}
+    for number, _, value in _fields(buf):
+        if number == 1:
+            field['name'] = _string(value)
+        elif number == 2:
+            field['type'] = _FIELD_TYPES[value] if value < len(_FIELD_TYPES) else value
+        elif number == 3:
+            field['alias'] = _string(value)
+    return field
+
+
+def _decode_spatial_reference(buf):
+    spatial_reference = {}
+    names = {1: 'wkid', 2: 'latestWkid', 3: 'vcsWkid', 4: 'latestVcsWkid'}
+    for number, _, value in _fields(buf):
+        if number in names:
+            spatial_reference[names[number]] = value
+        elif number == 5:
+            spatial_reference['wkt'] = _string(value)
+    return spatial_reference
+
+
+class _GeometryDecoder(object):
+    """ Turns the quantized, delta-encoded coordinates of a Geometry message back into Esri JSON. """
+
+    def __init__(self, geometry_type, has_z, has_m, transform, precision):
+        self._geometry_type = geometry_type
+        self._has_z = has_z
+        self._has_m = has_m
+        self._dimensions = 2 + has_z + has_m
+        self._precision = precision
+
+        origin, scale, translate = transform
+        self._scale_x, self._scale_y, self._scale_m, self._scale_z = scale
+        self._translate_x, self._translate_y, self._translate_m, self._translate_z = translate
+        # Quantized y grows downwards from an upper left origin
+        if origin == _UPPER_LEFT:
+            self._scale_y = -self._scale_y
+
+    def _vertices(self, coords):
+        dimensions = self._dimensions
+        precision = self._precision
+        scales = [self._scale_x, self._scale_y]
+        translates = [self._translate_x, self._translate_y]
+        if self._has_z:
+            scales.append(self._scale_z)
+            translates.append(self._translate_z)
+        if self._has_m:
+            scales.append(self._scale_m)
+            translates.append(self._translate_m)
+
+        # Every coordinate is a delta from the previous vertex, across all the parts
+        totals = [0] * dimensions
+        vertices = []
+        for i in range(0, len(coords) - dimensions + 1, dimensions):
+            vertex = []
+            for d in range(dimensions):
+                totals[d] += coords[i + d]
+                value = translates[d] + scales[d] * totals[d]
+                vertex.append(round(value, precision) if precision is not None else value)
+            vertices.append(vertex)
+        return vertices
+
+    def _parts(self, vertices, lengths):
+        if not lengths:
+            return [vertices]
+
+        parts = []
+        start = 0
+        for length in lengths:
+            parts.append(vertices[start:start + length])
+            start += length
+        return parts
+
+    def decode(self, buf):
+        lengths = []
+        coords = []
+        for number, wire_type, value in _fields(buf):
+            if number == 2:
+                lengths.extend(_packed_varints(wire_type, value))
+            elif number == 3:
+                coords.extend(_zigzag(v) for v in _packed_varints(wire_type, value))
+
+        vertices = self._vertices(coords)
+        geometry_type = self._geometry_type
+        if geometry_type == 'esriGeometryPoint':
+            if not vertices:
+                return None
+            geometry = dict(x=vertices[0][0], y=vertices[0][1])
+            if self._has_z:
+                geometry['z'] = vertices[0][2]
+            if self._has_m:
+                geometry['m'] = vertices[0][-1]
+            return geometry
+        elif geometry_type == 'esriGeometryMultipoint':
+            return dict(points=vertices)
+        elif geometry_type == 'esriGeometryPolyline':
+            return dict(paths=self._parts(vertices, lengths))
+        elif geometry_type == 'esriGeometryPolygon':
+            return dict(rings=self._parts(vertices, lengths))
+        raise ValueError("Can't decode {} geometries from protobuf".format(geometry_type))
+
+
+def _decode_feature(buf, field_names, geometry_decoder):
+    values = []
+    geometry = None
+    for number, _, value in _fields(buf):
+        if number == 1:
+            values.append(_decode_value(value))
+        elif number == 2 and geometry_decoder:
+            geometry = geometry_decoder.decode(value)
+        elif number == 3:
+            raise ValueError("Can't decode features sent as Esri shape buffers")
+
+    feature = {'attributes': dict(zip(field_names, values))}
+    if geometry is not None:
+        feature['geometry'] = geometry
+    return feature
+
+
+def _decode_feature_result(buf, precision):
+    result = {}
+    has_z = has_m = False
+    geometry_type = None
+    transform = (_UPPER_LEFT, [1.0, 1.0, 1.0, 1.0], [0.0, 0.0, 0.0, 0.0])
+    fields = []
+    encoded_features = []
+
+    for number, _, value in _fields(buf):
+        if number == 1:
+            result['objectIdFieldName'] = _string(value)
+        elif number == 3:
+            result['globalIdFieldName'] = _string(value)
+        elif number == 7:
+            geometry_type = _GEOMETRY_TYPES.get(value)
+        elif number == 8:
+            result['spatialReference'] = _decode_spatial_reference(value)
+        elif number == 9:
+            result['exceededTransferLimit'] = bool(value)
+        elif number == 10:
+            has_z = bool(value)
+        elif number == 11:
+            has_m = bool(value)
+        elif number == 12:
+            transform = _decode_transform(value)
+        elif number == 13:
+            fields.append(_decode_field(value))
+        elif number == 15:
+            encoded_features.append(value)
+
+    if geometry_type:
+        result['geometryType'] = geometry_type
+    if has_z:
+        result['hasZ'] = True
+    if has_m:
+        result['hasM'] = True
+    result['fields'] = fields
+
+    geometry_decoder = None
+    if geometry_type and geometry_type != 'esriGeometryNull':
+        geometry_decoder = _GeometryDecoder(geometry_type, has_z, has_m, transform, precision)
+
+    field_names = [field.get('name') for field in fields]
+    result['features'] = [
+        _decode_feature(encoded, field_names, geometry_decoder)
+        for encoded in encoded_features
+    ]
+    return result
+
+
+def _decode_ids_result(buf):
+    result = {'objectIds': []}
+    for number, wire_type, value in _fields(buf):
+        if number == 1:
+            result['objectIdFieldName'] = _string(value)
+        elif number == 3:
+            result['objectIds'].extend(_packed_varints(wire_type, value))
+    return result
+
+
+def _decode_count_result(buf):
+    for number, _, value in _fields(buf):
+        if number == 1:
+            return {'count': value}
+    return {'count': 0}
+
+
+def decode_query_result(content, precision=None):
+    """ Decode an f=pbf query response into the dict an f=json query would have returned.
+
+    Coordinates are rounded to ``precision`` decimal places, so they match what
+    the server sends for the same query's ``geometryPrecision``. Raises
+    ValueError if the content isn't a FeatureCollectionPBuffer.
+    """
+    try:
+        for number, _, value in _fields(memoryview(content)):
+            if number != 2:
+                continue
+
+            for result_number, _, result in _fields(value):
+                if result_number == 1:
+                    return _decode_feature_result(result, precision)
+                elif result_number == 2:
+                    return _decode_count_result(result)
+                elif result_number == 3:
+                    return _decode_ids_result(result)
+    except (IndexError, struct.error) as e:
+        raise ValueError("Could not decode protobuf response: {}".format(e))
+
+    raise ValueError("Protobuf response has no query result")
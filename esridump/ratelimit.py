@@ -0,0 +1,164 @@
+import email.utils
+import itertools
+import logging
+import random
+import threading
+import time
+from six.moves.urllib.parse import urlparse
+
+
+def retry_after_seconds(response):
+    """ Return the delay asked for by a response's Retry-After header, or None. """
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class AdaptiveRateLimiter(object):
+    """ A token bucket whose refill rate follows how well the server is coping.
+
+    Every successful page adds ``increase`` requests per second to the rate
+    (up to ``max_rate``). A failed request (HTTP error, Esri error payload or
+    connection problem) or a response more than ``slow_factor`` times slower
+    than the running average multiplies the rate by ``decrease`` (down to
+    ``min_rate``). A Retry-After header holds back every request until it
+    expires. Retries of a failed page also wait ``backoff_base`` seconds,
+    doubling with each retry up to ``backoff_cap``, with up to half of
+    that taken off at random, since a server that was fast a moment ago
+    leaves the rate too high to space them out on its own. One limiter can
+    be shared by several dumpers and threads.
+    """
+
+    def __init__(self, initial_rate=4.0, min_rate=0.05, max_rate=50.0,
+                 increase=0.5, decrease=0.5, slow_factor=3.0, burst=1.0,
+                 backoff_base=2.0, backoff_cap=60.0,
+                 logger=None, clock=time.monotonic, random=random.random):
+        self.rate = float(initial_rate)
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._increase = increase
+        self._decrease = decrease
+        self._slow_factor = slow_factor
+        self._burst = burst
+        self._backoff_base = backoff_base
+        self._backoff_cap = backoff_cap
+        self._clock = clock
+        self._random = random
+        self._logger = logger or logging.getLogger('esridump')
+        self._lock = threading.Lock()
+
+        self._tokens = burst
+        self._updated = clock()
+        self._blocked_until = 0.0
+        self._latency = None
+
+    def acquire(self):
+        """ Reserve the next request slot, returning how many seconds to wait before using it. """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            delay = max(0.0, -self._tokens / self.rate, self._blocked_until - now)
+
+        if delay:
+            self._logger.debug("Waiting %.2f seconds at %.2f requests/second", delay, self.rate)
+        return delay
+
+    def record_success(self, latency):
+        with self._lock:
+            average = self._latency if self._latency is not None else latency
+            self._latency = 0.8 * average + 0.2 * latency
+
+            if latency > self._slow_factor * average:
+                self._back_off("response took %.2f seconds, average is %.2f" % (latency, average))
+            elif self.rate < self._max_rate:
+                self.rate = min(self._max_rate, self.rate + self._increase)
+                self._logger.debug("Speeding up to %.2f requests/second", self.rate)
+
+    def record_failure(self, retry_after=None):
+        with self._lock:
+            self._back_off("request failed")
+
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, self._clock() + retry_after)
+                self._logger.info("Server asked us to retry after %.1f seconds", retry_after)
+
+    def backoff(self, retry):
+        """ Extra delay before retry number ``retry``, on top of the lowered rate. """
+        delay = min(self._backoff_cap, self._backoff_base * 2 ** retry)
+        return delay * (1.0 - 0.5 * self._random())
+
+    def _back_off(self, reason):
+        self.rate = max(self._min_rate, self.rate * self._decrease)
+        self._logger.info("Backing off to %.2f requests/second because %s", self.rate, reason)
+
+
+class FixedPauseRateLimiter(object):
+    """ Pause for ``pause_seconds`` before every ``requests_to_pause``-th request,
+    regardless of how the server responds. """
+
+    def __init__(self, pause_seconds=10, requests_to_pause=5, logger=None):
+        self._pause_seconds = pause_seconds
+        self._requests_to_pause = requests_to_pause
+        self._logger = logger or logging.getLogger('esridump')
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            request_number = next(self._counter)
+
+        if request_number % self._requests_to_pause == 0:
+            self._logger.info("pause for %s seconds", self._pause_seconds)
+            return self._pause_seconds
+        return 0.0
+
+    def record_success(self, latency):
+        pass
+
+    def record_failure(self, retry_after=None):
+        pass
+
+    def backoff(self, retry):
+        # increase the pause time every retry, to increase the probability of fetching data successfully
+        return self._pause_seconds * (retry + 1)
+
+
+class HostLimitedSession(object):
+    """ Wraps a requests.Session so at most ``limit`` requests at a time reach each host.
+
+    Pass one as ``session=`` to several dumpers to cap how hard they hit a
+    server between them, however many pages each has in flight.
+    """
+
+    def __init__(self, session, limit):
+        self._session = session
+        self._limit = limit
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self._limit)
+            return self._semaphores[host]
+
+    def request(self, method, url, **kwargs):
+        with self._semaphore(url):
+            return self._session.request(method, url, **kwargs)
+
+    def close(self):
+        self._session.close()
@@ -0,0 +1,150 @@
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from esridump.dumper import EsriDumper, _build_rate_limiter, _build_session, _sets_rate_limit
+from esridump.errors import EsriDownloadError
+from esridump.ratelimit import HostLimitedSession
+from esridump.writers import GeoJSONWriter, json_dumps
+
+
+# File extensions for each output format, without and with jsonlines
+_EXTENSIONS = {
+    'geojson': ('.geojson', '.geojsonl'),
+    'esrijson': ('.json', '.jsonl'),
+}
+
+
+def _layer_file_name(layer, jsonlines, output_format='geojson'):
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', layer.get('name') or '').strip('-').lower()
+    name = '{}-{}'.format(layer['id'], slug) if slug else str(layer['id'])
+    return name + _EXTENSIONS[output_format][jsonlines]
+
+
+class ServiceDumper(object):
+    """ Dumps every layer and table of a MapServer or FeatureServer.
+
+    The layer list and each layer's metadata come from the service's
+    ``/layers`` resource in one request, so layers don't look up their own.
+    Up to ``concurrency`` layers are dumped at once. They share one session,
+    which lets at most ``host_concurrency`` requests reach each host at a
+    time, and one rate limiter. Other keyword arguments are passed to each
+    layer's EsriDumper.
+    """
+
+    def __init__(self, url, concurrency=4, host_concurrency=8, parent_logger=None, **dumper_kwargs):
+        self._url = url.rstrip('/')
+        self._concurrency = max(1, concurrency or 1)
+        self._host_concurrency = max(1, host_concurrency or 1)
+        self._dumper_kwargs = dumper_kwargs
+        self._parent_logger = parent_logger
+        self._session = None
+        self._rate_limiter = None
+
+        if parent_logger:
+            self._logger = parent_logger.getChild('esridump')
+        else:
+            self._logger = logging.getLogger('esridump')
+
+        # The layers that failed in the last dump, by layer ID
+        self.errors = {}
+
+    def _get_session(self):
+        if self._session is None:
+            session = self._dumper_kwargs.get('session') or _build_session(self._host_concurrency)
+            self._session = HostLimitedSession(session, self._host_concurrency)
+        return self._session
+
+    def close(self):
+        if self._session is not None and not self._dumper_kwargs.get('session'):
+            self._session.close()
+        self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _dumper(self, url, **kwargs):
+        dumper_kwargs = dict(self._dumper_kwargs, session=self._get_session(), parent_logger=self._parent_logger)
+        if not _sets_rate_limit(dumper_kwargs):
+            # Every layer is on the same server, so they slow down together
+            if self._rate_limiter is None:
+                self._rate_limiter = _build_rate_limiter(self._logger)
+            dumper_kwargs['rate_limiter'] = self._rate_limiter
+        dumper_kwargs.update(kwargs)
+        return EsriDumper(url, **dumper_kwargs)
+
+    def get_layers(self):
+        """ Return the metadata of the service's layers and tables, leaving out group layers. """
+        try:
+            service = self._dumper(self._url + '/layers').get_metadata()
+        except EsriDownloadError:
+            # Servers before 10.1 have no /layers resource, so each layer will fetch its own metadata
+            self._logger.info("Service has no /layers resource, so reading the layer list from the service")
+            service = self._dumper(self._url).get_metadata()
+
+        layers = (service.get('layers') or []) + (service.get('tables') or [])
+        if not layers:
+            self._logger.warning("Service at %s lists no layers", self._url)
+
+        return [
+            layer for layer in layers
+            if not layer.get('subLayerIds') and layer.get('type') not in ('Group Layer', 'Raster Layer')
+        ]
+
+    def layer_dumper(self, layer):
+        """ Make the EsriDumper for one of the layers returned by get_layers. """
+        # Layers listed by the service itself have only a few keys, not the layer's full metadata
+        metadata = layer if 'fields' in layer else None
+        return self._dumper('{}/{}'.format(self._url, layer['id']), metadata=metadata)
+
+    def plans(self):
+        """ Return the QueryPlan of each layer, by layer ID. """
+        layers = self.get_layers()
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            plans = executor.map(lambda layer: self.layer_dumper(layer).plan(), layers)
+            return dict(zip([layer['id'] for layer in layers], plans))
+
+    def _dump_layer(self, layer, path, jsonlines, fast_json):
+        dumper = self.layer_dumper(layer)
+        self._logger.info("Dumping layer %s (%s) to %s", layer['id'], layer.get('name'), path)
+        with open(path, 'w') as f:
+            writer = GeoJSONWriter(f, jsonlines=jsonlines, dumps=json_dumps(fast=fast_json))
+            for page in dumper.iter_pages():
+                writer.write_page(page)
+            writer.close()
+        return path
+
+    def dump(self, output_dir, jsonlines=False, fast_json=False):
+        """ Write each layer to its own file in output_dir, returning the paths by layer ID.
+
+        A layer that fails doesn't stop the others. Its exception is kept in
+        ``errors`` and its partial output is removed.
+        """
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        layers = self.get_layers()
+        self.errors = {}
+        paths = {}
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            futures = []
+            for layer in layers:
+                path = os.path.join(output_dir, _layer_file_name(
+                    layer, jsonlines, self._dumper_kwargs.get('output_format') or 'geojson'))
+                futures.append((layer, path, executor.submit(self._dump_layer, layer, path, jsonlines, fast_json)))
+
+            for layer, path, future in futures:
+                try:
+                    paths[layer['id']] = future.result()
+                except Exception as e:
+                    self._logger.exception("Could not dump layer %s (%s)", layer['id'], layer.get('name'))
+                    self.errors[layer['id']] = e
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        self._logger.info("Dumped %s of %s layers", len(paths), len(layers))
+        return paths
@@ -0,0 +1,121 @@
+import json
+import os
+
+from esridump.compress import CompressedWriter, compression_for
+from esridump.writers import GeoJSONWriter, serialize_features
+
+
+def shard_path(path, index):
+    """ The path of a numbered shard of path, with the number before the extension and any compression extension. """
+    root, compression_extension = path, ''
+    if compression_for(path):
+        root, compression_extension = os.path.splitext(path)
+    root, extension = os.path.splitext(root)
+    return '{}-{:05d}{}{}'.format(root, index, extension, compression_extension)
+
+
+class ShardedWriter(object):
+    """ Writes pages of features across numbered files, each a complete FeatureCollection or jsonlines file.
+
+    A new shard starts once the current one has ``shard_size`` features,
+    or with ``by_bytes``, before it would grow past ``shard_size``
+    characters of serialized features. Each shard is compressed with
+    ``compress`` if given. When a shard is closed, a line with its path,
+    feature count and smallest and largest ``oid_field`` values is added
+    to the ``manifest`` file, so shards can be picked up while the rest
+    are still being written. The records are also kept in ``shards``.
+    """
+
+    def __init__(self, path, shard_size, by_bytes=False, jsonlines=False, dumps=json.dumps, oid_field=None,
+                 compress=None, manifest=None):
+        self._path = path
+        self._shard_size = shard_size
+        self._by_bytes = by_bytes
+        self._jsonlines = jsonlines
+        self._dumps = dumps
+        self._oid_field = oid_field
+        self._compress = compress
+        self._manifest = open(manifest, 'w') if manifest else None
+
+        self._file = None
+        self._writer = None
+        self._current = None
+        self._size = 0
+        self.shards = []
+
+    def _open_shard(self):
+        path = shard_path(self._path, len(self.shards))
+        if self._compress:
+            self._file = CompressedWriter(open(path, 'wb'), self._compress)
+        else:
+            self._file = open(path, 'w')
+        self._writer = GeoJSONWriter(self._file, jsonlines=self._jsonlines)
+        self._current = dict(path=path, features=0, min_oid=None, max_oid=None)
+        self._size = 0
+
+    def _close_shard(self):
+        self._writer.close()
+        self._file.close()
+        self.shards.append(self._current)
+
+        if self._manifest:
+            self._manifest.write(json.dumps(self._current) + '\n')
+            self._manifest.flush()
+        self._writer = self._file = self._current = None
+
+    def _is_full(self, size):
+        if not self._current['features']:
+            return False
+        if self._by_bytes:
+            return self._size + size > self._shard_size
+        return self._current['features'] >= self._shard_size
+
+    def _write_chunk(self, texts):
+        if texts:
+            self._writer.write_serialized(serialize_features(texts, self._jsonlines, dumps=str))
+
+    def _track_oid(self, feature):
+        attributes = feature.get('properties') or feature.get('attributes') or {}
+        oid = attributes.get(self._oid_field)
+        if oid is None:
+            return
+
+        current = self._current
+        if current['min_oid'] is None or oid < current['min_oid']:
+            current['min_oid'] = oid
+        if current['max_oid'] is None or oid > current['max_oid']:
+            current['max_oid'] = oid
+
+    def write_page(self, features):
+        dumps = self._dumps
+        texts = []
+
+        for feature in features:
+            text = dumps(feature)
+            # Count the separator that goes after the feature too
+            size = len(text) + 1
+
+            if self._writer is None:
+                self._open_shard()
+            elif self._is_full(size):
+                self._write_chunk(texts)
+                texts = []
+                self._close_shard()
+                self._open_shard()
+
+            texts.append(text)
+            self._current['features'] += 1
+            self._size += size
+            if self._oid_field:
+                self._track_oid(feature)
+
+        self._write_chunk(texts)
+
+    def close(self):
+        if self._writer is None and not self.shards:
+            # Output with no features is still one valid, empty shard
+            self._open_shard()
+        if self._writer is not None:
+            self._close_shard()
+        if self._manifest:
+            self._manifest.close()
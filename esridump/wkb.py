@@ -0,0 +1,178 @@
+import struct
+
+from esridump.esri2geojson import clean_esri_rings, group_esri_rings
+
+# Well-known binary geometry type codes. ISO WKB adds 1000 to these for
+# geometries with a Z coordinate.
+_WKB_TYPES = {
+    'Point': 1,
+    'LineString': 2,
+    'Polygon': 3,
+    'MultiPoint': 4,
+    'MultiLineString': 5,
+    'MultiPolygon': 6,
+    'GeometryCollection': 7,
+}
+
+# PostGIS extended WKB (EWKB) flags the type code instead of adding 1000
+_EWKB_Z = 0x80000000
+_EWKB_SRID = 0x20000000
+
+_NAN = float('nan')
+
+
+def _dimensions(coordinates):
+    """ The number of dimensions of the first position in nested GeoJSON coordinates. """
+    while coordinates and isinstance(coordinates[0], (list, tuple)):
+        coordinates = coordinates[0]
+    return 3 if len(coordinates) > 2 else 2
+
+
+def _header(geometry_type, dimensions, extended=False, srid=None):
+    if not extended:
+        return struct.pack('<BI', 1, _WKB_TYPES[geometry_type] + (1000 if dimensions == 3 else 0))
+
+    code = _WKB_TYPES[geometry_type] | (_EWKB_Z if dimensions == 3 else 0)
+    if srid is None:
+        return struct.pack('<BI', 1, code)
+    return struct.pack('<BII', 1, code | _EWKB_SRID, int(srid))
+
+
+def _position(position, dimensions):
+    if len(position) == dimensions:
+        return position
+    # Positions missing a Z take 0, and any values after Z are dropped
+    return (list(position) + [0.0])[:dimensions]
+
+
+def _points(positions, dimensions):
+    values = []
+    for position in positions:
+        values.extend(_position(position, dimensions))
+    return struct.pack('<I%dd' % len(values), len(positions), *values)
+
+
+def _encode(geometry_type, coordinates, dimensions, extended=False, srid=None):
+    header = _header(geometry_type, dimensions, extended, srid)
+    if geometry_type == 'Point':
+        if not coordinates:
+            # An empty point is written with NaN coordinates
+            return header + struct.pack('<%dd' % dimensions, *([_NAN] * dimensions))
+        return header + struct.pack('<%dd' % dimensions, *_position(coordinates, dimensions))
+    elif geometry_type == 'LineString':
+        return header + _points(coordinates, dimensions)
+    elif geometry_type == 'Polygon':
+        return header + struct.pack('<I', len(coordinates)) + b''.join(
+            _points(ring, dimensions) for ring in coordinates)
+
+    part_type = {'MultiPoint': 'Point', 'MultiLineString': 'LineString', 'MultiPolygon': 'Polygon'}[geometry_type]
+    return header + struct.pack('<I', len(coordinates)) + b''.join(
+        _encode(part_type, part, dimensions, extended) for part in coordinates)
+
+
+def geojson_to_wkb(geometry):
+    """ Encode a GeoJSON geometry as little-endian ISO well-known binary, or return None for no geometry.
+
+    Geometries whose first position has a third value are written with Z
+    coordinates. Positions with any further values, such as M, are cut to
+    the first three.
+    """
+    if not geometry:
+        return None
+
+    geometry_type = geometry['type']
+    if geometry_type == 'GeometryCollection':
+        parts = [geojson_to_wkb(part) for part in geometry['geometries']]
+        dimensions = 3 if any(struct.unpack('<I', part[1:5])[0] > 1000 for part in parts) else 2
+        return _header(geometry_type, dimensions) + struct.pack('<I', len(parts)) + b''.join(parts)
+
+    if geometry_type not in _WKB_TYPES:
+        raise ValueError("Can't encode {} geometries as WKB".format(geometry_type))
+
+    coordinates = geometry['coordinates']
+    return _encode(geometry_type, coordinates, _dimensions(coordinates))
+
+
+def esri_to_wkb(esri_geometry, srid=None, has_z=None):
+    """ Encode an Esri JSON geometry as little-endian WKB without making GeoJSON first, or return None for no geometry.
+
+    The geometry types, ring closing and grouping of holes into polygons
+    match what convert_esri_geometry makes. Esri query responses say
+    whether there are Z values on the feature set rather than on each
+    geometry, so pass the layer's ``hasZ`` as ``has_z``, which also keeps
+    the M values of a layer with only ``hasM`` from being taken for Z.
+    Without it, the geometry's own ``hasZ`` is used, and failing that a
+    geometry has a Z if its first position has three values. With an
+    ``srid``, PostGIS extended WKB (EWKB) carrying that SRID is written
+    instead of ISO WKB.
+    """
+    if not esri_geometry:
+        return None
+
+    extended = srid is not None
+    if has_z is not None:
+        dimensions = 3 if has_z else 2
+    elif 'hasZ' in esri_geometry or 'hasM' in esri_geometry:
+        dimensions = 3 if esri_geometry.get('hasZ') else 2
+    elif 'z' in esri_geometry:
+        dimensions = 3
+    else:
+        coordinates = esri_geometry.get('points') or esri_geometry.get('paths') or esri_geometry.get('rings') or []
+        dimensions = _dimensions(coordinates)
+
+    if 'x' in esri_geometry or 'y' in esri_geometry:
+        x, y = esri_geometry.get('x'), esri_geometry.get('y')
+        if not (x and y):
+            return None
+        return _encode('Point', [x, y, esri_geometry.get('z') or 0.0], dimensions, extended, srid)
+    elif 'points' in esri_geometry:
+        points = esri_geometry['points']
+        if len(points) == 1:
+            return _encode('Point', points[0], dimensions, extended, srid)
+        return _encode('MultiPoint', points, dimensions, extended, srid)
+    elif 'paths' in esri_geometry:
+        paths = esri_geometry['paths']
+        if len(paths) == 1:
+            return _encode('LineString', paths[0], dimensions, extended, srid)
+        return _encode('MultiLineString', paths, dimensions, extended, srid)
+    elif 'rings' in esri_geometry:
+        rings = clean_esri_rings(esri_geometry['rings'])
+        if not rings:
+            return None
+        polygons = [rings] if len(rings) == 1 else group_esri_rings(rings)
+        if len(polygons) == 1:
+            return _encode('Polygon', polygons[0], dimensions, extended, srid)
+        return _encode('MultiPolygon', polygons, dimensions, extended, srid)
+
+    return None
+
+
+def esri_envelope(esri_geometry):
+    """ Return the (min x, max x, min y, max y) of an Esri JSON geometry's coordinates, or None if it has none. """
+    if not esri_geometry:
+        return None
+
+    if 'x' in esri_geometry or 'y' in esri_geometry:
+        x, y = esri_geometry.get('x'), esri_geometry.get('y')
+        if not (x and y):
+            return None
+        return (x, x, y, y)
+
+    if 'points' in esri_geometry:
+        parts = [esri_geometry['points']]
+    else:
+        parts = esri_geometry.get('paths') or esri_geometry.get('rings') or []
+
+    min_x = min_y = float('inf')
+    max_x = max_y = float('-inf')
+    for part in parts:
+        if not part:
+            continue
+        xs = [position[0] for position in part]
+        ys = [position[1] for position in part]
+        min_x, max_x = min(min_x, min(xs)), max(max_x, max(xs))
+        min_y, max_y = min(min_y, min(ys)), max(max_y, max(ys))
+
+    if min_x > max_x:
+        return None
+    return (min_x, max_x, min_y, max_y)
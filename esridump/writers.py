@@ -0,0 +1,644 @@
+import datetime
+import json
+import sqlite3
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from esridump.wkb import esri_envelope, esri_to_wkb, geojson_to_wkb
+
+
+def json_dumps(fast=False):
+    """ Pick the function used to serialize each feature.
+
+    The standard library is the default because its output is what esri2geojson
+    has always written. ``fast=True`` uses orjson when it is installed, which
+    is several times faster but writes compact JSON with unescaped UTF-8.
+    """
+    if fast and orjson is not None:
+        return lambda feature: orjson.dumps(feature).decode('utf-8')
+    return json.dumps
+
+
+def serialize_features(features, jsonlines=False, dumps=json.dumps):
+    """ Serialize a page of GeoJSON features into the text GeoJSONWriter.write_serialized expects. """
+    if jsonlines:
+        return ''.join(dumps(feature) + '\n' for feature in features)
+    return ',\n'.join(dumps(feature) for feature in features)
+
+
+class GeoJSONWriter(object):
+    """ Writes pages of GeoJSON features as a FeatureCollection or as newline-delimited GeoJSON.
+
+    Each page is serialized into one string and written with a single call,
+    and pages bigger than ``buffer_size`` characters are written in pieces of
+    about that size, so memory stays bounded when pages are streamed.
+    """
+
+    def __init__(self, outfile, jsonlines=False, dumps=json.dumps, buffer_size=4 * 1024 * 1024):
+        self._outfile = outfile
+        self._jsonlines = jsonlines
+        self._dumps = dumps
+        self._buffer_size = buffer_size
+        self._first = True
+
+        if not jsonlines:
+            self._outfile.write('{"type":"FeatureCollection","features":[\n')
+
+    def write_page(self, features):
+        dumps = self._dumps
+        buffer = []
+        buffered = 0
+
+        for feature in features:
+            text = dumps(feature)
+            if self._jsonlines:
+                buffer.append(text)
+                buffer.append('\n')
+            else:
+                if not self._first:
+                    buffer.append(',\n')
+                buffer.append(text)
+            self._first = False
+
+            buffered += len(text)
+            if buffered >= self._buffer_size:
+                self._outfile.write(''.join(buffer))
+                buffer = []
+                buffered = 0
+
+        if buffer:
+            self._outfile.write(''.join(buffer))
+
+    def write_serialized(self, text):
+        """ Write a page already turned into text by serialize_features. """
+        if not text:
+            return
+
+        if not self._jsonlines and not self._first:
+            self._outfile.write(',\n')
+        self._outfile.write(text)
+        self._first = False
+
+    def close(self):
+        if not self._jsonlines:
+            self._outfile.write('\n]}')
+
+
+# The Arrow type of each kind of Esri field, by name of the pyarrow function that makes it
+_ARROW_TYPES = {
+    'esriFieldTypeSmallInteger': 'int16',
+    'esriFieldTypeInteger': 'int32',
+    'esriFieldTypeBigInteger': 'int64',
+    'esriFieldTypeOID': 'int64',
+    'esriFieldTypeSingle': 'float32',
+    'esriFieldTypeDouble': 'float64',
+    'esriFieldTypeBlob': 'binary',
+}
+
+
+def _arrow_schema_fields(fields):
+    """ Return (name, Arrow type) for each Esri field that becomes a column. Geometry and raster fields don't. """
+    columns = []
+    for field in fields:
+        field_type = field.get('type')
+        if field_type in ('esriFieldTypeGeometry', 'esriFieldTypeRaster'):
+            continue
+        if field_type == 'esriFieldTypeDate':
+            # Esri dates are milliseconds since the epoch, in UTC
+            arrow_type = pyarrow.timestamp('ms', tz='UTC')
+        else:
+            arrow_type = getattr(pyarrow, _ARROW_TYPES.get(field_type, 'string'))()
+        columns.append((field['name'], arrow_type))
+    return columns
+
+
+class GeoParquetWriter(object):
+    """ Writes pages of GeoJSON features to a GeoParquet file.
+
+    The columns come from the layer's ``fields`` metadata, plus a WKB
+    ``geometry`` column. Features are buffered until there are
+    ``row_group_size`` of them, then written as one row group, so memory is
+    bounded by one row group. Coordinates in ``srid`` 4326 are recorded as
+    the GeoParquet default (longitude/latitude). Other SRIDs are recorded as
+    an unknown CRS, because writing their PROJJSON would need pyproj.
+    Requires pyarrow.
+    """
+
+    def __init__(self, where, fields, srid=4326, row_group_size=10000):
+        if pyarrow is None:
+            raise ImportError("GeoParquetWriter requires pyarrow, install it with `pip install esridump[parquet]`")
+
+        self._columns = _arrow_schema_fields(fields)
+        self._row_group_size = row_group_size
+
+        geometry_column = dict(encoding='WKB', geometry_types=[])
+        if str(srid) != '4326':
+            geometry_column['crs'] = None
+        geo = dict(version='1.1.0', primary_column='geometry', columns=dict(geometry=geometry_column))
+        self._schema = pyarrow.schema(
+            [pyarrow.field(name, arrow_type) for name, arrow_type in self._columns] +
+            [pyarrow.field('geometry', pyarrow.binary())],
+            metadata={b'geo': json.dumps(geo).encode('utf-8')},
+        )
+        self._writer = pyarrow.parquet.ParquetWriter(where, self._schema)
+        self._buffers = [[] for _ in self._columns]
+        self._geometries = []
+
+    def write_page(self, features):
+        string_columns = [
+            i for i, (_, arrow_type) in enumerate(self._columns)
+            if arrow_type == pyarrow.string()
+        ]
+        names = [name for name, _ in self._columns]
+        buffers = self._buffers
+
+        for feature in features:
+            properties = feature.get('properties') or {}
+            for name, buffer in zip(names, buffers):
+                buffer.append(properties.get(name))
+            for i in string_columns:
+                value = buffers[i][-1]
+                if value is not None and not isinstance(value, str):
+                    buffers[i][-1] = str(value)
+            self._geometries.append(geojson_to_wkb(feature.get('geometry')))
+
+            if len(self._geometries) >= self._row_group_size:
+                self._write_row_group()
+
+    def _write_row_group(self):
+        if not self._geometries:
+            return
+
+        arrays = [
+            pyarrow.array(buffer, type=arrow_type)
+            for buffer, (_, arrow_type) in zip(self._buffers, self._columns)
+        ]
+        arrays.append(pyarrow.array(self._geometries, type=pyarrow.binary()))
+        self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self._schema))
+
+        # Emptied in place, since write_page holds on to the lists
+        for buffer in self._buffers:
+            del buffer[:]
+        del self._geometries[:]
+
+    def close(self):
+        self._write_row_group()
+        self._writer.close()
+
+
+# The PostgreSQL type of each kind of Esri field. Others are written as text.
+_POSTGRES_TYPES = {
+    'esriFieldTypeSmallInteger': 'smallint',
+    'esriFieldTypeInteger': 'integer',
+    'esriFieldTypeBigInteger': 'bigint',
+    'esriFieldTypeOID': 'bigint',
+    'esriFieldTypeSingle': 'real',
+    'esriFieldTypeDouble': 'double precision',
+    'esriFieldTypeDate': 'timestamptz',
+}
+
+_UNIX_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+# Binary timestamps count microseconds from 2000-01-01, Esri dates milliseconds from 1970-01-01
+_POSTGRES_EPOCH_MS = 946684800000
+
+_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+
+_COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _copy_text_value(postgres_type):
+    """ The function that writes a value of a column as COPY text. """
+    if postgres_type in ('smallint', 'integer', 'bigint'):
+        return lambda value: str(int(value))
+    elif postgres_type in ('real', 'double precision'):
+        return lambda value: repr(float(value))
+    elif postgres_type == 'timestamptz':
+        return lambda value: (_UNIX_EPOCH + datetime.timedelta(milliseconds=value)).isoformat()
+    return lambda value: str(value).translate(_COPY_TEXT_ESCAPES)
+
+
+def _copy_binary_value(postgres_type):
+    """ The function that writes a value of a column in the COPY binary format, without its length. """
+    packers = {
+        'smallint': struct.Struct('>h'),
+        'integer': struct.Struct('>i'),
+        'bigint': struct.Struct('>q'),
+        'real': struct.Struct('>f'),
+        'double precision': struct.Struct('>d'),
+    }
+    if postgres_type in ('smallint', 'integer', 'bigint'):
+        pack = packers[postgres_type].pack
+        return lambda value: pack(int(value))
+    elif postgres_type in ('real', 'double precision'):
+        pack = packers[postgres_type].pack
+        return lambda value: pack(float(value))
+    elif postgres_type == 'timestamptz':
+        pack = packers['bigint'].pack
+        return lambda value: pack(int(value - _POSTGRES_EPOCH_MS) * 1000)
+    return lambda value: str(value).encode('utf-8')
+
+
+def _quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _quote_table(name):
+    """ Quote a table name that may have a schema in front. """
+    return '.'.join(_quote_identifier(part) for part in name.split('.'))
+
+
+class PostGISCopyWriter(object):
+    """ Writes pages of Esri JSON features as PostgreSQL ``COPY ... FROM STDIN`` data.
+
+    Each feature's geometry is encoded straight to EWKB with ``srid``, and
+    its attributes are typed from the layer's ``fields`` metadata, so
+    nothing passes through GeoJSON. The columns are the fields in order,
+    without geometry and raster fields, then ``geometry``. Text COPY goes to
+    a text file, and ``binary=True`` writes the binary format to a binary
+    file. Given a ``table``, text output is a psql script that creates the
+    table and copies into it. Geometries have Z values when ``has_z``, the
+    layer's ``hasZ``, is set.
+    """
+
+    def __init__(self, outfile, fields, srid=4326, binary=False, table=None, has_z=False):
+        if binary and table:
+            raise ValueError("Only text COPY output can include the table")
+
+        self._outfile = outfile
+        self._srid = srid
+        self._binary = binary
+        self._table = table
+        self._has_z = has_z
+        self._columns = [
+            (field['name'], _POSTGRES_TYPES.get(field.get('type'), 'text'))
+            for field in fields
+            if field.get('type') not in ('esriFieldTypeGeometry', 'esriFieldTypeRaster')
+        ]
+
+        to_value = _copy_binary_value if binary else _copy_text_value
+        self._encoders = [(name, to_value(postgres_type)) for name, postgres_type in self._columns]
+
+        if binary:
+            self._outfile.write(_COPY_SIGNATURE)
+        elif table:
+            self._outfile.write(self.create_table_sql(table) + ';\n' + self.copy_sql(table) + ';\n')
+
+    def create_table_sql(self, table):
+        columns = ['{} {}'.format(_quote_identifier(name), postgres_type) for name, postgres_type in self._columns]
+        # PostGIS won't take geometries with a Z in a column without one
+        geometry_type = 'GeometryZ' if self._has_z else 'Geometry'
+        columns.append('geometry geometry({}, {})'.format(geometry_type, int(self._srid)))
+        return 'CREATE TABLE {} (\n    {}\n)'.format(_quote_table(table), ',\n    '.join(columns))
+
+    def copy_sql(self, table):
+        columns = [_quote_identifier(name) for name, _ in self._columns] + ['geometry']
+        return 'COPY {} ({}) FROM STDIN{}'.format(
+            _quote_table(table), ', '.join(columns), ' WITH (FORMAT binary)' if self._binary else '')
+
+    def write_page(self, features):
+        if self._binary:
+            self._outfile.write(self._binary_rows(features))
+        else:
+            self._outfile.write(self._text_rows(features))
+
+    def _text_rows(self, features):
+        encoders = self._encoders
+        srid = self._srid
+        has_z = self._has_z
+        lines = []
+        for feature in features:
+            attributes = feature.get('attributes') or {}
+            values = []
+            for name, encode in encoders:
+                value = attributes.get(name)
+                values.append('\\N' if value is None else encode(value))
+            geometry = esri_to_wkb(feature.get('geometry'), srid=srid, has_z=has_z)
+            values.append('\\N' if geometry is None else geometry.hex())
+            lines.append('\t'.join(values) + '\n')
+        return ''.join(lines)
+
+    def _binary_rows(self, features):
+        encoders = self._encoders
+        srid = self._srid
+        has_z = self._has_z
+        tuple_header = struct.pack('>h', len(encoders) + 1)
+        null = struct.pack('>i', -1)
+        length = struct.Struct('>i').pack
+        buffer = []
+        for feature in features:
+            attributes = feature.get('attributes') or {}
+            buffer.append(tuple_header)
+            for name, encode in encoders:
+                value = attributes.get(name)
+                if value is None:
+                    buffer.append(null)
+                else:
+                    value = encode(value)
+                    buffer.append(length(len(value)))
+                    buffer.append(value)
+            geometry = esri_to_wkb(feature.get('geometry'), srid=srid, has_z=has_z)
+            if geometry is None:
+                buffer.append(null)
+            else:
+                buffer.append(length(len(geometry)))
+                buffer.append(geometry)
+        return b''.join(buffer)
+
+    def close(self):
+        if self._binary:
+            self._outfile.write(struct.pack('>h', -1))
+        elif self._table:
+            self._outfile.write('\\.\n')
+
+
+# The GeoPackage column type of each kind of Esri field. Others are written as TEXT.
+_GEOPACKAGE_TYPES = {
+    'esriFieldTypeSmallInteger': 'SMALLINT',
+    'esriFieldTypeInteger': 'MEDIUMINT',
+    'esriFieldTypeBigInteger': 'INTEGER',
+    'esriFieldTypeOID': 'INTEGER',
+    'esriFieldTypeSingle': 'FLOAT',
+    'esriFieldTypeDouble': 'DOUBLE',
+    'esriFieldTypeDate': 'DATETIME',
+}
+
+_GEOPACKAGE_APPLICATION_ID = 0x47504B47  # "GPKG"
+_GEOPACKAGE_VERSION = 10300
+
+_GEOPACKAGE_TABLES = """
+CREATE TABLE gpkg_spatial_ref_sys (
+    srs_name TEXT NOT NULL,
+    srs_id INTEGER PRIMARY KEY,
+    organization TEXT NOT NULL,
+    organization_coordsys_id INTEGER NOT NULL,
+    definition TEXT NOT NULL,
+    description TEXT
+);
+CREATE TABLE gpkg_contents (
+    table_name TEXT NOT NULL PRIMARY KEY,
+    data_type TEXT NOT NULL,
+    identifier TEXT UNIQUE,
+    description TEXT DEFAULT '',
+    last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+    min_x DOUBLE,
+    min_y DOUBLE,
+    max_x DOUBLE,
+    max_y DOUBLE,
+    srs_id INTEGER,
+    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id)
+);
+CREATE TABLE gpkg_geometry_columns (
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    geometry_type_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL,
+    z TINYINT NOT NULL,
+    m TINYINT NOT NULL,
+    CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+    CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+    CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id)
+);
+CREATE TABLE gpkg_extensions (
+    table_name TEXT,
+    column_name TEXT,
+    extension_name TEXT NOT NULL,
+    definition TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name)
+);
+INSERT INTO gpkg_spatial_ref_sys VALUES
+    ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+    ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system'),
+    ('WGS 84 geodetic', 4326, 'EPSG', 4326,
+     'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],' ||
+     'AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],' ||
+     'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]',
+     'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid');
+"""
+
+# The triggers the GeoPackage R-tree extension uses to keep the index up to date, from the GeoPackage
+# specification. {t} is the table, {c} the geometry column, {i} the primary key and {r} the R-tree,
+# and {trigger} the unquoted R-tree name the trigger names start with.
+_GEOPACKAGE_RTREE_TRIGGERS = """
+CREATE TRIGGER "{trigger}_insert" AFTER INSERT ON {t}
+  WHEN (new.{c} NOT NULL AND NOT ST_IsEmpty(NEW.{c}))
+BEGIN
+  INSERT OR REPLACE INTO {r} VALUES (
+    NEW.{i}, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), ST_MinY(NEW.{c}), ST_MaxY(NEW.{c}));
+END;
+CREATE TRIGGER "{trigger}_update1" AFTER UPDATE OF {c} ON {t}
+  WHEN OLD.{i} = NEW.{i} AND (NEW.{c} NOTNULL AND NOT ST_IsEmpty(NEW.{c}))
+BEGIN
+  INSERT OR REPLACE INTO {r} VALUES (
+    NEW.{i}, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), ST_MinY(NEW.{c}), ST_MaxY(NEW.{c}));
+END;
+CREATE TRIGGER "{trigger}_update2" AFTER UPDATE OF {c} ON {t}
+  WHEN OLD.{i} = NEW.{i} AND (NEW.{c} ISNULL OR ST_IsEmpty(NEW.{c}))
+BEGIN
+  DELETE FROM {r} WHERE id = OLD.{i};
+END;
+CREATE TRIGGER "{trigger}_update3" AFTER UPDATE ON {t}
+  WHEN OLD.{i} != NEW.{i} AND (NEW.{c} NOTNULL AND NOT ST_IsEmpty(NEW.{c}))
+BEGIN
+  DELETE FROM {r} WHERE id = OLD.{i};
+  INSERT OR REPLACE INTO {r} VALUES (
+    NEW.{i}, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), ST_MinY(NEW.{c}), ST_MaxY(NEW.{c}));
+END;
+CREATE TRIGGER "{trigger}_update4" AFTER UPDATE ON {t}
+  WHEN OLD.{i} != NEW.{i} AND (NEW.{c} ISNULL OR ST_IsEmpty(NEW.{c}))
+BEGIN
+  DELETE FROM {r} WHERE id IN (OLD.{i}, NEW.{i});
+END;
+CREATE TRIGGER "{trigger}_delete" AFTER DELETE ON {t}
+  WHEN old.{c} NOT NULL
+BEGIN
+  DELETE FROM {r} WHERE id = OLD.{i};
+END;
+"""
+
+# GeoPackage geometry header: magic, version 0, then flags for little-endian with an XY envelope
+_GEOPACKAGE_HEADER = struct.Struct('<2sBBi4d')
+# The header of an empty geometry has the empty flag set and no envelope
+_GEOPACKAGE_EMPTY_HEADER = struct.pack('<2sBB', b'GP', 0, 0b10001)
+
+
+def _geopackage_datetime(value):
+    moment = _UNIX_EPOCH + datetime.timedelta(milliseconds=value)
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(moment.microsecond // 1000)
+
+
+class GeoPackageWriter(object):
+    """ Writes pages of Esri JSON features to a table in a new GeoPackage file.
+
+    The columns are typed from the layer's ``fields`` metadata, after a
+    ``fid`` primary key numbering the rows. Object IDs are kept in their
+    own column, since servers don't always keep them unique. Rows go in
+    through one prepared statement, in transactions of at least
+    ``transaction_size`` rows. The R-tree spatial index is filled
+    in one pass by ``close()``, from envelopes kept in a temporary table,
+    and its triggers are only created then because they call spatial
+    functions the sqlite3 module doesn't have. SRIDs other than 4326 are
+    recorded with an undefined definition. With ``has_z``, from the layer's
+    ``hasZ``, the geometry column and its geometries have Z values.
+    """
+
+    def __init__(self, path, fields, table='features', srid=4326, geometry_type='GEOMETRY', has_z=False,
+                 transaction_size=50000):
+        self._table = table
+        self._srid = int(srid)
+        self._has_z = has_z
+        self._transaction_size = transaction_size
+        self._geometry_column = 'geom'
+        self._bounds = None
+        self._rows_in_transaction = 0
+        self._next_fid = 1
+
+        self._fields = [
+            field for field in fields
+            if field.get('type') not in ('esriFieldTypeGeometry', 'esriFieldTypeRaster')
+        ]
+        self._date_indexes = [
+            i for i, field in enumerate(self._fields) if field.get('type') == 'esriFieldTypeDate'
+        ]
+
+        self._connection = sqlite3.connect(path, isolation_level=None)
+        cursor = self._connection.cursor()
+        # A partial file is thrown away, so there's nothing to gain from syncing each transaction to disk
+        cursor.execute('PRAGMA synchronous = OFF')
+        cursor.execute('PRAGMA application_id = {}'.format(_GEOPACKAGE_APPLICATION_ID))
+        cursor.execute('PRAGMA user_version = {}'.format(_GEOPACKAGE_VERSION))
+
+        cursor.execute('BEGIN')
+        for statement in _GEOPACKAGE_TABLES.split(';\n'):
+            if statement.strip():
+                cursor.execute(statement)
+        if self._srid not in (-1, 0, 4326):
+            cursor.execute(
+                'INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)',
+                ('EPSG:{}'.format(self._srid), self._srid, 'EPSG', self._srid, 'undefined', None))
+
+        definitions = [
+            'fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL',
+            '{} {}'.format(_quote_identifier(self._geometry_column), geometry_type),
+        ] + [
+            '{} {}'.format(_quote_identifier(field['name']), _GEOPACKAGE_TYPES.get(field.get('type'), 'TEXT'))
+            for field in self._fields
+        ]
+        cursor.execute('CREATE TABLE {} ({})'.format(_quote_identifier(table), ', '.join(definitions)))
+        cursor.execute(
+            'INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, ?, ?, ?)',
+            (table, 'features', table, self._srid))
+        cursor.execute(
+            'INSERT INTO gpkg_geometry_columns VALUES (?, ?, ?, ?, ?, ?)',
+            (table, self._geometry_column, geometry_type, self._srid, 2 if has_z else 0, 0))
+        cursor.execute(
+            'CREATE TEMP TABLE envelopes (id INTEGER, min_x DOUBLE, max_x DOUBLE, min_y DOUBLE, max_y DOUBLE)')
+
+        column_names = ['fid', self._geometry_column] + [field['name'] for field in self._fields]
+        self._insert = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            _quote_identifier(table),
+            ', '.join(_quote_identifier(name) for name in column_names),
+            ', '.join('?' * len(column_names)))
+
+    def _extend_bounds(self, envelopes):
+        min_x = min(envelope[1] for envelope in envelopes)
+        max_x = max(envelope[2] for envelope in envelopes)
+        min_y = min(envelope[3] for envelope in envelopes)
+        max_y = max(envelope[4] for envelope in envelopes)
+        if self._bounds:
+            min_x, max_x = min(min_x, self._bounds[0]), max(max_x, self._bounds[1])
+            min_y, max_y = min(min_y, self._bounds[2]), max(max_y, self._bounds[3])
+        self._bounds = (min_x, max_x, min_y, max_y)
+
+    def write_page(self, features):
+        names = [field['name'] for field in self._fields]
+        date_indexes = self._date_indexes
+        srid = self._srid
+        has_z = self._has_z
+        pack_header = _GEOPACKAGE_HEADER.pack
+        empty_header = _GEOPACKAGE_EMPTY_HEADER + struct.pack('<i', srid)
+
+        rows = []
+        envelopes = []
+        for feature in features:
+            attributes = feature.get('attributes') or {}
+            fid = self._next_fid
+            self._next_fid += 1
+
+            esri_geometry = feature.get('geometry')
+            geometry = esri_to_wkb(esri_geometry, has_z=has_z)
+            if geometry is not None:
+                envelope = esri_envelope(esri_geometry)
+                if envelope is None:
+                    # Geometries with no coordinates, like an empty multipoint, stay out of the spatial index
+                    geometry = empty_header + geometry
+                else:
+                    geometry = pack_header(b'GP', 0, 0b011, srid, *envelope) + geometry
+                    envelopes.append((fid,) + envelope)
+
+            values = [fid, geometry]
+            values.extend(attributes.get(name) for name in names)
+            for i in date_indexes:
+                if values[i + 2] is not None:
+                    values[i + 2] = _geopackage_datetime(values[i + 2])
+            rows.append(values)
+
+        if not rows:
+            return
+
+        cursor = self._connection.cursor()
+        if not self._connection.in_transaction:
+            cursor.execute('BEGIN')
+        cursor.executemany(self._insert, rows)
+        if envelopes:
+            cursor.executemany('INSERT INTO temp.envelopes VALUES (?, ?, ?, ?, ?)', envelopes)
+            self._extend_bounds(envelopes)
+
+        self._rows_in_transaction += len(rows)
+        if self._rows_in_transaction >= self._transaction_size:
+            cursor.execute('COMMIT')
+            self._rows_in_transaction = 0
+
+    def _create_spatial_index(self, cursor):
+        table, column = self._table, self._geometry_column
+        rtree = 'rtree_{}_{}'.format(table, column)
+        cursor.execute('CREATE VIRTUAL TABLE {} USING rtree(id, minx, maxx, miny, maxy)'.format(
+            _quote_identifier(rtree)))
+        cursor.execute('INSERT INTO {} SELECT * FROM temp.envelopes'.format(_quote_identifier(rtree)))
+        cursor.execute('DROP TABLE temp.envelopes')
+        cursor.execute(
+            'INSERT INTO gpkg_extensions VALUES (?, ?, ?, ?, ?)',
+            (table, column, 'gpkg_rtree_index', 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only'))
+
+        triggers = _GEOPACKAGE_RTREE_TRIGGERS.format(
+            trigger=rtree.replace('"', '""'),
+            t=_quote_identifier(table),
+            c=_quote_identifier(column),
+            i='fid',
+            r=_quote_identifier(rtree))
+        for statement in triggers.split('END;'):
+            if statement.strip():
+                cursor.execute(statement + 'END;')
+
+    def close(self):
+        cursor = self._connection.cursor()
+        if not self._connection.in_transaction:
+            cursor.execute('BEGIN')
+        self._create_spatial_index(cursor)
+        if self._bounds:
+            min_x, max_x, min_y, max_y = self._bounds
+            cursor.execute(
+                'UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ? WHERE table_name = ?',
+                (min_x, min_y, max_x, max_y, self._table))
+        cursor.execute('COMMIT')
+        self._connection.close()
@@ -21,6 +21,12 @@ setup(
         'requests',
         'six',
     ],
+    extras_require={
+        'async': ['httpx'],
+        'fast': ['orjson'],
+        'parquet': ['pyarrow'],
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': ['esri2geojson=esridump.cli:main'],
     }
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import unittest
+from six.moves.urllib.parse import parse_qs
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from esridump.errors import EsriDownloadError
+
+
+def read_fixture(file):
+    with open(os.path.join('tests/fixtures', file), 'rb') as f:
+        return f.read()
+
+
+@unittest.skipIf(httpx is None, "httpx is not installed")
+class TestAsyncEsriDownload(unittest.TestCase):
+    def setUp(self):
+        self.fake_url = 'http://example.com'
+        self.requests = []
+
+    def dump(self, handler, follow_redirects=False, **kwargs):
+        from esridump.aio import AsyncEsriDumper
+
+        def record(request):
+            self.requests.append(request)
+            return handler(request)
+
+        async def collect():
+            client = httpx.AsyncClient(transport=httpx.MockTransport(record), follow_redirects=follow_redirects)
+            async with client:
+                dumper = AsyncEsriDumper(self.fake_url, client=client, **kwargs)
+                return [feature async for feature in dumper]
+
+        return asyncio.run(collect())
+
+    def carson_handler(self, request):
+        query = parse_qs(request.url.query.decode())
+        if request.method == 'POST':
+            return httpx.Response(200, content=read_fixture('us-ca-carson/us-ca-carson-0.json'))
+        elif query.get('returnCountOnly') == ['true']:
+            return httpx.Response(200, content=read_fixture('us-ca-carson/us-ca-carson-count-only.json'))
+        elif query.get('returnIdsOnly') == ['true']:
+            return httpx.Response(200, content=read_fixture('us-ca-carson/us-ca-carson-ids-only.json'))
+        return httpx.Response(200, content=read_fixture('us-ca-carson/us-ca-carson-metadata.json'))
+
+    def test_object_id_enumeration(self):
+        data = self.dump(self.carson_handler)
+
+        self.assertEqual(6, len(data))
+        self.assertEqual('Feature', data[0]['type'])
+        self.assertEqual(['GET', 'GET', 'GET', 'POST'], [r.method for r in self.requests])
+
+    def test_concurrent_pages_are_yielded_in_order(self):
+        oids = list(range(1, 10))
+
+        def handler(request):
+            query = parse_qs(request.url.query.decode())
+            if request.method == 'POST':
+                where = parse_qs(request.content.decode())['where'][0]
+                page_min, page_max = [int(t) for t in where.split() if t.isdigit()]
+                features = [
+                    {'attributes': {'OBJECTID': oid}, 'geometry': {'x': oid, 'y': oid}}
+                    for oid in oids
+                    if page_min <= oid <= page_max
+                ]
+                return httpx.Response(200, json={'features': features})
+            elif query.get('returnCountOnly') == ['true']:
+                return httpx.Response(200, json={'count': len(oids)})
+            elif query.get('returnIdsOnly') == ['true']:
+                return httpx.Response(200, json={'objectIds': oids})
+            return httpx.Response(200, json={
+                'objectIdField': 'OBJECTID',
+                'maxRecordCount': 2,
+                'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}],
+            })
+
+        data = self.dump(handler, max_page_size=1, concurrency=3, pause_seconds=0)
+
+        self.assertEqual(oids, [f['properties']['OBJECTID'] for f in data])
+
+    def test_esri_error_is_raised(self):
+        def handler(request):
+            if request.method == 'POST':
+                return httpx.Response(200, json={'error': {'message': 'Nope', 'details': ['Broken']}})
+            return self.carson_handler(request)
+
+        with self.assertRaisesRegex(EsriDownloadError, "Could not connect to URL"):
+            self.dump(handler, pause_seconds=0, num_of_retry=2)
+
+    def test_timeouts_are_retried(self):
+        timed_out = []
+
+        def handler(request):
+            if request.method == 'POST' and not timed_out:
+                timed_out.append(request)
+                raise httpx.ReadTimeout("The server is slow", request=request)
+            return self.carson_handler(request)
+
+        data = self.dump(handler, pause_seconds=0)
+
+        self.assertEqual(6, len(data))
+        self.assertEqual(2, sum(1 for r in self.requests if r.method == 'POST'))
+
+    def test_redirects_are_followed(self):
+        def handler(request):
+            if request.url.scheme == 'http':
+                # A 301 would turn a POST into a GET, so queries are moved with a 308
+                status = 301 if request.method == 'GET' else 308
+                return httpx.Response(status, headers={'Location': str(request.url.copy_with(scheme='https'))})
+            return self.carson_handler(request)
+
+        data = self.dump(handler, follow_redirects=True)
+
+        self.assertEqual(6, len(data))
+
+    def test_own_client_follows_redirects(self):
+        from esridump.aio import AsyncEsriDumper
+
+        async def client_settings():
+            dumper = AsyncEsriDumper(self.fake_url)
+            client = dumper._get_client()
+            await dumper.aclose()
+            return client.follow_redirects
+
+        self.assertTrue(asyncio.run(client_settings()))
@@ -0,0 +1,122 @@
+import json
+import os
+import re
+import responses
+import shutil
+import tempfile
+import unittest
+
+from esridump.batch import BatchDumper, ManifestEntry, _HostScheduler, read_manifest
+
+
+def entry(url, outfile='out.geojson', params=None):
+    return ManifestEntry(url, outfile, params or {}, {})
+
+
+class TestHostScheduler(unittest.TestCase):
+    def test_hosts_take_turns_within_their_limit(self):
+        entries = [
+            entry('http://a.example.com/0'),
+            entry('http://a.example.com/1'),
+            entry('http://a.example.com/2'),
+            entry('http://b.example.com/0'),
+        ]
+        scheduler = _HostScheduler(entries, 2)
+
+        self.assertEqual(0, scheduler.next_entry())
+        # b goes next even though a has entries waiting ahead of it
+        self.assertEqual(3, scheduler.next_entry())
+        self.assertEqual(1, scheduler.next_entry())
+
+        # a is at its limit until one of its entries finishes
+        scheduler.entry_done(0)
+        self.assertEqual(2, scheduler.next_entry())
+        self.assertIsNone(scheduler.next_entry())
+
+
+class TestBatchDumper(unittest.TestCase):
+    def setUp(self):
+        self.responses = responses.RequestsMock()
+        self.responses.start()
+
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.responses.stop()
+        self.responses.reset()
+        shutil.rmtree(self.tmpdir)
+
+    def add_layer(self, host, oids):
+        self.responses.add(
+            method='GET',
+            url=re.compile(r'http://{}/.*/\?f=json.*'.format(re.escape(host))),
+            json={
+                'objectIdField': 'OBJECTID',
+                'maxRecordCount': 1000,
+                'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}],
+            },
+            match_querystring=True,
+        )
+        self.responses.add(
+            method='GET',
+            url=re.compile(r'http://{}/.*returnCountOnly=true.*'.format(re.escape(host))),
+            json={'count': len(oids)},
+            match_querystring=True,
+        )
+        self.responses.add(
+            method='GET',
+            url=re.compile(r'http://{}/.*returnIdsOnly=true.*'.format(re.escape(host))),
+            json={'objectIds': oids},
+            match_querystring=True,
+        )
+        self.responses.add(
+            method='POST',
+            url=re.compile(r'http://{}/.*query.*'.format(re.escape(host))),
+            json={'features': [{'attributes': {'OBJECTID': oid}} for oid in oids]},
+        )
+
+    def test_manifest(self):
+        path = os.path.join(self.tmpdir, 'manifest.jsonl')
+        with open(path, 'w') as f:
+            f.write('# Nightly layers\n')
+            f.write('{"url": "http://a.example.com/0/", "outfile": "a.geojson", "params": {"token": "x"}}\n')
+            f.write('\n')
+            f.write('{"url": "http://b.example.com/0/", "outfile": "b.geojson"}\n')
+
+        self.assertEqual([
+            ManifestEntry('http://a.example.com/0/', 'a.geojson', {'token': 'x'}, {}),
+            ManifestEntry('http://b.example.com/0/', 'b.geojson', {}, {}),
+        ], read_manifest(path))
+
+    def test_invalid_manifest_line(self):
+        path = os.path.join(self.tmpdir, 'manifest.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"url": "http://a.example.com/0/"}\n')
+
+        with self.assertRaisesRegex(ValueError, 'Line 1'):
+            read_manifest(path)
+
+    def test_run_reports_each_entry(self):
+        self.add_layer('a.example.com', [1, 2, 3])
+        self.add_layer('b.example.com', [4])
+        self.responses.add(method='GET', url=re.compile(r'http://c\.example\.com/.*'), status=404)
+        entries = [
+            entry('http://a.example.com/0/', os.path.join(self.tmpdir, 'a', 'a.geojson'), {'token': 'x'}),
+            entry('http://b.example.com/0/', os.path.join(self.tmpdir, 'b.geojson')),
+            entry('http://c.example.com/0/', os.path.join(self.tmpdir, 'c.geojson')),
+        ]
+
+        with BatchDumper(entries, workers=2, pause_seconds=0, num_of_retry=1) as batch:
+            report = batch.run()
+
+        self.assertEqual(['ok', 'ok', 'failed'], [result['status'] for result in report])
+        self.assertEqual([3, 1, 0], [result['features'] for result in report])
+        self.assertIn('error', report[2])
+        with open(entries[0].outfile) as f:
+            self.assertEqual(3, len(json.load(f)['features']))
+        self.assertFalse(os.path.exists(entries[2].outfile))
+        self.assertTrue(all(
+            'token=x' in call.request.url or 'token=x' in (call.request.body or '')
+            for call in self.responses.calls
+            if 'a.example.com' in call.request.url
+        ))
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from esridump.cache import ResponseCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.clock = FakeClock()
+        self.path = os.path.join(self.tmpdir, 'cache.sqlite')
+
+    def make_cache(self, **kwargs):
+        cache = ResponseCache(self.path, clock=self.clock, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_key_ignores_argument_order(self):
+        cache = self.make_cache()
+
+        self.assertEqual(
+            cache.key('GET', 'http://example.com/query', params={'f': 'json', 'where': '1=1'}),
+            cache.key('get', 'http://example.com/query', params={'where': '1=1', 'f': 'json'}),
+        )
+        self.assertNotEqual(
+            cache.key('GET', 'http://example.com/query', params={'where': '1=1'}),
+            cache.key('POST', 'http://example.com/query', data={'where': '1=1'}),
+        )
+
+    def test_round_trip_survives_reopening(self):
+        cache = self.make_cache()
+        cache.put('a', b'{"features": []}')
+        cache.close()
+
+        cache = self.make_cache()
+        self.assertEqual(b'{"features": []}', cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_expired_entries_are_ignored(self):
+        cache = self.make_cache(ttl=60)
+        cache.put('a', b'{}')
+
+        self.clock.now += 30
+        self.assertEqual(b'{}', cache.get('a'))
+        self.clock.now += 31
+        self.assertIsNone(cache.get('a'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        body = os.urandom(1000)
+        cache = self.make_cache(max_size=2500)
+
+        cache.put('a', body)
+        self.clock.now += 1
+        cache.put('b', body)
+        self.clock.now += 1
+        cache.get('a')
+        self.clock.now += 1
+        cache.put('c', body)
+
+        self.assertEqual(body, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(body, cache.get('c'))
+
+    def test_eviction_reads_a_few_entries_at_a_time(self):
+        # Room for exactly 100 entries
+        cache = self.make_cache(max_size=100 * len(zlib.compress(b'{}', 6)))
+        for i in range(100):
+            self.clock.now += 1
+            cache.put(str(i), b'{}')
+
+        statements = []
+        cache._db.set_trace_callback(statements.append)
+        self.clock.now += 1
+        cache.put('new', b'{}')
+
+        self.assertIn('LIMIT 16', ' '.join(statements))
+        self.assertIsNone(cache.get('0'))
+        self.assertEqual(b'{}', cache.get('1'))
+        self.assertEqual(b'{}', cache.get('new'))
@@ -1,11 +1,19 @@
+import argparse
+import gzip
+import io
+import json
 import logging
 import mock
 import os
 import re
 import responses
+import shutil
+import sqlite3
+import tempfile
 import unittest
 
 import esridump.cli
+from esridump.esri2geojson import esri2geojson
 
 class TestEsriDumpCommandlineHelpers(unittest.TestCase):
     def test_collect_headers(self):
@@ -24,6 +32,75 @@ class TestEsriDumpCommandlineHelpers(unittest.TestCase):
             }
         )
 
+    def test_resume_requires_jsonlines(self):
+        with self.assertRaises(SystemExit):
+            esridump.cli._parse_args(['http://example.com', '-', '--checkpoint', 'x', '--resume'])
+
+    def test_resume_appends_when_checkpoint_exists(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        outfile = os.path.join(tmpdir, 'out.geojsonl')
+
+        args = esridump.cli._parse_args(['http://example.com', outfile, '--jsonlines', '--resume'])
+        args.outfile.close()
+        self.assertEqual(outfile + '.checkpoint', args.checkpoint)
+        self.assertEqual('w', args.outfile.mode)
+
+        open(args.checkpoint, 'w').close()
+        args = esridump.cli._parse_args(['http://example.com', outfile, '--jsonlines', '--resume'])
+        args.outfile.close()
+        self.assertEqual('a', args.outfile.mode)
+
+    def test_compression_follows_the_outfile_extension(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        outfile = os.path.join(tmpdir, 'out.geojsonl.gz')
+
+        args = esridump.cli._parse_args(['http://example.com', outfile, '--jsonlines'])
+        self.assertEqual('gzip', args.compress)
+        args.outfile.write('{"type":"Feature"}\n')
+        args.outfile.close()
+        with gzip.open(outfile, 'rt') as f:
+            self.assertEqual('{"type":"Feature"}\n', f.read())
+
+        with self.assertRaises(SystemExit):
+            esridump.cli._parse_args(['http://example.com', outfile, '--jsonlines', '--resume'])
+
+    def test_shard_size(self):
+        self.assertEqual((100000, False), esridump.cli._shard_size('100000'))
+        self.assertEqual((512 * 1024 * 1024, True), esridump.cli._shard_size('512MB'))
+        self.assertEqual((1536 * 1024 * 1024, True), esridump.cli._shard_size('1.5gb'))
+
+        args = esridump.cli._parse_args(['http://example.com', 'out.geojson', '--shard-size', '1000'])
+        self.assertEqual('out.geojson', args.outfile)
+        self.assertEqual('out.geojson.shards.jsonl', args.shard_manifest)
+
+        for bad_args in (['--shard-size', '10 features'], ['--shard-size', '10', '--workers', '2']):
+            with self.assertRaises(SystemExit):
+                esridump.cli._parse_args(['http://example.com', 'out.geojson'] + bad_args)
+
+    def test_cache_max_size(self):
+        self.assertEqual(500 * 1024 ** 2, esridump.cli._byte_size('500MB'))
+        self.assertEqual(4096, esridump.cli._byte_size('4096'))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            esridump.cli._byte_size('lots')
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache = os.path.join(tmpdir, 'cache.sqlite')
+        args = esridump.cli._parse_args(['http://example.com', '-', '--cache', cache, '--cache-max-size', '2KB'])
+        self.assertEqual(2048, args.cache_max_size)
+
+    def test_url_and_outfile_are_required_without_a_manifest(self):
+        with self.assertRaises(SystemExit):
+            esridump.cli._parse_args(['http://example.com'])
+
+        args = esridump.cli._parse_args(['--manifest', 'nightly.jsonl'])
+        self.assertEqual('nightly.jsonl', args.manifest)
+
+        with self.assertRaises(SystemExit):
+            esridump.cli._parse_args(['--manifest', 'nightly.jsonl', 'http://example.com'])
+
 
 class TestEsriDumpCommandlineMain(unittest.TestCase):
     def setUp(self):
@@ -66,6 +143,21 @@ class TestEsriDumpCommandlineMain(unittest.TestCase):
         self.parse_return.params = []
         self.parse_return.proxy = None
         self.parse_return.output_format = 'geojson'
+        self.parse_return.concurrency = 1
+        self.parse_return.checkpoint = None
+        self.parse_return.resume = False
+        self.parse_return.cache = None
+        self.parse_return.incremental = None
+        self.parse_return.stream_pages = False
+        self.parse_return.fast_json = False
+        self.parse_return.transport = 'json'
+        self.parse_return.workers = 1
+        self.parse_return.fetch_by_object_ids = False
+        self.parse_return.dry_run = False
+        self.parse_return.service = False
+        self.parse_return.manifest = None
+        self.parse_return.compress = None
+        self.parse_return.shard_size = None
         self.mock_parseargs.return_value = self.parse_return
 
         self.fake_url = 'http://example.com'
@@ -85,13 +177,18 @@ class TestEsriDumpCommandlineMain(unittest.TestCase):
                 **kwargs
             )
 
+    def written(self):
+        return ''.join(c.args[0] for c in self.mock_outfile.write.call_args_list)
+
     def test_cli_simple(self):
         esridump.cli.main()
 
         # Make sure it has the FeatureCollection "header" and footer
-        self.mock_outfile.write.assert_any_call('{"type":"FeatureCollection","features":[\n')
-        self.mock_outfile.write.assert_any_call(']}')
-        self.assertEqual(self.mock_outfile.write.call_count, 14)
+        output = self.written()
+        self.assertTrue(output.startswith('{"type":"FeatureCollection","features":[\n'))
+        self.assertTrue(output.endswith('\n]}'))
+        self.assertEqual(6, len(json.loads(output)['features']))
+        self.assertEqual(5, output.count('},\n{'))
 
     def test_cli_jsonlines(self):
         self.parse_return.jsonlines = True
@@ -99,7 +196,95 @@ class TestEsriDumpCommandlineMain(unittest.TestCase):
         esridump.cli.main()
 
         # jsonlines won't have FeatureCollection wrapper
-        self.assertEqual(self.mock_outfile.write.call_count, 12)
+        lines = self.written().split('\n')
+        self.assertEqual(7, len(lines))
+        self.assertEqual('', lines[-1])
+        self.assertEqual('Feature', json.loads(lines[0])['type'])
+
+    def test_cli_writes_each_page_at_once(self):
+        self.parse_return.jsonlines = True
+
+        esridump.cli.main()
+
+        # All six features are on one page
+        self.assertEqual(1, self.mock_outfile.write.call_count)
+
+    def test_cli_output_matches_json_dumps(self):
+        with open('tests/fixtures/us-ca-carson/us-ca-carson-0.json') as f:
+            features = [esri2geojson(feature) for feature in json.load(f)['features']]
+
+        esridump.cli.main()
+
+        self.assertEqual(
+            '{"type":"FeatureCollection","features":[\n' + ',\n'.join(json.dumps(f) for f in features) + '\n]}',
+            self.written(),
+        )
+
+    def test_cli_converts_in_worker_processes(self):
+        with open('tests/fixtures/us-ca-carson/us-ca-carson-0.json') as f:
+            features = [esri2geojson(feature) for feature in json.load(f)['features']]
+        self.parse_return.workers = 2
+
+        esridump.cli.main()
+
+        self.assertEqual(
+            '{"type":"FeatureCollection","features":[\n' + ',\n'.join(json.dumps(f) for f in features) + '\n]}',
+            self.written(),
+        )
+
+    def test_cli_pgcopy(self):
+        self.parse_return.output_format = 'pgcopy'
+        self.parse_return.copy_table = 'parcels'
+
+        esridump.cli.main()
+
+        lines = self.written().split('\n')
+        self.assertTrue(lines[0].startswith('CREATE TABLE "parcels" ('))
+        self.assertIn('COPY "parcels" (', self.written())
+        self.assertEqual(['\\.', ''], lines[-2:])
+        # One row per feature, with the fields from the layer metadata and the geometry
+        rows = [line for line in lines if '\t' in line]
+        self.assertEqual(6, len(rows))
+        self.assertTrue(rows[0].split('\t')[-1].startswith('0101000020e6100000'))
+        # Layer metadata was fetched once, for both the plan and the table
+        self.assertEqual(1, sum(1 for call in self.responses.calls if re.search(r'\?f=json', call.request.url)))
+
+    def test_cli_geopackage(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.parse_return.output_format = 'geopackage'
+        self.parse_return.outfile = os.path.join(tmpdir, 'out.gpkg')
+        # An existing file is replaced
+        open(self.parse_return.outfile, 'w').close()
+
+        esridump.cli.main()
+
+        db = sqlite3.connect(self.parse_return.outfile)
+        self.addCleanup(db.close)
+        table, geometry_type = db.execute(
+            'SELECT table_name, geometry_type_name FROM gpkg_geometry_columns').fetchone()
+        self.assertEqual('POINT', geometry_type)
+        self.assertEqual(6, db.execute('SELECT count(*) FROM "{}"'.format(table)).fetchone()[0])
+        # Every feature with a geometry is in the spatial index
+        self.assertEqual(
+            db.execute('SELECT count(*) FROM "{}" WHERE geom IS NOT NULL'.format(table)).fetchone(),
+            db.execute('SELECT count(*) FROM "rtree_{}_geom"'.format(table)).fetchone())
+
+    def test_cli_shards(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.parse_return.outfile = os.path.join(tmpdir, 'out.geojsonl')
+        self.parse_return.jsonlines = True
+        self.parse_return.shard_size = (4, False)
+        self.parse_return.shard_manifest = os.path.join(tmpdir, 'shards.jsonl')
+
+        esridump.cli.main()
+
+        with open(self.parse_return.shard_manifest) as f:
+            shards = [json.loads(line) for line in f]
+        self.assertEqual([4, 2], [shard['features'] for shard in shards])
+        self.assertEqual([(1, 3), (4, 5)], [(shard['min_oid'], shard['max_oid']) for shard in shards])
+        self.assertEqual(['out-00000.geojsonl', 'out-00001.geojsonl', 'shards.jsonl'], sorted(os.listdir(tmpdir)))
 
     def test_cli_override_where(self):
         self.parse_return.params = ['where=foo=bar']
@@ -108,4 +293,20 @@ class TestEsriDumpCommandlineMain(unittest.TestCase):
 
         self.assertIn('where=foo%3Dbar', self.responses.calls[2].request.url)
         self.assertIn('where=%28OBJECTID+%3E%3D+70193+AND+OBJECTID+%3C%3D+70307%29+AND+%28foo%3Dbar%29', self.responses.calls[3].request.body)
-        self.assertEqual(self.mock_outfile.write.call_count, 14)
+        self.assertEqual(6, len(json.loads(self.written())['features']))
+
+    def test_cli_dry_run(self):
+        self.parse_return.dry_run = True
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            esridump.cli.main()
+
+        self.assertEqual({
+            'url': 'http://example.com',
+            'strategy': 'oid-enumeration',
+            'row_count': 30551,
+            'page_size': 1000,
+            'request_count': 1,
+        }, json.loads(stdout.getvalue()))
+        self.assertFalse(any(call.request.method == 'POST' for call in self.responses.calls))
+        self.assertEqual('', self.written())
@@ -0,0 +1,59 @@
+import gzip
+import io
+import unittest
+
+from esridump.compress import CompressedWriter, compression_for, zstandard
+
+
+class UnclosedBytesIO(io.BytesIO):
+    """ Keeps its value readable after close(). """
+
+    def close(self):
+        self.closed_by_writer = True
+
+
+class FailingFile(io.BytesIO):
+    """ Fills up after the first few bytes. """
+
+    def write(self, data):
+        if self.tell() + len(data) > 32:
+            raise IOError("Disk full")
+        return super(FailingFile, self).write(data)
+
+
+class TestCompressedWriter(unittest.TestCase):
+    def test_compression_for(self):
+        self.assertEqual('gzip', compression_for('parcels.geojson.gz'))
+        self.assertEqual('zstd', compression_for('parcels.geojsonl.ZST'))
+        self.assertIsNone(compression_for('parcels.geojson'))
+
+    def test_gzip(self):
+        out = UnclosedBytesIO()
+        with CompressedWriter(out, 'gzip', queue_size=1) as writer:
+            writer.write('{"type":"FeatureCollection","features":[\n')
+            writer.write(b'\n]}')
+
+        self.assertTrue(out.closed_by_writer)
+        self.assertEqual(b'{"type":"FeatureCollection","features":[\n\n]}', gzip.decompress(out.getvalue()))
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        out = UnclosedBytesIO()
+        writer = CompressedWriter(out, 'zstd', threads=2)
+        for i in range(1000):
+            writer.write('{"id": %d}\n' % i)
+        writer.close()
+
+        decompressed = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(out.getvalue())).read()
+        self.assertEqual(''.join('{"id": %d}\n' % i for i in range(1000)).encode('utf-8'), decompressed)
+
+    def test_errors_on_the_background_thread_are_raised(self):
+        writer = CompressedWriter(FailingFile(), 'gzip')
+        writer.write('x' * 100000)
+
+        with self.assertRaisesRegex(IOError, 'Disk full'):
+            writer.close()
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            CompressedWriter(io.BytesIO(), 'lz4')
@@ -1,8 +1,17 @@
+import json
+import mock
 import os
+import requests
 import responses
+import shutil
+import tempfile
+import time
 import unittest
 import re
+from six.moves.urllib.parse import parse_qs
 
+from esridump.cache import ResponseCache
+from esridump.checkpoint import Checkpoint
 from esridump.dumper import EsriDumper
 from esridump.errors import EsriDownloadError
 
@@ -404,6 +413,106 @@ class TestEsriDownload(unittest.TestCase):
 
         self.assertEqual(2, len(data))
 
+    def add_envelope_layer(self, points, max_record_count=3):
+        self.responses.add(
+            method='GET',
+            url=re.compile(r'.*/\?f=json.*'),
+            json={
+                'objectIdField': 'OBJECTID',
+                'maxRecordCount': max_record_count,
+                'extent': {'xmin': 0, 'ymin': 0, 'xmax': 16, 'ymax': 16, 'spatialReference': {'wkid': 3857}},
+                'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}],
+            },
+            match_querystring=True,
+        )
+        self.responses.add(
+            method='GET',
+            url=re.compile('.*returnCountOnly=true.*'),
+            json={'count': len(points)},
+            match_querystring=True,
+        )
+        self.responses.add(
+            method='GET',
+            url=re.compile('.*returnIdsOnly=true.*'),
+            json={},
+            match_querystring=True,
+        )
+
+        self.envelopes = []
+        self.pages = []
+
+        def envelope_callback(request):
+            args = parse_qs(request.url.split('?', 1)[1])
+            envelope = json.loads(args['geometry'][0])
+            self.envelopes.append(envelope)
+            features = [
+                {'attributes': {'OBJECTID': oid}, 'geometry': {'x': x, 'y': y}}
+                for oid, (x, y) in enumerate(points, 1)
+                if envelope['xmin'] <= x <= envelope['xmax'] and envelope['ymin'] <= y <= envelope['ymax']
+            ]
+            if args.get('returnCountOnly') == ['true']:
+                return (200, {}, json.dumps({'count': len(features)}))
+            self.pages.append(len(features[:max_record_count]))
+            return (200, {}, json.dumps({'features': features[:max_record_count]}))
+
+        self.responses.add_callback(
+            method='GET',
+            url=re.compile('.*geometry=.*'),
+            callback=envelope_callback,
+        )
+
+    def test_split_envelope_into_quadrants(self):
+        dump = EsriDumper(self.fake_url)
+        quadrants = dump._split_envelope({'xmin': 0, 'ymin': 10, 'xmax': 4, 'ymax': 12, 'spatialReference': {'wkid': 4326}})
+
+        self.assertEqual([
+            (0, 10, 2, 11),
+            (2, 10, 4, 11),
+            (0, 11, 2, 12),
+            (2, 11, 4, 12),
+        ], [(q['xmin'], q['ymin'], q['xmax'], q['ymax']) for q in quadrants])
+        self.assertTrue(all(q['spatialReference'] == {'wkid': 4326} for q in quadrants))
+
+    def test_concurrent_envelope_crawl_finds_every_feature(self):
+        points = [(x + 0.5, y + 0.5) for x in range(0, 16, 3) for y in range(0, 16, 5)] + [(8, 8)]
+        self.add_envelope_layer(points)
+
+        dump = EsriDumper(self.fake_url, max_page_size=3, concurrency=4, pause_seconds=0)
+        data = list(dump)
+
+        self.assertEqual(list(range(1, len(points) + 1)), sorted(f['properties']['OBJECTID'] for f in data))
+        for envelope in self.envelopes:
+            self.assertLess(envelope['xmin'], envelope['xmax'])
+            self.assertLess(envelope['ymin'], envelope['ymax'])
+        # Features are only fetched for boxes that fit in a page
+        self.assertTrue(all(0 < count < 3 for count in self.pages))
+        self.assertEqual(len(self.pages), dump.stats['envelope_feature_query_requests'])
+        self.assertGreater(dump.stats['envelope_bytes_saved'], 0)
+
+    def test_envelope_crawl_without_counts(self):
+        points = [(x + 0.5, y + 0.5) for x in range(0, 16, 3) for y in range(0, 16, 5)]
+        self.add_envelope_layer(points)
+
+        dump = EsriDumper(self.fake_url, max_page_size=3, pause_seconds=0, envelope_count_first=False)
+        data = list(dump)
+
+        self.assertEqual(list(range(1, len(points) + 1)), sorted(f['properties']['OBJECTID'] for f in data))
+        self.assertEqual(0, dump.stats['envelope_count_query_requests'])
+        self.assertIn(3, self.pages)
+
+    def test_envelope_crawl_stops_at_max_depth(self):
+        # More features on one spot than fit in a page, so boxes never stop coming back full
+        self.add_envelope_layer([(1, 1)] * 4)
+
+        dump = EsriDumper(self.fake_url, max_page_size=3, pause_seconds=0, max_envelope_depth=2)
+        data = list(dump)
+
+        self.assertEqual([1, 2, 3], [f['properties']['OBJECTID'] for f in data])
+        # Counts for the whole extent, its four quadrants and the four quadrants of the
+        # full one, then features for the full box at the bottom
+        self.assertEqual(9, dump.stats['envelope_count_query_requests'])
+        self.assertEqual([3], self.pages)
+
     def test_empty_result_set_short_circuits(self):
         self.add_fixture_response(
             r'.*/\?f=json.*',
@@ -447,3 +556,436 @@ class TestEsriDownload(unittest.TestCase):
         dump = EsriDumper(self.fake_url, output_format='esrijson')
         data = list(dump)
         self.assertIn('attributes', data[0], message='Data does not have "attributes" key with output format == esrijson')
+
+    def add_synthetic_layer(self, oids, max_record_count=2, fail_on_oid=None):
+        self.responses.add(
+            method='GET',
+            url=re.compile(r'.*/\?f=json.*'),
+            json={
+                'objectIdField': 'OBJECTID',
+                'maxRecordCount': max_record_count,
+                'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}],
+            },
+            match_querystring=True,
+        )
+        self.responses.add(
+            method='GET',
+            url=re.compile('.*returnCountOnly=true.*'),
+            json={'count': len(oids)},
+            match_querystring=True,
+        )
+        self.responses.add(
+            method='GET',
+            url=re.compile('.*returnIdsOnly=true.*'),
+            json={'objectIdFieldName': 'OBJECTID', 'objectIds': oids},
+            match_querystring=True,
+        )
+
+        self.add_query_callback(oids, fail_on_oid)
+
+    def add_query_callback(self, oids, fail_on_oid=None):
+        def query_callback(request):
+            where = parse_qs(request.body)['where'][0]
+            page_min, page_max = map(int, re.findall(r'\d+', where))
+            if page_min <= (fail_on_oid or 0) <= page_max:
+                return (500, {}, 'Server fell over')
+            if page_min == min(oids):
+                # Make the first page the slowest one to come back
+                time.sleep(0.1)
+            features = [
+                {'attributes': {'OBJECTID': oid}, 'geometry': {'x': oid, 'y': oid}}
+                for oid in oids
+                if page_min <= oid <= page_max
+            ]
+            return (200, {}, json.dumps({'features': features}))
+
+        self.responses.add_callback(
+            method='POST',
+            url=re.compile('.*query.*'),
+            callback=query_callback,
+        )
+
+    def test_concurrent_pages_are_yielded_in_order(self):
+        oids = list(range(1, 10))
+        self.add_synthetic_layer(oids)
+
+        dump = EsriDumper(self.fake_url, max_page_size=1, concurrency=4, pause_seconds=0)
+        data = list(dump)
+
+        self.assertEqual(oids, [f['properties']['OBJECTID'] for f in data])
+
+    def test_concurrent_pages_unordered(self):
+        oids = list(range(1, 10))
+        self.add_synthetic_layer(oids)
+
+        dump = EsriDumper(self.fake_url, max_page_size=1, concurrency=4, ordered=False, pause_seconds=0)
+        data = list(dump)
+
+        self.assertEqual(oids, sorted(f['properties']['OBJECTID'] for f in data))
+        self.assertNotEqual(1, data[0]['properties']['OBJECTID'])
+
+    def test_worker_processes_keep_page_order(self):
+        oids = list(range(1, 10))
+        self.add_synthetic_layer(oids)
+
+        dump = EsriDumper(self.fake_url, max_page_size=1, concurrency=4, pause_seconds=0, workers=2)
+        text = ''.join(dump.iter_serialized_pages(jsonlines=True))
+
+        self.assertEqual(oids, [json.loads(line)['properties']['OBJECTID'] for line in text.splitlines()])
+
+    def test_worker_processes_get_envelope_scrapes_a_page_at_a_time(self):
+        points = [(x + 0.5, y + 0.5) for x in range(0, 16, 3) for y in range(0, 16, 5)]
+        self.add_envelope_layer(points)
+
+        dump = EsriDumper(self.fake_url, max_page_size=3, pause_seconds=0, workers=2)
+        pages = list(dump.iter_serialized_pages(jsonlines=True))
+
+        oids = [json.loads(line)['properties']['OBJECTID'] for page in pages for line in page.splitlines()]
+        self.assertEqual(list(range(1, len(points) + 1)), sorted(oids))
+        self.assertEqual([3] * 8, [len(page.splitlines()) for page in pages])
+
+    def test_adaptive_page_size_splits_failing_pages(self):
+        oids = list(range(1, 31))
+        self.add_synthetic_layer(oids, max_record_count=16)
+        self.responses.remove(responses.POST, re.compile('.*query.*'))
+        page_sizes = []
+
+        def query_callback(request):
+            where = parse_qs(request.body)['where'][0]
+            page_min, page_max = map(int, re.findall(r'\d+', where))
+            page_sizes.append(page_max - page_min + 1)
+            if page_max - page_min >= 3:
+                return (500, {}, 'Page too big')
+            features = [{'attributes': {'OBJECTID': oid}} for oid in range(page_min, page_max + 1)]
+            return (200, {}, json.dumps({'features': features}))
+
+        self.responses.add_callback(method='POST', url=re.compile('.*query.*'), callback=query_callback)
+
+        dump = EsriDumper(self.fake_url, max_page_size='auto', pause_seconds=0, num_of_retry=1)
+        data = list(dump)
+
+        self.assertEqual(oids, [f['properties']['OBJECTID'] for f in data])
+        # Starts at a quarter of maxRecordCount, and failed pages are fetched again in halves
+        self.assertEqual([4, 2, 2], page_sizes[:3])
+
+    def add_statistics_layer(self, oids, max_record_count):
+        self.responses.add(
+            method='GET',
+            url=re.compile(r'.*/\?f=json.*'),
+            json={
+                'objectIdField': 'OBJECTID',
+                'maxRecordCount': max_record_count,
+                'supportsStatistics': True,
+                'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}],
+            },
+            match_querystring=True,
+        )
+
+        def oids_where(where):
+            if where == '1=1':
+                return oids
+            after, last = map(int, re.findall(r'\d+', where))
+            return [oid for oid in oids if after < oid <= last]
+
+        def get_callback(request):
+            args = parse_qs(request.url.split('?', 1)[1])
+            if 'outStatistics' in args:
+                return (200, {}, json.dumps({'features': [{'attributes': {'THE_MIN': min(oids), 'THE_MAX': max(oids)}}]}))
+            if 'returnIdsOnly' in args:
+                return (200, {}, json.dumps({'objectIds': [min(oids), max(oids)]}))
+            return (200, {}, json.dumps({'count': len(oids_where(args['where'][0]))}))
+
+        self.responses.add_callback(method='GET', url=re.compile('.*query.*'), callback=get_callback)
+
+        self.pages = []
+
+        def query_callback(request):
+            page = oids_where(parse_qs(request.body)['where'][0])
+            self.pages.append(page)
+            return (200, {}, json.dumps({'features': [{'attributes': {'OBJECTID': oid}} for oid in page]}))
+
+        self.responses.add_callback(method='POST', url=re.compile('.*query.*'), callback=query_callback)
+
+    def test_sparse_oids_are_paged_by_row_count(self):
+        oids = list(range(1, 6)) + list(range(5000, 5004)) + [90000, 99999]
+        self.add_statistics_layer(oids, max_record_count=4)
+
+        dump = EsriDumper(self.fake_url, max_page_size=1, pause_seconds=0)
+        data = list(dump)
+
+        self.assertEqual(oids, [f['properties']['OBJECTID'] for f in data])
+        # Instead of 25,000 pages of 4 OIDs, mostly empty
+        self.assertEqual([[1, 2, 3], [4, 5], [5000, 5001, 5002, 5003], [90000, 99999]], self.pages)
+        self.assertEqual(15, dump.stats['oid_count_query_requests'])
+
+    def test_dense_oids_are_paged_by_oid(self):
+        oids = list(range(1, 10))
+        self.add_statistics_layer(oids, max_record_count=4)
+
+        dump = EsriDumper(self.fake_url, max_page_size=1, pause_seconds=0)
+        list(dump)
+
+        self.assertEqual([[1, 2, 3, 4], [5, 6, 7, 8], [9]], self.pages)
+        self.assertEqual(0, dump.stats['oid_count_query_requests'])
+
+    def add_object_ids_callback(self, oids, ignore_object_ids=False):
+        self.responses.remove(responses.POST, re.compile('.*query.*'))
+        self.pages = []
+
+        def query_callback(request):
+            args = parse_qs(request.body)
+            self.assertEqual('1=1', args['where'][0])
+            asked = [int(oid) for oid in args['objectIds'][0].split(',')]
+            self.pages.append(asked)
+            returned = oids[:len(asked)] if ignore_object_ids else [oid for oid in asked if oid in oids]
+            features = [{'attributes': {'OBJECTID': oid}} for oid in returned]
+            return (200, {}, json.dumps({'objectIdFieldName': 'OBJECTID', 'features': features}))
+
+        self.responses.add_callback(method='POST', url=re.compile('.*query.*'), callback=query_callback)
+
+    def test_fetch_by_object_ids(self):
+        oids = [1, 2, 5, 8, 13, 21, 34]
+        self.add_synthetic_layer(oids, max_record_count=3)
+        self.add_object_ids_callback(oids)
+
+        dump = EsriDumper(self.fake_url, max_page_size=1, fetch_by_object_ids=True, pause_seconds=0)
+        data = list(dump)
+
+        self.assertEqual(oids, [f['properties']['OBJECTID'] for f in data])
+        self.assertEqual([[1, 2, 5], [8, 13, 21], [34]], self.pages)
+
+    def test_fetch_by_object_ids_when_the_server_ignores_them(self):
+        oids = [1, 2, 5, 8, 13, 21, 34]
+        self.add_synthetic_layer(oids, max_record_count=3)
+        self.add_object_ids_callback(oids, ignore_object_ids=True)
+
+        dump = EsriDumper(self.fake_url, max_page_size=1, fetch_by_object_ids=True, pause_seconds=0)
+
+        with self.assertRaisesRegex(EsriDownloadError, 'OID 1 which'):
+            list(dump)
+
+    def test_feature_set_dimensions_leave_geometries_alone(self):
+        oids = [1, 2]
+        self.add_synthetic_layer(oids)
+        self.responses.remove(responses.POST, re.compile('.*query.*'))
+        self.responses.add(method='POST', url=re.compile('.*query.*'), json={
+            'hasZ': True,
+            'hasM': True,
+            'features': [
+                {'attributes': {'OBJECTID': 1}, 'geometry': {'paths': [[[0, 0, 5, 9], [1, 1, 6, 9]]]}},
+                {'attributes': {'OBJECTID': 2}, 'geometry': None},
+            ],
+        })
+
+        dump = EsriDumper(self.fake_url, output_format='esrijson', pause_seconds=0)
+        data = list(dump)
+
+        self.assertEqual({'paths': [[[0, 0, 5, 9], [1, 1, 6, 9]]]}, data[0]['geometry'])
+
+    def test_plan_is_lazy_and_followed(self):
+        oids = list(range(1, 10))
+        self.add_synthetic_layer(oids)
+
+        dump = EsriDumper(self.fake_url, max_page_size=1, pause_seconds=0)
+        plan = dump.plan()
+
+        self.assertEqual('oid-enumeration', plan.strategy)
+        self.assertEqual(9, plan.row_count)
+        self.assertEqual(5, plan.request_count)
+        self.assertEqual('OBJECTID >= 1 AND OBJECTID <= 2', next(plan.pages())['where'])
+        self.assertEqual(3, len(self.responses.calls))
+
+        data = list(dump)
+
+        self.assertEqual(oids, [f['properties']['OBJECTID'] for f in data])
+        # Only the five pages were requested after planning
+        self.assertEqual(8, len(self.responses.calls))
+
+    def test_requests_share_one_session(self):
+        self.add_synthetic_layer(list(range(1, 6)))
+
+        session = mock.MagicMock(wraps=requests.Session())
+        dump = EsriDumper(self.fake_url, max_page_size=1, pause_seconds=0, session=session)
+        data = list(dump)
+
+        self.assertEqual(5, len(data))
+        # metadata, count, ids and three pages
+        self.assertEqual(6, session.request.call_count)
+
+        dump.close()
+        session.close.assert_not_called()
+
+    def test_keep_alive_can_be_turned_off(self):
+        self.add_synthetic_layer(list(range(1, 3)))
+
+        dump = EsriDumper(self.fake_url, max_page_size=1, keep_alive=False)
+        list(dump)
+
+        self.assertEqual('close', self.responses.calls[-1].request.headers['Connection'])
+
+    def test_rate_limiter_hears_about_throttled_pages(self):
+        self.add_fixture_response(
+            r'.*/\?f=json.*',
+            'us-ca-carson/us-ca-carson-metadata.json',
+            method='GET',
+        )
+        self.add_fixture_response(
+            '.*returnCountOnly=true.*',
+            'us-ca-carson/us-ca-carson-count-only.json',
+            method='GET',
+        )
+        self.add_fixture_response(
+            '.*returnIdsOnly=true.*',
+            'us-ca-carson/us-ca-carson-ids-only.json',
+            method='GET',
+        )
+        self.responses.add(
+            method='POST',
+            url=re.compile('.*query.*'),
+            status=429,
+            headers={'Retry-After': '7'},
+            body='Too many requests',
+        )
+        self.add_fixture_response(
+            '.*query.*',
+            'us-ca-carson/us-ca-carson-0.json',
+            method='POST',
+        )
+
+        limiter = mock.Mock()
+        limiter.acquire.return_value = 0
+        limiter.backoff.return_value = 0
+        dump = EsriDumper(self.fake_url, rate_limiter=limiter)
+        data = list(dump)
+
+        self.assertEqual(6, len(data))
+        limiter.record_failure.assert_called_once_with(7.0)
+        self.assertEqual(1, limiter.record_success.call_count)
+
+    def test_resume_from_checkpoint(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        checkpoint_path = os.path.join(tmpdir, 'dump.checkpoint')
+        oids = list(range(1, 10))
+
+        self.add_synthetic_layer(oids, fail_on_oid=5)
+        dump = EsriDumper(self.fake_url, max_page_size=1, pause_seconds=0, num_of_retry=1,
+                          checkpoint=Checkpoint(checkpoint_path))
+        first_run = []
+        with self.assertRaises(EsriDownloadError):
+            for feature in dump:
+                first_run.append(feature['properties']['OBJECTID'])
+        self.assertEqual([1, 2, 3, 4], first_run)
+
+        self.responses.reset()
+        self.add_query_callback(oids)
+        checkpoint = Checkpoint(checkpoint_path)
+        self.assertTrue(checkpoint.load())
+        self.assertEqual({0, 1}, checkpoint.completed)
+
+        dump = EsriDumper(self.fake_url, max_page_size=1, pause_seconds=0, checkpoint=checkpoint)
+        second_run = [feature['properties']['OBJECTID'] for feature in dump]
+
+        self.assertEqual([5, 6, 7, 8, 9], second_run)
+        # Only the three remaining pages are requested, no planning queries
+        self.assertEqual(['POST'] * 3, [c.request.method for c in self.responses.calls])
+
+    def test_cached_responses_skip_the_network(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache = ResponseCache(os.path.join(tmpdir, 'cache.sqlite'))
+        self.addCleanup(cache.close)
+        oids = list(range(1, 6))
+
+        self.add_synthetic_layer(oids)
+        first_run = list(EsriDumper(self.fake_url, max_page_size=1, pause_seconds=0, cache=cache))
+        self.assertEqual(6, len(self.responses.calls))
+
+        self.responses.reset()
+        dump = EsriDumper(self.fake_url, max_page_size=1, pause_seconds=0, cache=cache)
+
+        self.assertEqual(first_run, list(dump))
+        self.assertEqual(0, len(self.responses.calls))
+        self.assertEqual(5, dump.get_feature_count())
+
+    def test_streamed_pages(self):
+        self.add_fixture_response(
+            r'.*/\?f=json.*',
+            'us-esri-test/us-esri-test-metadata.json',
+            method='GET',
+        )
+        self.add_fixture_response(
+            '.*returnCountOnly=true.*',
+            'us-esri-test/us-esri-test-count-only.json',
+            method='GET',
+        )
+        self.add_fixture_response(
+            '.*query.*',
+            'us-esri-test/us-esri-test-0.json',
+            method='POST',
+        )
+
+        dump = EsriDumper(self.fake_url, stream_pages=True, stream_chunk_size=1024)
+        data = list(dump)
+
+        self.assertEqual(1000, len(data))
+        self.assertEqual('Feature', data[0]['type'])
+
+    def test_streamed_page_latency_is_recorded_once_read(self):
+        self.add_fixture_response(
+            r'.*/\?f=json.*',
+            'us-esri-test/us-esri-test-metadata.json',
+            method='GET',
+        )
+        self.add_fixture_response(
+            '.*returnCountOnly=true.*',
+            'us-esri-test/us-esri-test-count-only.json',
+            method='GET',
+        )
+        self.add_fixture_response(
+            '.*query.*',
+            'us-esri-test/us-esri-test-0.json',
+            method='POST',
+        )
+
+        limiter = mock.Mock()
+        limiter.acquire.return_value = 0
+        dump = EsriDumper(self.fake_url, stream_pages=True, stream_chunk_size=1024, rate_limiter=limiter)
+        page = next(dump.iter_pages())
+
+        next(iter(page))
+        self.assertEqual(0, limiter.record_success.call_count)
+        self.assertEqual(999, len(list(page)))
+        self.assertEqual(1, limiter.record_success.call_count)
+
+    def test_concurrent_streamed_pages_are_read_on_the_fetching_threads(self):
+        oids = list(range(1, 7))
+        self.add_synthetic_layer(oids)
+
+        dump = EsriDumper(self.fake_url, max_page_size=2, concurrency=3, stream_pages=True, pause_seconds=0)
+        pages = [features for _, features in dump._fetched_pages()]
+
+        self.assertEqual([list] * 3, [type(features) for features in pages])
+        self.assertEqual(oids, [f['attributes']['OBJECTID'] for features in pages for f in features])
+
+    def test_streamed_pages_detect_error_payloads(self):
+        self.add_fixture_response(
+            r'.*/\?f=json.*',
+            'us-esri-test/us-esri-test-metadata.json',
+            method='GET',
+        )
+        self.add_fixture_response(
+            '.*returnCountOnly=true.*',
+            'us-esri-test/us-esri-test-count-only.json',
+            method='GET',
+        )
+        self.responses.add(
+            method='POST',
+            url=re.compile('.*query.*'),
+            json={'error': {'code': 500, 'message': 'Database is down', 'details': []}},
+        )
+
+        dump = EsriDumper(self.fake_url, stream_pages=True, pause_seconds=0, num_of_retry=1)
+        with self.assertRaisesRegex(EsriDownloadError, "Could not connect to URL") as context:
+            list(dump)
+        self.assertIn("Database is down", str(context.exception.args[1]))
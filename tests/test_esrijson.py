@@ -1,6 +1,8 @@
+import json
 import unittest
 
-from esridump import esri2geojson
+from esridump import esri2geojson, esri2geojson_batch
+from esridump.esri2geojson import pairwise, ring_is_clockwise
 
 class TestEsriJsonToGeoJson(unittest.TestCase):
     def setUp(self):
@@ -556,3 +558,42 @@ class TestGeoJsonPolygonConversion(TestEsriJsonToGeoJson):
                 "geometry": None
             }
         )
+
+
+class TestBatchConversion(unittest.TestCase):
+    def setUp(self):
+        square = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]
+        hole = [[2, 2], [8, 2], [8, 8], [2, 8], [2, 2]]
+        far_square = [[20, 0], [20, 5], [25, 5], [25, 0]]
+
+        self.features = [
+            {'geometry': {'x': 1, 'y': 2}, 'attributes': {'OBJECTID': 1}},
+            {'geometry': {'paths': [[[0, 0], [1, 1]]]}, 'attributes': {'OBJECTID': 2}},
+            {'geometry': {'rings': [square]}, 'attributes': {'OBJECTID': 3}},
+            {'geometry': {'rings': [square, hole, far_square]}, 'attributes': {'OBJECTID': 4}},
+            # A hole before any outer ring is skipped
+            {'geometry': {'rings': [hole, square]}, 'attributes': {'OBJECTID': 5}},
+            # A ring with no area
+            {'geometry': {'rings': [square, [[0, 0], [1, 1], [2, 2], [0, 0]]]}, 'attributes': {'OBJECTID': 6}},
+            {'geometry': {'rings': [[[0.1, 0.2, 5], [0.1, 0.3, 5], [0.4, 0.3, 5]], hole]}, 'attributes': None},
+            {'geometry': None, 'attributes': {'OBJECTID': 8}},
+        ]
+        with open('tests/fixtures/us-ca-tuolumne/us-ca-tuolumne-0.json') as f:
+            self.features.extend(json.load(f)['features'])
+
+    def assertMatchesOneAtATime(self, features):
+        self.assertEqual([esri2geojson(feature) for feature in features], esri2geojson_batch(features))
+
+    def test_matches_esri2geojson(self):
+        self.assertMatchesOneAtATime(self.features)
+
+    def test_ring_is_clockwise_sums_in_pairwise_order(self):
+        def pairwise_sum(ring):
+            total = 0
+            for (pt1, pt2) in pairwise(ring):
+                total += (pt2[0] - pt1[0]) * (pt2[1] + pt1[1])
+            return total >= 0
+
+        rings = [feature['geometry']['rings'][0] for feature in self.features if 'rings' in (feature['geometry'] or {})]
+        rings.append([])
+        self.assertEqual([pairwise_sum(ring) for ring in rings], [ring_is_clockwise(ring) for ring in rings])
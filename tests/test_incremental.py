@@ -0,0 +1,135 @@
+import json
+import os
+import re
+import responses
+import shutil
+import tempfile
+import unittest
+from six.moves.urllib.parse import parse_qs
+
+from esridump.dumper import EsriDumper
+from esridump.incremental import IncrementalDump, read_features
+from esridump.writers import GeoJSONWriter
+
+
+def feature(oid, edited, name):
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [oid, oid]},
+        'properties': {'OBJECTID': oid, 'EDITED': edited, 'NAME': name},
+    }
+
+
+class TestIncrementalDump(unittest.TestCase):
+    def setUp(self):
+        self.responses = responses.RequestsMock()
+        self.responses.start()
+        self.fake_url = 'http://example.com'
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def tearDown(self):
+        self.responses.stop()
+        self.responses.reset()
+
+    def add_layer(self, metadata, server_oids, edited_oids=None):
+        self.responses.add(
+            method='GET',
+            url=re.compile(r'.*/\?f=json.*'),
+            json=metadata,
+            match_querystring=True,
+        )
+        if edited_oids is not None:
+            self.responses.add(
+                method='GET',
+                url=re.compile('.*TIMESTAMP.*returnIdsOnly=true.*'),
+                json={'objectIds': edited_oids},
+                match_querystring=True,
+            )
+        self.responses.add(
+            method='GET',
+            url=re.compile(r'.*where=1%3D1&returnIdsOnly=true.*'),
+            json={'objectIds': server_oids},
+            match_querystring=True,
+        )
+
+        def query_callback(request):
+            where = parse_qs(request.body)['where'][0]
+            oids = [int(oid) for oid in re.findall(r'\d+', where)]
+            features = [
+                {'attributes': {'OBJECTID': oid, 'EDITED': 2000, 'NAME': 'new'}, 'geometry': {'x': oid, 'y': oid}}
+                for oid in oids
+            ]
+            return (200, {}, json.dumps({'features': features}))
+
+        self.responses.add_callback(
+            method='POST',
+            url=re.compile('.*query.*'),
+            callback=query_callback,
+        )
+
+    def write_previous(self, features, jsonlines=True):
+        path = os.path.join(self.tmpdir, 'previous.geojson')
+        with open(path, 'w') as f:
+            if jsonlines:
+                for feature in features:
+                    f.write(json.dumps(feature) + '\n')
+            else:
+                json.dump({'type': 'FeatureCollection', 'features': features}, f)
+        return path
+
+    def test_fetches_added_and_edited_features(self):
+        self.add_layer({
+            'objectIdField': 'OBJECTID',
+            'maxRecordCount': 1000,
+            'editFieldsInfo': {'editDateField': 'EDITED'},
+        }, server_oids=[1, 3, 4, 5], edited_oids=[3, 5])
+        previous = self.write_previous([
+            feature(1, 1000, 'old'),
+            feature(2, 1000, 'old'),
+            feature(3, 1500, 'old'),
+            feature(4, 1000, 'old'),
+        ])
+
+        dump = IncrementalDump(EsriDumper(self.fake_url), lambda: read_features(previous))
+        merged = list(dump)
+
+        self.assertEqual([5], dump.added)
+        self.assertEqual([3], dump.modified)
+        self.assertEqual([2], dump.deleted)
+        self.assertEqual(
+            [(1, 'old'), (4, 'old'), (3, 'new'), (5, 'new')],
+            [(f['properties']['OBJECTID'], f['properties']['NAME']) for f in merged],
+        )
+        self.assertIn("EDITED+%3E%3D+TIMESTAMP+%271970-01-01+00%3A00%3A01%27", self.responses.calls[2].request.url)
+
+    def test_without_edit_tracking_only_compares_oids(self):
+        self.add_layer({
+            'objectIdField': 'OBJECTID',
+            'maxRecordCount': 1000,
+        }, server_oids=[1, 2, 3])
+        previous = self.write_previous([feature(1, 1000, 'old'), feature(2, 1000, 'old')], jsonlines=False)
+
+        dump = IncrementalDump(EsriDumper(self.fake_url), lambda: read_features(previous))
+        merged = list(dump)
+
+        self.assertEqual([3], dump.added)
+        self.assertEqual([], dump.modified)
+        self.assertEqual([], dump.deleted)
+        self.assertEqual([1, 2, 3], [f['properties']['OBJECTID'] for f in merged])
+
+    def test_reads_esri_json(self):
+        features = [
+            {'attributes': {'OBJECTID': 1}, 'geometry': {'x': 1, 'y': 1}},
+            {'attributes': {'OBJECTID': 2}, 'geometry': None},
+        ]
+
+        for jsonlines in (True, False):
+            path = os.path.join(self.tmpdir, 'previous.json')
+            with open(path, 'w') as f:
+                writer = GeoJSONWriter(f, jsonlines=jsonlines)
+                writer.write_page(features)
+                writer.close()
+
+            self.assertEqual(features, list(read_features(path)))
@@ -0,0 +1,69 @@
+import json
+import unittest
+
+from esridump.jsonstream import FeatureStreamParser
+
+
+def parse_in_chunks(body, size, on_member=None):
+    parser = FeatureStreamParser(on_member=on_member)
+    features = []
+    for i in range(0, len(body), size):
+        features.extend(parser.feed(body[i:i + size]))
+    features.extend(parser.close())
+    return features
+
+
+class TestFeatureStreamParser(unittest.TestCase):
+    def test_matches_json_loads_for_any_chunk_size(self):
+        with open('tests/fixtures/us-ca-tuolumne/us-ca-tuolumne-0.json', 'rb') as f:
+            body = f.read()
+        expected = json.loads(body)
+        expected_features = expected.pop('features')
+
+        for size in (1, 3, 64, 4096, len(body)):
+            members = {}
+            features = parse_in_chunks(body, size, on_member=members.__setitem__)
+
+            self.assertEqual(expected_features, features)
+            self.assertEqual(expected, members)
+
+    def test_numbers_split_across_chunks(self):
+        body = b'{"features": [{"attributes": {"A": 12.5e3}}, {"attributes": {"A": -7}}], "count": 1024}'
+        members = {}
+
+        self.assertEqual(
+            [{'attributes': {'A': 12500.0}}, {'attributes': {'A': -7}}],
+            parse_in_chunks(body, 1, on_member=members.__setitem__),
+        )
+        self.assertEqual({'count': 1024}, members)
+
+    def test_multibyte_characters_split_across_chunks(self):
+        body = '{"features": [{"attributes": {"NAME": "Peñasco €"}}]}'.encode('utf-8')
+
+        self.assertEqual([{'attributes': {'NAME': 'Peñasco €'}}], parse_in_chunks(body, 1))
+
+    def test_error_member_is_reported_before_features(self):
+        body = b'{"error": {"code": 400, "message": "Invalid query", "details": []}}'
+        seen = []
+
+        self.assertEqual([], parse_in_chunks(body, 5, on_member=lambda key, value: seen.append(key)))
+        self.assertEqual(['error'], seen)
+
+    def test_features_are_returned_as_soon_as_they_are_complete(self):
+        parser = FeatureStreamParser()
+
+        self.assertEqual([], parser.feed(b'{"features": [{"id": 1}'))
+        self.assertEqual([{'id': 1}], parser.feed(b', {"id"'))
+        self.assertEqual([{'id': 2}], parser.feed(b': 2}]}'))
+        self.assertEqual([], parser.close())
+
+    def test_truncated_response_raises(self):
+        parser = FeatureStreamParser()
+        parser.feed(b'{"features": [{"id": 1}, {"id":')
+
+        with self.assertRaises(ValueError):
+            parser.close()
+
+    def test_html_response_raises(self):
+        with self.assertRaises(ValueError):
+            FeatureStreamParser().feed(b'<html><body>Error</body></html>')
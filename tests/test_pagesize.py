@@ -0,0 +1,40 @@
+import unittest
+
+from esridump.pagesize import AdaptivePageSize
+
+
+class TestAdaptivePageSize(unittest.TestCase):
+    def setUp(self):
+        self.sizer = AdaptivePageSize(1000, target_seconds=4.0)
+
+    def test_starts_at_a_quarter_of_the_maximum(self):
+        self.assertEqual(250, self.sizer.size)
+
+    def test_fast_pages_grow_up_to_the_maximum(self):
+        self.sizer.record_success(250, 1.0)
+        self.assertEqual(500, self.sizer.size)
+        self.sizer.record_success(500, 1.0)
+        self.sizer.record_success(1000, 1.0)
+        self.assertEqual(1000, self.sizer.size)
+
+    def test_short_pages_dont_grow(self):
+        self.sizer.record_success(40, 0.1)
+        self.assertEqual(250, self.sizer.size)
+
+    def test_slow_and_failed_pages_shrink(self):
+        self.sizer.record_success(250, 3.0)
+        self.assertEqual(250, self.sizer.size)
+        self.sizer.record_success(250, 5.0)
+        self.assertEqual(125, self.sizer.size)
+        self.sizer.record_failure(125)
+        self.assertEqual(62, self.sizer.size)
+
+    def test_pages_cut_before_a_shrink_dont_shrink_it_again(self):
+        self.sizer.record_failure(250)
+        self.sizer.record_failure(250)
+        self.assertEqual(125, self.sizer.size)
+
+    def test_never_below_the_minimum(self):
+        for _ in range(20):
+            self.sizer.record_failure(self.sizer.size)
+        self.assertEqual(1, self.sizer.size)
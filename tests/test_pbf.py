@@ -0,0 +1,198 @@
+import json
+import re
+import responses
+import struct
+import unittest
+from six.moves.urllib.parse import parse_qs
+
+from esridump.dumper import EsriDumper
+from esridump.errors import EsriDownloadError
+from esridump.pbf import decode_query_result
+
+
+def varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, value):
+    """ Encode a varint field, or a length-delimited one if value is bytes. """
+    if isinstance(value, bytes):
+        return varint(number << 3 | 2) + varint(len(value)) + value
+    return varint(number << 3) + varint(value)
+
+
+def double(number, value):
+    return varint(number << 3 | 1) + struct.pack('<d', value)
+
+
+def packed(number, values):
+    return field(number, b''.join(varint(v) for v in values))
+
+
+def feature_collection(features, geometry_type=3, fields=None):
+    """ Encode a FeatureCollectionPBuffer with an upper left origin, scale (0.5, 0.25) and translate (10, 20). """
+    fields = fields or [('OBJECTID', 6), ('NAME', 4), ('AREA', 3)]
+    transform = (
+        field(1, 0) +
+        field(2, double(1, 0.5) + double(2, 0.25)) +
+        field(3, double(1, 10.0) + double(2, 20.0))
+    )
+    result = field(1, b'OBJECTID') + field(7, geometry_type) + field(12, transform)
+    for name, field_type in fields:
+        result += field(13, field(1, name.encode('utf-8')) + field(2, field_type))
+    for attributes, lengths, coords in features:
+        feature = b''.join(field(1, value) for value in attributes)
+        feature += field(2, packed(2, lengths) + packed(3, [zigzag(c) for c in coords]))
+        result += field(15, feature)
+
+    return field(1, b'1.0') + field(2, field(1, result))
+
+
+POLYGON = (
+    [field(5, 1), field(1, 'Main St'.encode('utf-8')), double(3, 0.75)],
+    [5],
+    [0, 0, 0, 4, 2, 0, 0, -4, -2, 0],
+)
+LINE = (
+    [field(5, 2), b'', double(3, 0.0)],
+    [2, 2],
+    [0, 0, 2, 0, 2, 4, 0, 4],
+)
+
+
+class TestDecodeQueryResult(unittest.TestCase):
+    def test_feature_result(self):
+        data = decode_query_result(feature_collection([POLYGON]))
+
+        self.assertEqual('OBJECTID', data['objectIdFieldName'])
+        self.assertEqual('esriGeometryPolygon', data['geometryType'])
+        self.assertEqual(
+            [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+             {'name': 'NAME', 'type': 'esriFieldTypeString'},
+             {'name': 'AREA', 'type': 'esriFieldTypeDouble'}],
+            data['fields'])
+        self.assertEqual([{
+            'attributes': {'OBJECTID': 1, 'NAME': 'Main St', 'AREA': 0.75},
+            'geometry': {'rings': [[[10.0, 20.0], [10.0, 19.0], [11.0, 19.0], [11.0, 20.0], [10.0, 20.0]]]},
+        }], data['features'])
+
+    def test_deltas_continue_across_parts(self):
+        data = decode_query_result(feature_collection([LINE], geometry_type=2))
+
+        self.assertEqual({'OBJECTID': 2, 'NAME': None, 'AREA': 0.0}, data['features'][0]['attributes'])
+        self.assertEqual(
+            {'paths': [[[10.0, 20.0], [11.0, 20.0]], [[12.0, 19.0], [12.0, 18.0]]]},
+            data['features'][0]['geometry'])
+
+    def test_points_are_rounded_to_precision(self):
+        point = ([field(5, 3)], [], [1, 1])
+        data = decode_query_result(feature_collection([point], geometry_type=0, fields=[('OBJECTID', 6)]), 0)
+
+        self.assertEqual({'x': 10.0, 'y': 20.0}, data['features'][0]['geometry'])
+
+    def test_count_result(self):
+        content = field(2, field(2, field(1, 42)))
+
+        self.assertEqual({'count': 42}, decode_query_result(content))
+
+    def test_truncated_content(self):
+        content = feature_collection([POLYGON])
+
+        with self.assertRaises(ValueError):
+            decode_query_result(content[:-3])
+
+
+class TestPbfTransport(unittest.TestCase):
+    def setUp(self):
+        self.responses = responses.RequestsMock()
+        self.responses.start()
+
+        self.fake_url = 'http://example.com'
+
+    def tearDown(self):
+        self.responses.stop()
+        self.responses.reset()
+
+    def add_layer(self, formats, query_body):
+        self.responses.add(
+            method='GET',
+            url=re.compile(r'.*/\?f=json.*'),
+            json={
+                'objectIdField': 'OBJECTID',
+                'maxRecordCount': 1000,
+                'supportsPagination': True,
+                'supportedQueryFormats': formats,
+                'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}],
+            },
+            match_querystring=True,
+        )
+        self.responses.add(
+            method='GET',
+            url=re.compile('.*returnCountOnly=true.*'),
+            json={'count': 2},
+            match_querystring=True,
+        )
+
+        self.formats = []
+
+        def query_callback(request):
+            args = parse_qs(request.body)
+            self.formats.append(args['f'][0])
+            return (200, {}, query_body(args['f'][0]))
+
+        self.responses.add_callback(
+            method='POST',
+            url=re.compile('.*query.*'),
+            callback=query_callback,
+        )
+
+    def json_page(self):
+        return json.dumps({'features': decode_query_result(feature_collection([POLYGON, LINE]))['features']})
+
+    def test_pages_are_decoded_from_pbf(self):
+        self.add_layer('JSON, geoJSON, PBF', lambda f: feature_collection([POLYGON, LINE]))
+
+        data = list(EsriDumper(self.fake_url, transport='pbf', pause_seconds=0))
+
+        self.assertEqual(['pbf'], self.formats)
+        self.assertEqual([1, 2], [feature['properties']['OBJECTID'] for feature in data])
+        self.assertEqual(
+            {'type': 'Polygon', 'coordinates': [[[10.0, 20.0], [10.0, 19.0], [11.0, 19.0], [11.0, 20.0], [10.0, 20.0]]]},
+            data[0]['geometry'])
+
+    def test_json_when_the_layer_has_no_pbf(self):
+        self.add_layer('JSON, geoJSON', lambda f: self.json_page())
+
+        data = list(EsriDumper(self.fake_url, transport='pbf', pause_seconds=0))
+
+        self.assertEqual(['json'], self.formats)
+        self.assertEqual(2, len(data))
+
+    def test_json_when_pbf_can_not_be_decoded(self):
+        self.add_layer('JSON, PBF', lambda f: b'\xff\xff' if f == 'pbf' else self.json_page())
+
+        data = list(EsriDumper(self.fake_url, transport='pbf', pause_seconds=0))
+
+        self.assertEqual(['pbf', 'json'], self.formats)
+        self.assertEqual(2, len(data))
+
+    def test_error_payloads_for_pbf_queries(self):
+        error = {'error': {'code': 400, 'message': 'Invalid query', 'details': []}}
+        self.add_layer('JSON, PBF', lambda f: json.dumps(error))
+
+        with self.assertRaisesRegex(EsriDownloadError, 'Invalid query'):
+            list(EsriDumper(self.fake_url, transport='pbf', pause_seconds=0, num_of_retry=1))
@@ -0,0 +1,121 @@
+import mock
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from esridump.ratelimit import AdaptiveRateLimiter, FixedPauseRateLimiter, HostLimitedSession, retry_after_seconds
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = AdaptiveRateLimiter(initial_rate=2.0, min_rate=0.5, max_rate=3.0, clock=self.clock)
+
+    def test_spaces_requests_at_the_current_rate(self):
+        self.assertEqual(0.0, self.limiter.acquire())
+        self.assertAlmostEqual(0.5, self.limiter.acquire())
+        self.assertAlmostEqual(1.0, self.limiter.acquire())
+
+        self.clock.now += 1.0
+        self.assertAlmostEqual(0.5, self.limiter.acquire())
+
+    def test_additive_increase_up_to_max_rate(self):
+        self.limiter.record_success(0.2)
+        self.assertEqual(2.5, self.limiter.rate)
+        self.limiter.record_success(0.2)
+        self.limiter.record_success(0.2)
+        self.assertEqual(3.0, self.limiter.rate)
+
+    def test_multiplicative_decrease_down_to_min_rate(self):
+        self.limiter.record_failure()
+        self.assertEqual(1.0, self.limiter.rate)
+        self.limiter.record_failure()
+        self.limiter.record_failure()
+        self.assertEqual(0.5, self.limiter.rate)
+
+    def test_slow_response_backs_off(self):
+        self.limiter.record_success(0.2)
+        self.limiter.record_success(5.0)
+        self.assertEqual(1.25, self.limiter.rate)
+
+    def test_retry_after_blocks_requests(self):
+        self.limiter.record_failure(retry_after=30)
+
+        self.assertAlmostEqual(30.0, self.limiter.acquire())
+        self.clock.now += 31
+        self.assertEqual(0.0, self.limiter.acquire())
+
+    def test_retries_back_off_exponentially(self):
+        limiter = AdaptiveRateLimiter(backoff_base=2.0, backoff_cap=20.0, clock=self.clock, random=lambda: 0.0)
+        self.assertEqual([2.0, 4.0, 8.0, 16.0, 20.0], [limiter.backoff(retry) for retry in range(5)])
+
+        jittered = AdaptiveRateLimiter(backoff_base=2.0, clock=self.clock, random=lambda: 1.0)
+        self.assertEqual(4.0, jittered.backoff(2))
+
+    def test_failures_after_a_fast_run_still_wait(self):
+        limiter = AdaptiveRateLimiter(clock=self.clock)
+        for _ in range(200):
+            limiter.record_success(0.05)
+        self.assertEqual(50.0, limiter.rate)
+
+        waited = 0.0
+        for retry in range(5):
+            waited += limiter.acquire()
+            limiter.record_failure()
+            waited += limiter.backoff(retry)
+        self.assertGreater(waited, 30.0)
+
+
+class TestFixedPauseRateLimiter(unittest.TestCase):
+    def test_pauses_every_nth_request(self):
+        limiter = FixedPauseRateLimiter(pause_seconds=10, requests_to_pause=3)
+
+        self.assertEqual([0, 0, 10, 0, 0, 10], [limiter.acquire() for _ in range(6)])
+        self.assertEqual(20, limiter.backoff(1))
+
+
+class TestHostLimitedSession(unittest.TestCase):
+    def test_limits_requests_per_host(self):
+        lock = threading.Lock()
+        in_flight = {}
+        most = {}
+
+        def request(method, url, **kwargs):
+            host = url.split('/')[2]
+            with lock:
+                in_flight[host] = in_flight.get(host, 0) + 1
+                most[host] = max(most.get(host, 0), in_flight[host])
+            time.sleep(0.01)
+            with lock:
+                in_flight[host] -= 1
+            return url
+
+        session = HostLimitedSession(mock.Mock(request=request), 2)
+        urls = ['http://a.example.com/{}'.format(i) for i in range(8)] + ['http://b.example.com/0']
+        with ThreadPoolExecutor(max_workers=9) as executor:
+            self.assertEqual(urls, list(executor.map(lambda url: session.request('GET', url), urls)))
+
+        self.assertEqual({'a.example.com': 2, 'b.example.com': 1}, most)
+
+
+class TestRetryAfter(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(120.0, retry_after_seconds(mock.Mock(headers={'Retry-After': '120'})))
+
+    def test_http_date(self):
+        with mock.patch('time.time', return_value=1445412480.0):
+            response = mock.Mock(headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:30 GMT'})
+            self.assertEqual(30.0, retry_after_seconds(response))
+
+    def test_missing(self):
+        self.assertIsNone(retry_after_seconds(mock.Mock(headers={})))
+        self.assertIsNone(retry_after_seconds(None))
@@ -0,0 +1,115 @@
+import json
+import os
+import re
+import responses
+import shutil
+import tempfile
+import unittest
+from six.moves.urllib.parse import parse_qs
+
+from esridump.service import ServiceDumper
+
+
+def layer(layer_id, name, **kwargs):
+    metadata = {
+        'id': layer_id,
+        'name': name,
+        'type': 'Feature Layer',
+        'objectIdField': 'OBJECTID',
+        'maxRecordCount': 1000,
+        'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}],
+    }
+    metadata.update(kwargs)
+    return metadata
+
+
+class TestServiceDumper(unittest.TestCase):
+    def setUp(self):
+        self.responses = responses.RequestsMock()
+        self.responses.start()
+
+        self.fake_url = 'http://example.com/arcgis/rest/services/Parcels/MapServer'
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.responses.stop()
+        self.responses.reset()
+        shutil.rmtree(self.tmpdir)
+
+    def add_service(self, layers, oids, failing_layer=None):
+        self.responses.add(
+            method='GET',
+            url=re.compile(r'.*/MapServer/layers\?f=json.*'),
+            json={'layers': layers, 'tables': []},
+            match_querystring=True,
+        )
+        self.responses.add(
+            method='GET',
+            url=re.compile('.*returnCountOnly=true.*'),
+            json={'count': len(oids)},
+            match_querystring=True,
+        )
+        self.responses.add(
+            method='GET',
+            url=re.compile('.*returnIdsOnly=true.*'),
+            json={'objectIds': oids},
+            match_querystring=True,
+        )
+
+        def query_callback(request):
+            layer_id = int(re.search(r'/MapServer/(\d+)/query', request.url).group(1))
+            if layer_id == failing_layer:
+                return (200, {}, json.dumps({'error': {'code': 500, 'message': 'Broken layer'}}))
+            where = parse_qs(request.body)['where'][0]
+            first, last = map(int, re.findall(r'\d+', where))
+            features = [
+                {'attributes': {'OBJECTID': oid, 'LAYER': layer_id}}
+                for oid in oids
+                if first <= oid <= last
+            ]
+            return (200, {}, json.dumps({'features': features}))
+
+        self.responses.add_callback(method='POST', url=re.compile('.*query.*'), callback=query_callback)
+
+    def read(self, name):
+        with open(os.path.join(self.tmpdir, name)) as f:
+            return [json.loads(line) for line in f]
+
+    def test_dumps_each_layer(self):
+        self.add_service([
+            layer(0, 'Parcels'),
+            {'id': 1, 'name': 'Boundaries', 'type': 'Group Layer', 'subLayerIds': [2]},
+            layer(2, 'City Limits'),
+        ], [1, 2, 3])
+
+        with ServiceDumper(self.fake_url, pause_seconds=0) as service:
+            paths = service.dump(self.tmpdir, jsonlines=True)
+
+        self.assertEqual({
+            0: os.path.join(self.tmpdir, '0-parcels.geojsonl'),
+            2: os.path.join(self.tmpdir, '2-city-limits.geojsonl'),
+        }, paths)
+        self.assertEqual([2, 2, 2], [f['properties']['LAYER'] for f in self.read('2-city-limits.geojsonl')])
+        self.assertEqual({}, service.errors)
+        # Layer metadata came from the service, so no layer asked for its own
+        self.assertFalse(any(re.search(r'/MapServer/\d+\?f=json', call.request.url) for call in self.responses.calls))
+
+    def test_esri_json_layers_are_named_for_it(self):
+        self.add_service([layer(0, 'Parcels')], [1, 2])
+
+        with ServiceDumper(self.fake_url, pause_seconds=0, output_format='esrijson') as service:
+            paths = service.dump(self.tmpdir)
+
+        self.assertEqual({0: os.path.join(self.tmpdir, '0-parcels.json')}, paths)
+        with open(paths[0]) as f:
+            self.assertEqual([1, 2], [feature['attributes']['OBJECTID'] for feature in json.load(f)['features']])
+
+    def test_failing_layers_dont_stop_the_others(self):
+        self.add_service([layer(0, 'Parcels'), layer(1, 'Roads')], [1, 2, 3], failing_layer=1)
+
+        with ServiceDumper(self.fake_url, pause_seconds=0, num_of_retry=1) as service:
+            paths = service.dump(self.tmpdir, jsonlines=True)
+
+        self.assertEqual([0], list(paths))
+        self.assertEqual([1], list(service.errors))
+        self.assertEqual(['0-parcels.geojsonl'], os.listdir(self.tmpdir))
@@ -0,0 +1,67 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from esridump.shards import ShardedWriter, shard_path
+
+
+def feature(oid):
+    return {'type': 'Feature', 'geometry': None, 'properties': {'OBJECTID': oid}}
+
+
+class TestShardedWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'parcels.geojson')
+        self.manifest = os.path.join(self.tmpdir, 'shards.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_manifest(self):
+        with open(self.manifest) as f:
+            return [json.loads(line) for line in f]
+
+    def test_shard_path(self):
+        self.assertEqual('out/parcels-00003.geojson', shard_path('out/parcels.geojson', 3))
+        self.assertEqual('parcels-00000.geojsonl.gz', shard_path('parcels.geojsonl.gz', 0))
+
+    def test_shards_by_feature_count(self):
+        writer = ShardedWriter(self.path, 2, oid_field='OBJECTID', manifest=self.manifest)
+        writer.write_page([feature(oid) for oid in (5, 3, 9)])
+        # The second shard is listed as soon as it fills up, before the dump finishes
+        writer.write_page([feature(oid) for oid in (1, 2)])
+        self.assertEqual(2, len(self.read_manifest()))
+        writer.close()
+
+        self.assertEqual([
+            {'path': shard_path(self.path, 0), 'features': 2, 'min_oid': 3, 'max_oid': 5},
+            {'path': shard_path(self.path, 1), 'features': 2, 'min_oid': 1, 'max_oid': 9},
+            {'path': shard_path(self.path, 2), 'features': 1, 'min_oid': 2, 'max_oid': 2},
+        ], self.read_manifest())
+        self.assertEqual(self.read_manifest(), writer.shards)
+
+        for index, oids in enumerate([[5, 3], [9, 1], [2]]):
+            with open(shard_path(self.path, index)) as f:
+                collection = json.load(f)
+            self.assertEqual(oids, [f['properties']['OBJECTID'] for f in collection['features']])
+
+    def test_shards_by_size(self):
+        size = len(json.dumps(feature(1))) + 1
+        writer = ShardedWriter(self.path + '.gz', size * 3, by_bytes=True, jsonlines=True, compress='gzip')
+        writer.write_page([feature(oid) for oid in range(1, 8)])
+        writer.close()
+
+        self.assertEqual([3, 3, 1], [shard['features'] for shard in writer.shards])
+        with gzip.open(shard_path(self.path + '.gz', 1), 'rt') as f:
+            self.assertEqual([4, 5, 6], [json.loads(line)['properties']['OBJECTID'] for line in f])
+
+    def test_no_features_is_one_empty_shard(self):
+        writer = ShardedWriter(self.path, 10)
+        writer.close()
+
+        with open(shard_path(self.path, 0)) as f:
+            self.assertEqual([], json.load(f)['features'])
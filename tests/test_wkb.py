@@ -0,0 +1,120 @@
+import struct
+import unittest
+
+from esridump.esri2geojson import convert_esri_geometry
+from esridump.wkb import esri_to_wkb, geojson_to_wkb
+
+
+def header(geometry_type):
+    return struct.pack('<BI', 1, geometry_type)
+
+
+def doubles(*values):
+    return struct.pack('<%dd' % len(values), *values)
+
+
+def count(n):
+    return struct.pack('<I', n)
+
+
+class TestGeoJSONToWKB(unittest.TestCase):
+    def test_point(self):
+        self.assertEqual(
+            bytes.fromhex('0101000000000000000000f03f0000000000000040'),
+            geojson_to_wkb({'type': 'Point', 'coordinates': [1, 2]}))
+
+    def test_point_z(self):
+        self.assertEqual(
+            header(1001) + doubles(1, 2, 3),
+            geojson_to_wkb({'type': 'Point', 'coordinates': [1, 2, 3]}))
+
+    def test_polygon(self):
+        ring = [[0, 0], [1, 0], [1, 1], [0, 0]]
+        self.assertEqual(
+            header(3) + count(1) + count(4) + doubles(0, 0, 1, 0, 1, 1, 0, 0),
+            geojson_to_wkb({'type': 'Polygon', 'coordinates': [ring]}))
+
+    def test_multi_geometries_hold_whole_parts(self):
+        self.assertEqual(
+            header(4) + count(2) + header(1) + doubles(1, 2) + header(1) + doubles(3, 4),
+            geojson_to_wkb({'type': 'MultiPoint', 'coordinates': [[1, 2], [3, 4]]}))
+        self.assertEqual(
+            header(5) + count(1) + header(2) + count(2) + doubles(0, 0, 1, 1),
+            geojson_to_wkb({'type': 'MultiLineString', 'coordinates': [[[0, 0], [1, 1]]]}))
+
+    def test_geometry_collection(self):
+        self.assertEqual(
+            header(7) + count(1) + header(1) + doubles(1, 2),
+            geojson_to_wkb({'type': 'GeometryCollection', 'geometries': [{'type': 'Point', 'coordinates': [1, 2]}]}))
+
+    def test_no_geometry(self):
+        self.assertIsNone(geojson_to_wkb(None))
+
+
+class TestEsriToWKB(unittest.TestCase):
+    def assertSameAsGeoJSON(self, esri_geometry):
+        self.assertEqual(geojson_to_wkb(convert_esri_geometry(esri_geometry)), esri_to_wkb(esri_geometry))
+
+    def test_matches_the_geojson_conversion(self):
+        self.assertSameAsGeoJSON({'x': 1, 'y': 2})
+        self.assertSameAsGeoJSON({'points': [[1, 2]]})
+        self.assertSameAsGeoJSON({'points': [[1, 2], [3, 4]]})
+        self.assertSameAsGeoJSON({'paths': [[[0, 0], [1, 1]]]})
+        self.assertSameAsGeoJSON({'paths': [[[0, 0], [1, 1]], [[2, 2], [3, 3]]]})
+
+    def test_polygon_rings_are_closed_and_grouped(self):
+        outer = [[0, 0], [0, 10], [10, 10], [10, 0]]
+        hole = [[2, 2], [4, 2], [4, 4], [2, 4], [2, 2]]
+        other = [[20, 20], [20, 30], [30, 30], [20, 20]]
+        degenerate = [[5, 5], [6, 6], [5, 5]]
+
+        self.assertSameAsGeoJSON({'rings': [outer]})
+        self.assertSameAsGeoJSON({'rings': [outer, hole, degenerate, other]})
+        self.assertEqual(
+            header(6) + count(2) +
+            header(3) + count(2) + count(5) + doubles(0, 0, 0, 10, 10, 10, 10, 0, 0, 0) +
+            count(5) + doubles(2, 2, 4, 2, 4, 4, 2, 4, 2, 2) +
+            header(3) + count(1) + count(4) + doubles(20, 20, 20, 30, 30, 30, 20, 20),
+            esri_to_wkb({'rings': [outer, hole, other]}))
+        self.assertIsNone(esri_to_wkb({'rings': [degenerate]}))
+
+    def test_z_comes_from_has_z(self):
+        self.assertEqual(
+            header(1001) + doubles(1, 2, 3),
+            esri_to_wkb({'x': 1, 'y': 2, 'z': 3, 'hasZ': True}))
+        # The third value of an M geometry is not a Z
+        self.assertEqual(
+            header(2) + count(2) + doubles(0, 0, 1, 1),
+            esri_to_wkb({'paths': [[[0, 0, 5], [1, 1, 6]]], 'hasM': True}))
+
+    def test_z_comes_from_the_layer(self):
+        self.assertEqual(
+            header(1002) + count(2) + doubles(0, 0, 5, 1, 1, 6),
+            esri_to_wkb({'paths': [[[0, 0, 5, 9], [1, 1, 6, 9]]]}, has_z=True))
+        # A layer with only hasM has no Z, however many values its positions have
+        self.assertEqual(
+            header(2) + count(2) + doubles(0, 0, 1, 1),
+            esri_to_wkb({'paths': [[[0, 0, 5], [1, 1, 6]]]}, has_z=False))
+        self.assertEqual(header(1), esri_to_wkb({'x': 1, 'y': 2, 'z': 3}, has_z=False)[:5])
+
+    def test_z_from_positions_without_flags(self):
+        # Without the layer's hasZ, a third value is taken for Z
+        self.assertEqual(
+            header(1002) + count(2) + doubles(0, 0, 5, 1, 1, 6),
+            esri_to_wkb({'paths': [[[0, 0, 5], [1, 1, 6]]]}))
+        self.assertEqual(header(1001) + doubles(1, 2, 3), esri_to_wkb({'x': 1, 'y': 2, 'z': 3}))
+
+    def test_ewkb_carries_the_srid(self):
+        self.assertEqual(
+            bytes.fromhex('0101000020e6100000000000000000f03f0000000000000040'),
+            esri_to_wkb({'x': 1, 'y': 2}, srid=4326))
+        # Only the outer geometry has the SRID, and Z is a flag rather than 1000 more
+        self.assertEqual(
+            struct.pack('<BII', 1, 0xa0000004, 3857) + count(2) +
+            struct.pack('<BI', 1, 0x80000001) + doubles(1, 2, 3) +
+            struct.pack('<BI', 1, 0x80000001) + doubles(4, 5, 6),
+            esri_to_wkb({'points': [[1, 2, 3], [4, 5, 6]], 'hasZ': True}, srid=3857))
+
+    def test_no_geometry(self):
+        self.assertIsNone(esri_to_wkb(None))
+        self.assertIsNone(esri_to_wkb({'x': None, 'y': None}))
@@ -0,0 +1,319 @@
+import io
+import json
+import mock
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import unittest
+
+from esridump.writers import (
+    GeoJSONWriter, GeoPackageWriter, GeoParquetWriter, PostGISCopyWriter, json_dumps, orjson, pyarrow, serialize_features,
+)
+from esridump.wkb import esri_to_wkb, geojson_to_wkb
+
+
+class TestGeoJSONWriter(unittest.TestCase):
+    def setUp(self):
+        self.features = [
+            {'type': 'Feature', 'geometry': None, 'properties': {'OBJECTID': i, 'NAME': 'Straße {}'.format(i)}}
+            for i in range(5)
+        ]
+
+    def test_feature_collection_across_pages(self):
+        outfile = io.StringIO()
+        writer = GeoJSONWriter(outfile)
+        writer.write_page(self.features[:2])
+        writer.write_page([])
+        writer.write_page(self.features[2:])
+        writer.close()
+
+        self.assertEqual(
+            '{"type":"FeatureCollection","features":[\n' + ',\n'.join(map(json.dumps, self.features)) + '\n]}',
+            outfile.getvalue(),
+        )
+
+    def test_serialized_pages_match_write_page(self):
+        for jsonlines in (False, True):
+            by_page = io.StringIO()
+            writer = GeoJSONWriter(by_page, jsonlines=jsonlines)
+            for page in (self.features[:2], [], self.features[2:]):
+                writer.write_page(page)
+            writer.close()
+
+            serialized = io.StringIO()
+            writer = GeoJSONWriter(serialized, jsonlines=jsonlines)
+            for page in (self.features[:2], [], self.features[2:]):
+                writer.write_serialized(serialize_features(page, jsonlines))
+            writer.close()
+
+            self.assertEqual(by_page.getvalue(), serialized.getvalue())
+
+    def test_empty_feature_collection(self):
+        outfile = io.StringIO()
+        writer = GeoJSONWriter(outfile)
+        writer.close()
+
+        self.assertEqual('{"type":"FeatureCollection","features":[\n\n]}', outfile.getvalue())
+
+    def test_jsonlines_in_bounded_writes(self):
+        outfile = io.StringIO()
+        outfile.write = writes = mock.Mock(wraps=outfile.write)
+        writer = GeoJSONWriter(outfile, jsonlines=True, buffer_size=200)
+        writer.write_page(iter(self.features))
+        writer.close()
+
+        self.assertEqual(''.join(json.dumps(f) + '\n' for f in self.features), outfile.getvalue())
+        self.assertEqual(2, writes.call_count)
+
+    @unittest.skipIf(orjson is None, "orjson is not installed")
+    def test_fast_json_round_trips(self):
+        outfile = io.StringIO()
+        writer = GeoJSONWriter(outfile, dumps=json_dumps(fast=True))
+        writer.write_page(self.features)
+        writer.close()
+
+        self.assertEqual(self.features, json.loads(outfile.getvalue())['features'])
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class TestGeoParquetWriter(unittest.TestCase):
+    fields = [
+        {'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+        {'name': 'NAME', 'type': 'esriFieldTypeString'},
+        {'name': 'BUILT', 'type': 'esriFieldTypeDate'},
+        {'name': 'AREA', 'type': 'esriFieldTypeDouble'},
+        {'name': 'Shape', 'type': 'esriFieldTypeGeometry'},
+    ]
+
+    def feature(self, i):
+        return {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [i, -i]} if i % 2 else None,
+            'properties': {'OBJECTID': i, 'NAME': 1000 + i if i == 3 else 'Lot {}'.format(i),
+                           'BUILT': 86400000 * i, 'AREA': i / 2.0},
+        }
+
+    def test_pages_are_written_in_row_groups(self):
+        import pyarrow.parquet
+
+        out = io.BytesIO()
+        writer = GeoParquetWriter(out, self.fields, row_group_size=2)
+        writer.write_page([self.feature(i) for i in range(3)])
+        writer.write_page([self.feature(i) for i in range(3, 5)])
+        writer.close()
+
+        parquet = pyarrow.parquet.ParquetFile(io.BytesIO(out.getvalue()))
+        self.assertEqual(3, parquet.num_row_groups)
+        self.assertEqual(['OBJECTID', 'NAME', 'BUILT', 'AREA', 'geometry'], parquet.schema_arrow.names)
+
+        geo = json.loads(parquet.schema_arrow.metadata[b'geo'])
+        self.assertEqual('geometry', geo['primary_column'])
+        self.assertEqual('WKB', geo['columns']['geometry']['encoding'])
+        self.assertNotIn('crs', geo['columns']['geometry'])
+
+        table = parquet.read().to_pydict()
+        self.assertEqual([0, 1, 2, 3, 4], table['OBJECTID'])
+        self.assertEqual('1003', table['NAME'][3])
+        self.assertEqual(3, table['BUILT'][2].day)
+        self.assertEqual([None, geojson_to_wkb(self.feature(1)['geometry'])], table['geometry'][:2])
+
+    def test_other_srids_have_an_unknown_crs(self):
+        import pyarrow.parquet
+
+        out = io.BytesIO()
+        writer = GeoParquetWriter(out, self.fields, srid=3857)
+        writer.close()
+
+        geo = json.loads(pyarrow.parquet.read_schema(io.BytesIO(out.getvalue())).metadata[b'geo'])
+        self.assertIsNone(geo['columns']['geometry']['crs'])
+
+
+class TestPostGISCopyWriter(unittest.TestCase):
+    fields = [
+        {'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+        {'name': 'NAME', 'type': 'esriFieldTypeString'},
+        {'name': 'BUILT', 'type': 'esriFieldTypeDate'},
+        {'name': 'AREA', 'type': 'esriFieldTypeDouble'},
+        {'name': 'Shape', 'type': 'esriFieldTypeGeometry'},
+    ]
+
+    features = [
+        {'attributes': {'OBJECTID': 1, 'NAME': 'Tab\there\\', 'BUILT': 86400000, 'AREA': 1.5},
+         'geometry': {'x': 1, 'y': 2}},
+        {'attributes': {'OBJECTID': 2, 'NAME': None, 'BUILT': None, 'AREA': None}, 'geometry': None},
+    ]
+
+    def test_text(self):
+        out = io.StringIO()
+        writer = PostGISCopyWriter(out, self.fields)
+        writer.write_page(self.features)
+        writer.close()
+
+        self.assertEqual(
+            '1\tTab\\there\\\\\t1970-01-02T00:00:00+00:00\t1.5\t{}\n'
+            '2\t\\N\t\\N\t\\N\t\\N\n'.format(esri_to_wkb({'x': 1, 'y': 2}, srid=4326).hex()),
+            out.getvalue())
+
+    def test_text_with_table(self):
+        out = io.StringIO()
+        writer = PostGISCopyWriter(out, self.fields[:2], srid=3857, table='public.parcels')
+        writer.write_page(self.features[1:])
+        writer.close()
+
+        self.assertEqual(
+            'CREATE TABLE "public"."parcels" (\n'
+            '    "OBJECTID" bigint,\n'
+            '    "NAME" text,\n'
+            '    geometry geometry(Geometry, 3857)\n'
+            ');\n'
+            'COPY "public"."parcels" ("OBJECTID", "NAME", geometry) FROM STDIN;\n'
+            '2\t\\N\t\\N\n'
+            '\\.\n',
+            out.getvalue())
+
+    def test_z_table(self):
+        out = io.StringIO()
+        writer = PostGISCopyWriter(out, self.fields[:1], table='parcels', has_z=True)
+        writer.write_page([{'attributes': {'OBJECTID': 1}, 'geometry': {'x': 1, 'y': 2, 'z': 3}}])
+        writer.close()
+
+        geometry = esri_to_wkb({'x': 1, 'y': 2, 'z': 3}, srid=4326, has_z=True)
+        # The EWKB has a Z, so the column must take one
+        self.assertEqual(0xA0000001, struct.unpack('<I', geometry[1:5])[0])
+        self.assertEqual(
+            'CREATE TABLE "parcels" (\n'
+            '    "OBJECTID" bigint,\n'
+            '    geometry geometry(GeometryZ, 4326)\n'
+            ');\n'
+            'COPY "parcels" ("OBJECTID", geometry) FROM STDIN;\n'
+            '1\t{}\n'
+            '\\.\n'.format(geometry.hex()),
+            out.getvalue())
+
+    def test_binary(self):
+        out = io.BytesIO()
+        writer = PostGISCopyWriter(out, self.fields, binary=True)
+        writer.write_page(self.features)
+        writer.close()
+
+        geometry = esri_to_wkb({'x': 1, 'y': 2}, srid=4326)
+        self.assertEqual(
+            b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0) +
+            struct.pack('>hiq', 5, 8, 1) +
+            struct.pack('>i', 9) + b'Tab\there\\' +
+            # Microseconds before 2000-01-01
+            struct.pack('>iq', 8, (86400000 - 946684800000) * 1000) +
+            struct.pack('>id', 8, 1.5) +
+            struct.pack('>i', len(geometry)) + geometry +
+            struct.pack('>hiq', 5, 8, 2) + struct.pack('>iiii', -1, -1, -1, -1) +
+            struct.pack('>h', -1),
+            out.getvalue())
+
+
+class TestGeoPackageWriter(unittest.TestCase):
+    fields = [
+        {'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+        {'name': 'NAME', 'type': 'esriFieldTypeString'},
+        {'name': 'BUILT', 'type': 'esriFieldTypeDate'},
+        {'name': 'AREA', 'type': 'esriFieldTypeDouble'},
+        {'name': 'Shape', 'type': 'esriFieldTypeGeometry'},
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'out.gpkg')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def feature(self, oid):
+        return {
+            'attributes': {'OBJECTID': oid, 'NAME': 'Lot {}'.format(oid), 'BUILT': 86400000 * oid, 'AREA': oid / 2.0},
+            'geometry': {'paths': [[[oid, -oid], [oid + 1, 1 - oid]]]} if oid != 3 else None,
+        }
+
+    def write(self, pages, fields=None, **kwargs):
+        writer = GeoPackageWriter(self.path, fields or self.fields, table='parcels', **kwargs)
+        for page in pages:
+            writer.write_page(page)
+        writer.close()
+
+        connection = sqlite3.connect(self.path)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_features_table(self):
+        db = self.write([[self.feature(i) for i in range(1, 4)], [self.feature(4)]], transaction_size=2)
+
+        self.assertEqual(0x47504B47, db.execute('PRAGMA application_id').fetchone()[0])
+        self.assertEqual(
+            [('fid', 'INTEGER', 1), ('geom', 'GEOMETRY', 0), ('OBJECTID', 'INTEGER', 0), ('NAME', 'TEXT', 0),
+             ('BUILT', 'DATETIME', 0), ('AREA', 'DOUBLE', 0)],
+            [(name, column_type, pk) for _, name, column_type, _, _, pk in db.execute('PRAGMA table_info(parcels)')])
+
+        rows = db.execute('SELECT OBJECTID, NAME, BUILT, AREA, geom FROM parcels ORDER BY fid').fetchall()
+        self.assertEqual([1, 2, 3, 4], [row[0] for row in rows])
+        self.assertEqual(('Lot 2', '1970-01-03T00:00:00.000Z', 1.0), rows[1][1:4])
+        self.assertIsNone(rows[2][4])
+
+        # GeoPackage geometries are a header with the SRID and envelope, then WKB
+        geometry = rows[0][4]
+        self.assertEqual((b'GP', 0, 0b011, 4326, 1.0, 2.0, -1.0, 0.0), struct.unpack('<2sBBi4d', geometry[:40]))
+        self.assertEqual(esri_to_wkb(self.feature(1)['geometry']), geometry[40:])
+
+        self.assertEqual(
+            [(1, 1.0, 2.0, -1.0, 0.0), (2, 2.0, 3.0, -2.0, -1.0), (4, 4.0, 5.0, -4.0, -3.0)],
+            db.execute('SELECT * FROM rtree_parcels_geom ORDER BY id').fetchall())
+        self.assertEqual(
+            [('parcels', 'features', 4326, 1.0, -4.0, 5.0, 0.0)],
+            db.execute('SELECT table_name, data_type, srs_id, min_x, min_y, max_x, max_y FROM gpkg_contents').fetchall())
+        self.assertEqual(
+            [('parcels', 'geom', 'GEOMETRY', 4326)],
+            db.execute('SELECT table_name, column_name, geometry_type_name, srs_id FROM gpkg_geometry_columns').fetchall())
+        self.assertEqual(
+            [('parcels', 'geom', 'gpkg_rtree_index')],
+            db.execute('SELECT table_name, column_name, extension_name FROM gpkg_extensions').fetchall())
+        self.assertEqual(6, db.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'parcels'").fetchone()[0])
+
+    def test_empty_geometries(self):
+        empty = [
+            {'attributes': {'OBJECTID': 1}, 'geometry': {'points': []}},
+            {'attributes': {'OBJECTID': 2}, 'geometry': {'paths': []}},
+        ]
+        db = self.write([empty + [self.feature(3), self.feature(4)]])
+
+        rows = db.execute('SELECT geom FROM parcels ORDER BY fid').fetchall()
+        # Empty geometries have the empty flag and no envelope
+        self.assertEqual((b'GP', 0, 0b10001, 4326), struct.unpack('<2sBBi', rows[0][0][:8]))
+        self.assertEqual(esri_to_wkb({'points': []}), rows[0][0][8:])
+        self.assertEqual(esri_to_wkb({'paths': []}), rows[1][0][8:])
+        self.assertEqual([4], [row[0] for row in db.execute('SELECT id FROM rtree_parcels_geom')])
+
+    def test_z_comes_from_the_layer(self):
+        feature = {'attributes': {'OBJECTID': 1}, 'geometry': {'paths': [[[0, 0, 5], [1, 1, 6]]]}}
+        db = self.write([[feature]], has_z=True)
+
+        self.assertEqual(2, db.execute('SELECT z FROM gpkg_geometry_columns').fetchone()[0])
+        self.assertEqual(
+            esri_to_wkb(feature['geometry'], has_z=True),
+            db.execute('SELECT geom FROM parcels').fetchone()[0][40:])
+
+        # The third values of a layer without hasZ are M values
+        os.remove(self.path)
+        db = self.write([[feature]])
+        self.assertEqual(
+            esri_to_wkb(feature['geometry'], has_z=False),
+            db.execute('SELECT geom FROM parcels').fetchone()[0][40:])
+
+    def test_object_ids_can_repeat(self):
+        db = self.write([[self.feature(5), self.feature(5)]], srid=3857)
+
+        self.assertEqual([(1, 5), (2, 5)], db.execute('SELECT fid, OBJECTID FROM parcels').fetchall())
+        self.assertEqual([1, 2], [row[0] for row in db.execute('SELECT id FROM rtree_parcels_geom')])
+        self.assertEqual(
+            [('EPSG', 3857, 'undefined')],
+            db.execute('SELECT organization, organization_coordsys_id, definition FROM gpkg_spatial_ref_sys '
+                       'WHERE srs_id = 3857').fetchall())